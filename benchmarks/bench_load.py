@@ -0,0 +1,243 @@
+"""
+Load test of the FCW service with simulated clients
+
+Simulated CollisionWarningClients stream a clip (pre-decoded frames of a video, looped) at given FPS. The number of
+sessions is ramped up in stages, each stage reports throughput of results, drop rate (frames without results) and
+latency percentiles (frame send -> results received) of frames sent during the stage. The ramp stops at the
+saturation point - the first stage with drop rate or p90 latency over the limits.
+
+The service is either a running fcw_service (--address), or a Server started in this process connected by Socket.IO
+on localhost (--transport socketio) or by the in-process stand-in of the transport without network
+(--transport local, fcw_service.local_transport). Clients run in this process in all cases, their rectification
+and encoding share CPU with an in-process server.
+
+python3 bench_load.py [--transport local] [--start 1] [--step 1] [--max-sessions 16] [--stage-time 10]
+python3 bench_load.py --address http://localhost:5896 [--fps 10] [--output load.json]
+"""
+from argparse import ArgumentParser
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from era_5g_interface.exceptions import BackPressureException
+from era_5g_interface.utils.rate_timer import RateTimer
+from fcw_client.client_common import CollisionWarningClient, StreamType
+
+
+def load_frames(video: str, n: int) -> List[np.ndarray]:
+    frames = []
+    cap = cv2.VideoCapture(video)
+    while len(frames) < n:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise Exception(f"Cannot read frames of {video}")
+    return frames
+
+
+class SimulatedClient(threading.Thread):
+    """Client streaming frames at given FPS, records send timestamps and latencies of results"""
+
+    def __init__(self, index: int, frames: List[np.ndarray], fps: float, **client_args):
+        super().__init__(name=f"Simulated client {index}", daemon=True)
+        self.frames = frames
+        self.fps = fps
+        # Clients do not send the same frames at the same time
+        self.offset = index * 7
+        # Send timestamps [ns] and latencies [ns] by send timestamp
+        self.sent: List[int] = []
+        self.latencies: Dict[int, int] = {}
+        self._stop_event = threading.Event()
+        self.client = CollisionWarningClient(fps=fps, viz=False, results_callback=self.get_results, **client_args)
+
+    def get_results(self, results: Dict[str, Any]):
+        timestamp = results.get("timestamp")
+        if timestamp:
+            self.latencies.setdefault(timestamp, time.perf_counter_ns() - timestamp)
+
+    def run(self):
+        rate_timer = RateTimer(rate=self.fps)
+        i = self.offset
+        while not self._stop_event.is_set():
+            timestamp = time.perf_counter_ns()
+            self.sent.append(timestamp)
+            try:
+                self.client.send_image(self.frames[i % len(self.frames)], timestamp)
+            except BackPressureException:
+                # Frame is dropped by transport
+                pass
+            i += 1
+            rate_timer.sleep()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.client.stop()
+
+
+def stage_stats(clients: List[SimulatedClient], start: int, end: int) -> Dict[str, Any]:
+    """
+    Statistics of frames sent in [start, end) [ns] by all clients
+    """
+    sent = 0
+    latencies = []
+    for c in clients:
+        timestamps = [t for t in c.sent if start <= t < end]
+        sent += len(timestamps)
+        latencies.extend(c.latencies[t] for t in timestamps if t in c.latencies)
+    duration = (end - start) * 1e-9
+    latencies = np.array(latencies) * 1e-6
+    stats = dict(
+        sessions=len(clients),
+        sent_fps=sent / duration,
+        results_fps=len(latencies) / duration,
+        drop_rate=1 - len(latencies) / sent if sent else 0.0,
+    )
+    for p in (50, 90, 99):
+        stats[f"p{p}_ms"] = float(np.percentile(latencies, p)) if len(latencies) else float("nan")
+    return stats
+
+
+def start_server(args):
+    """
+    Server in this process, returns (server, netapp_info, client_factory)
+    """
+    if args.transport == "local":
+        from fcw_service.local_transport import LocalClient, LocalServer
+
+        server = LocalServer(worker_processes=args.worker_processes, warm_workers=args.warm_workers)
+        return server, "local", functools.partial(LocalClient, server)
+
+    from fcw_service.interface import Server
+
+    server = Server(
+        worker_processes=args.worker_processes, warm_workers=args.warm_workers, port=args.port, host="127.0.0.1"
+    )
+    threading.Thread(target=server.run_server, name="Server", daemon=True).start()
+    # Wait for the server to listen
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    return server, f"http://127.0.0.1:{args.port}", None
+
+
+def main():
+    parser = ArgumentParser(description="Load test of FCW service with simulated clients")
+    parser.add_argument("--address", type=str, default=None, help="Address of running FCW service")
+    parser.add_argument(
+        "--transport",
+        type=str,
+        choices=["local", "socketio"],
+        default="local",
+        help="Transport of server started in this process when no address is given",
+    )
+    parser.add_argument("--port", type=int, default=5896, help="Port of server started in this process")
+    parser.add_argument("--worker-processes", type=int, default=0, help="Worker processes of started server")
+    parser.add_argument("--warm-workers", type=int, default=0, help="Pre-loaded detectors of started server")
+    parser.add_argument("--video", type=str, default="../videos/video3.mp4", help="Streamed clip")
+    parser.add_argument("--camera", type=Path, default=Path("../videos/video3.yaml"), help="Camera config of clip")
+    parser.add_argument("--config", type=Path, default=Path("../config/config.yaml"), help="FCW config")
+    parser.add_argument("--frames", type=int, default=150, help="Number of pre-decoded frames of the clip")
+    parser.add_argument("--fps", type=float, default=10, help="Frame rate of each client")
+    parser.add_argument("--stream", type=str, choices=["h264", "hevc", "jpeg"], default="h264", help="Image codec")
+    parser.add_argument("--start", type=int, default=1, help="Sessions of the first stage")
+    parser.add_argument("--step", type=int, default=1, help="Sessions added in each stage")
+    parser.add_argument("--max-sessions", type=int, default=16, help="Maximal number of sessions")
+    parser.add_argument("--warmup", type=float, default=3, help="Time after adding sessions before measurement [s]")
+    parser.add_argument("--stage-time", type=float, default=10, help="Measurement time of each stage [s]")
+    parser.add_argument("--max-drop", type=float, default=0.1, help="Saturation drop rate")
+    parser.add_argument("--max-latency", type=float, default=0.2, help="Saturation p90 latency [s]")
+    parser.add_argument("--no-stop", action="store_true", help="Continue ramp after saturation")
+    parser.add_argument("--output", type=str, default=None, help="Write stages to JSON")
+    parser.add_argument("--verbose", action="store_true", help="Log client and service")
+    args = parser.parse_args()
+
+    server = None
+    netapp_info, client_factory = args.address, None
+    if args.address is None:
+        server, netapp_info, client_factory = start_server(args)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    frames = load_frames(args.video, args.frames)
+    client_args = dict(
+        config=args.config,
+        camera_config=args.camera,
+        netapp_info=netapp_info,
+        stream_type=StreamType[args.stream.upper()],
+        client_factory=client_factory,
+    )
+
+    clients: List[SimulatedClient] = []
+    stages = []
+    saturation: Optional[int] = None
+    print(f"{'sessions':>8} {'sent/s':>8} {'results/s':>9} {'drop':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    try:
+        sessions = args.start
+        while sessions <= args.max_sessions:
+            while len(clients) < sessions:
+                client = SimulatedClient(len(clients), frames, args.fps, **client_args)
+                client.start()
+                clients.append(client)
+            time.sleep(args.warmup)
+            start = time.perf_counter_ns()
+            time.sleep(args.stage_time)
+            end = time.perf_counter_ns()
+            # Results of the last frames of the stage are still on the way
+            time.sleep(args.max_latency * 2)
+            stats = stage_stats(clients, start, end)
+            stats["saturated"] = stats["drop_rate"] > args.max_drop or stats["p90_ms"] > args.max_latency * 1e3
+            stages.append(stats)
+            print(
+                f"{sessions:>8} {stats['sent_fps']:>8.1f} {stats['results_fps']:>9.1f} {stats['drop_rate']:>6.1%} "
+                f"{stats['p50_ms']:>8.1f} {stats['p90_ms']:>8.1f} {stats['p99_ms']:>8.1f}"
+                f"{' SATURATED' if stats['saturated'] else ''}"
+            )
+            if stats["saturated"] and saturation is None:
+                saturation = sessions
+                if not args.no_stop:
+                    break
+            sessions += args.step
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients:
+            client.stop()
+
+    sustained = max([s["sessions"] for s in stages if not s["saturated"]], default=0)
+    if saturation is not None:
+        print(f"Saturated at {saturation} sessions, {sustained} sessions sustained at {args.fps} FPS")
+    else:
+        print(f"Not saturated, {sustained} sessions sustained at {args.fps} FPS")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(fps=args.fps, sustained=sustained, saturation=saturation, stages=stages), f, indent=2)
+
+    if server is not None:
+        if server.heartbeat_sender is not None:
+            server.heartbeat_sender.heartbeat_timer.stop()
+        if server.worker_pool is not None:
+            server.worker_pool.close()
+        if server.warm_pool is not None:
+            server.warm_pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of Camera.rectify_image
+
+Compares the original rectification (full-frame GaussianBlur + remap with float maps into newly allocated image)
+with fixed-point Rectifier, with and without anti-aliasing folded into a decimated remap, and with reused output.
+
+python3 bench_rectify.py [-n 200] [--video ../videos/video3.mp4]
+"""
+from argparse import ArgumentParser
+import time
+
+import cv2
+import numpy as np
+
+from fcw_core_utils.geometry import Camera, Rectifier
+
+
+def camera_dict(image_size, rectified_size):
+    """Calibration of videos/video3.yaml scaled to given image size"""
+    w, h = image_size
+    s = w / 962
+    return {
+        "image_size": list(image_size),
+        "rectified_size": list(rectified_size),
+        "K": [[1321 * s, 0, w / 2], [0, 1321 * s, h / 2], [0, 0, 1]],
+        "D": [-0.1, 0, 0, 0],
+        "view_direction": "x",
+        "location": [0.5, 0, 1.3],
+        "horizon_points": [[w / 2, h / 2]],
+    }
+
+
+def legacy_rectify(camera: Camera, image):
+    map1, map2 = camera.maps
+    img = cv2.GaussianBlur(image, (3, 3), 0.5)
+    return cv2.remap(img, map1, map2, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT)
+
+
+def measure(fn, n):
+    fn()  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
+
+
+def load_frame(video, size):
+    if video is not None:
+        cap = cv2.VideoCapture(video)
+        ret, frame = cap.read()
+        cap.release()
+        if ret:
+            return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    # Smooth synthetic image when no video is given
+    w, h = size
+    x, y = np.meshgrid(np.linspace(0, 8 * np.pi, w), np.linspace(0, 6 * np.pi, h))
+    gray = (127 + 120 * np.sin(x) * np.cos(y)).astype(np.uint8)
+    return cv2.merge([gray, gray[:, ::-1], gray[::-1]])
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of image rectification")
+    parser.add_argument("-n", type=int, default=200, help="Iterations per measurement")
+    parser.add_argument("--video", type=str, default=None, help="Take the first frame from video")
+    args = parser.parse_args()
+
+    cases = [
+        ((1920, 1080), (1920, 1080)),
+        ((1920, 1080), (640, 360)),
+        ((1280, 720), (1280, 720)),
+        ((1280, 720), (400, 300)),
+    ]
+
+    print(f"{'image':>10} {'rectified':>10} {'decim':>5} {'legacy':>9} {'fixed':>9} {'fixed+dst':>9} {'no-aa':>9}")
+    for image_size, rectified_size in cases:
+        camera = Camera.from_dict(camera_dict(image_size, rectified_size))
+        no_aa = Rectifier.from_maps(*camera.maps, antialias=False)
+        image = load_frame(args.video, image_size)
+        dst = np.empty((rectified_size[1], rectified_size[0], 3), np.uint8)
+
+        t_legacy = measure(lambda: legacy_rectify(camera, image), args.n)
+        t_fixed = measure(lambda: camera.rectify_image(image), args.n)
+        t_dst = measure(lambda: camera.rectify_image(image, dst), args.n)
+        t_no_aa = measure(lambda: no_aa(image, dst), args.n)
+
+        print(
+            f"{'%dx%d' % image_size:>10} {'%dx%d' % rectified_size:>10} {camera.rectifier.decimation:>5} "
+            f"{t_legacy * 1e3:>7.2f}ms {t_fixed * 1e3:>7.2f}ms {t_dst * 1e3:>7.2f}ms {t_no_aa * 1e3:>7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
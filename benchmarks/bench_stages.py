@@ -0,0 +1,295 @@
+"""
+Benchmark of FCW processing stages with regression check
+
+Measures the stages of the FCW pipeline on pre-decoded frames of a video and on synthetic crowds of objects:
+detection (per model, device and input size), rectification, SORT update, reference points, collision guard
+update and labeling, results generation and serialization and visualization compose. Stages of the service
+(results, visualization) are skipped when its dependencies are missing, detection when torch is missing.
+
+Medians of stages can be stored as a baseline JSON, later runs are compared with the baseline and the benchmark
+fails (exit code 1) when a stage is slower than the baseline by more than the threshold. Runs are compared with
+the reference baseline bench_stages_baseline.json by default. Timings depend on the machine, so regenerate the
+baseline on the machine running the check (e.g. CI runner) before comparing:
+
+python3 bench_stages.py --save-baseline bench_stages_baseline.json
+python3 bench_stages.py [-n 100] [--objects 5 20 50] [--baseline other.json] [--threshold 0.2]
+"""
+from argparse import ArgumentParser
+import json
+import logging
+import platform
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+import yaml
+
+from fcw_core.sort import Sort
+from fcw_core_utils.collision import ForwardCollisionGuard, get_reference_points
+from fcw_core_utils.geometry import Camera
+
+# Reference baseline of the suite
+BASELINE = Path(__file__).with_name("bench_stages_baseline.json")
+
+
+class Stages:
+    """Measured stages, stage name -> durations [s] of iterations"""
+
+    def __init__(self, only: Optional[List[str]] = None):
+        self.only = only
+        self.durations: Dict[str, List[float]] = {}
+
+    def enabled(self, name: str) -> bool:
+        return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+    def measure(self, name: str, fn: Callable, n: int, warmup: int = 1):
+        """
+        Call fn n times (and warmup times before), fn gets the iteration index
+        """
+        if not self.enabled(name):
+            return
+        for i in range(warmup):
+            fn(i)
+        for i in range(n):
+            t0 = time.perf_counter()
+            fn(i)
+            self.record(name, time.perf_counter() - t0)
+        self.print(name)
+
+    def record(self, name: str, duration: float):
+        if self.enabled(name):
+            self.durations.setdefault(name, []).append(duration)
+
+    def print(self, name: str):
+        if name in self.durations:
+            d = self.durations[name]
+            print(f"{name:<40} {np.median(d) * 1e3:>9.3f} {np.percentile(d, 90) * 1e3:>9.3f}")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: dict(median_ms=float(np.median(d) * 1e3), p90_ms=float(np.percentile(d, 90) * 1e3))
+            for name, d in self.durations.items()
+        }
+
+
+def load_frames(video: str, n: int, size) -> List[np.ndarray]:
+    """
+    The first n frames of the video decoded in advance, synthetic frames when the video can not be read
+    """
+    frames = []
+    cap = cv2.VideoCapture(video)
+    while len(frames) < n:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        w, h = size
+        x, y = np.meshgrid(np.linspace(0, 8 * np.pi, w), np.linspace(0, 6 * np.pi, h))
+        for i in range(n):
+            gray = (127 + 120 * np.sin(x + i * 0.1) * np.cos(y)).astype(np.uint8)
+            frames.append(cv2.merge([gray, gray[:, ::-1], gray[::-1]]))
+    return frames
+
+
+def synthetic_crowd(objects: int, frames: int, size, seed: int = 0) -> List[np.ndarray]:
+    """
+    Detections (N,6) [x1,y1,x2,y2,score,label] of objects below horizon of rectified image slowly moving between
+    frames, objects closer to the camera are larger
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size
+    bottom = rng.uniform(0.55 * h, 0.95 * h, objects)
+    center = rng.uniform(0.05 * w, 0.95 * w, objects)
+    velocity = rng.normal(0, 0.5, (objects, 2))
+    labels = rng.choice([0, 2, 7], objects)
+    crowd = []
+    for i in range(frames):
+        y2 = np.clip(bottom + velocity[:, 1] * i, 0.52 * h, h - 1)
+        cx = np.clip(center + velocity[:, 0] * i, 0, w - 1)
+        box_h = (y2 - 0.5 * h) * 0.8 + 4
+        box_w = box_h * np.where(labels == 0, 0.4, 1.3)
+        crowd.append(
+            np.stack([cx - box_w / 2, y2 - box_h, cx + box_w / 2, y2, np.full(objects, 0.9), labels], axis=1)
+        )
+    return crowd
+
+
+def bench_detector(stages: Stages, frames, camera: Camera, models, sizes, devices, n):
+    try:
+        import torch
+        from fcw_core.yolo_detector import YOLODetector
+    except ImportError as ex:
+        print(f"Detection skipped: {repr(ex)}")
+        return
+    for model in models:
+        if not stages.enabled(f"detect/{model}"):
+            continue
+        detector = YOLODetector(model=model)
+        for device in devices:
+            if device == "cuda" and not torch.cuda.is_available():
+                continue
+            detector.model.to(device)
+            for size in sizes:
+                detector.max_size = size
+                # Image rectified directly to detector input size
+                input_size = detector.input_size(camera.rectified_size)
+                images = [camera.rectify_image(f, size=input_size) for f in frames]
+                scale = camera.rectified_scale(input_size)
+                stages.measure(
+                    f"detect/{model}/{device}/{size}",
+                    lambda i: detector.detect(images[i % len(images)], scale),
+                    n,
+                    warmup=3,
+                )
+        del detector
+
+
+def bench_results(stages: Stages, config, camera_config, guard, tracked, objects, n):
+    try:
+        from fcw_core_utils.results_codec import pack_message
+        from fcw_service.collision_worker import CollisionWorker
+    except ImportError as ex:
+        print(f"Results skipped: {repr(ex)}")
+        return
+    # Detector is used only for class names
+    names = {0: "person", 2: "car", 7: "truck"}
+    detector = SimpleNamespace(model=SimpleNamespace(names=names))
+    worker = CollisionWorker(None, None, config, camera_config, 30, detector=detector)
+    worker._guard = guard
+    metadata = dict(timestamp=0, recv_timestamp=0, timestamp_before_process=0, timestamp_after_process=0)
+    results = worker._generate_results(tracked, metadata)
+    stages.measure(f"results/generate/{objects}", lambda i: worker._generate_results(tracked, metadata), n)
+    stages.measure(f"results/json/{objects}", lambda i: json.dumps(pack_message(results, "json")), n)
+    stages.measure(f"results/binary/{objects}", lambda i: pack_message(results, "binary"), n)
+    return results
+
+
+def bench_viz(stages: Stages, config, camera_config, images, results, objects, n):
+    try:
+        from fcw_service.visualization import SessionRenderer
+    except ImportError as ex:
+        print(f"Visualization skipped: {repr(ex)}")
+        return
+    renderer = SessionRenderer("bench", "")
+    renderer._config = dict(config=config, camera_config=camera_config, is_rectified=True)
+    renderer._load_layers(renderer._config)
+    stages.measure(f"viz/compose/{objects}", lambda i: renderer._render(results, images[i % len(images)]), n)
+
+
+def compare(summary: Dict, baseline: Dict, threshold: float, min_delta: float) -> List[str]:
+    """
+    Stages slower than baseline by more than threshold (relative) and min_delta [ms]
+    """
+    regressions = []
+    print(f"{'stage':<40} {'baseline':>9} {'now':>9} {'change':>8}")
+    for name, stats in summary.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["median_ms"], stats["median_ms"]
+        change = now / before - 1 if before > 0 else 0
+        regressed = change > threshold and now - before > min_delta
+        print(f"{name:<40} {before:>9.3f} {now:>9.3f} {change * 100:>7.1f}%{' REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of FCW processing stages")
+    parser.add_argument("-n", type=int, default=100, help="Iterations per stage")
+    parser.add_argument("--video", type=str, default="../videos/video3.mp4", help="Video of pre-decoded frames")
+    parser.add_argument("--camera", type=str, default="../videos/video3.yaml", help="Camera config of the video")
+    parser.add_argument("--config", type=str, default="../config/config.yaml", help="FCW config")
+    parser.add_argument("--frames", type=int, default=30, help="Number of pre-decoded frames")
+    parser.add_argument("--objects", type=int, nargs="+", default=[5, 20, 50], help="Sizes of synthetic crowds")
+    parser.add_argument("--models", type=str, nargs="+", default=["yolov5n6"], help="Detector models")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[640, 1024], help="Detector input sizes")
+    parser.add_argument("--devices", type=str, nargs="+", default=["cpu", "cuda"], help="Detector devices")
+    parser.add_argument("--stages", type=str, nargs="+", default=None, help="Measure only stages with prefixes")
+    parser.add_argument("--output", type=str, default=None, help="Write results to JSON")
+    parser.add_argument("--save-baseline", type=str, default=None, help="Write results as baseline JSON")
+    parser.add_argument(
+        "--baseline", type=str, default=str(BASELINE), help="Compare with baseline JSON, empty to skip the comparison"
+    )
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown of stage median")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="Ignore slowdowns smaller than this [ms]")
+    args = parser.parse_args()
+    # Logging of tracked objects would be measured with the stages
+    logging.disable(logging.INFO)
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    with open(args.camera) as f:
+        camera_config = yaml.safe_load(f)
+    camera = Camera.from_dict(camera_config)
+    frames = load_frames(args.video, args.frames, camera.image_size)
+    rectified = [camera.rectify_image(f) for f in frames]
+
+    stages = Stages(args.stages)
+    print(f"{'stage':<40} {'median ms':>9} {'p90 ms':>9}")
+    bench_detector(stages, frames, camera, args.models, args.sizes, args.devices, args.n)
+    dst = np.empty_like(rectified[0])
+    stages.measure("rectify/new", lambda i: camera.rectify_image(frames[i % len(frames)]), args.n)
+    stages.measure("rectify/reuse", lambda i: camera.rectify_image(frames[i % len(frames)], dst), args.n)
+
+    for objects in args.objects:
+        crowd = synthetic_crowd(objects, args.n + 1, camera.rectified_size)
+        tracker = Sort.from_dict(config.get("tracker", {}))
+        tracker.dt = 1 / 30
+        guard = ForwardCollisionGuard.from_dict(config.get("fcw", {}))
+        guard.dt = 1 / 30
+        tracked = {}
+        # Stages of the pipeline run in sequence on frames of the crowd, their states evolve as in the service
+        names = [f"{stage}/{objects}" for stage in ("sort/update", "reference_points", "guard/update", "guard/label")]
+        for i in range(args.n + 1):
+            t0 = time.perf_counter()
+            tracker.update(crowd[i])
+            t1 = time.perf_counter()
+            tracked = {t.id: t for t in tracker.trackers if t.hit_streak > tracker.min_hits and t.time_since_update < 1}
+            ref_points = get_reference_points(tracked, camera, is_rectified=True)
+            t2 = time.perf_counter()
+            guard.update(ref_points)
+            t3 = time.perf_counter()
+            list(guard.label_objects())
+            t4 = time.perf_counter()
+            if i > 0:  # warm-up
+                for name, duration in zip(names, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                    stages.record(name, duration)
+        for name in names:
+            stages.print(name)
+
+        results = bench_results(stages, config, camera_config, guard, tracked, objects, args.n)
+        if results is not None:
+            bench_viz(stages, config, camera_config, rectified, results, objects, args.n)
+
+    summary = stages.summary()
+    report = dict(
+        platform=platform.platform(),
+        processor=platform.processor(),
+        python=platform.python_version(),
+        iterations=args.n,
+        stages=summary,
+    )
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    # New baseline is not compared
+    if args.baseline and args.save_baseline is None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+        regressions = compare(summary, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print(f"{len(regressions)} stages regressed by more than {args.threshold * 100:.0f}%: {regressions}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Benchmark of visualization transport codecs
+
+Publishes frames with results from VizPublisher to VizReceiver running in other process over local TCP for raw,
+JPEG and H.264 images. Reports bandwidth and CPU time per frame of the publisher (including the encoder thread) and
+of the receiver (including decoding).
+
+python3 bench_viz_transport.py [-n 150] [--fps 30] [--video ../videos/video3.mp4]
+"""
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+import time
+
+import cv2
+import numpy as np
+import zmq
+
+from fcw_service.viz_transport import CODECS, VizPublisher, VizReceiver
+
+ADDRESS = "tcp://127.0.0.1:5790"
+
+RESULTS = {
+    "timestamp": 1,
+    "dangerous_detections": {
+        i: {
+            "bbox": [10, 20, 30, 40],
+            "dangerous_distance": 0,
+            "age": 10,
+            "hit_streak": 5,
+            "class": 2,
+            "class_name": "car",
+        }
+        for i in range(5)
+    },
+    "objects": [
+        {
+            "id": i,
+            "distance": 5.0,
+            "location": (10.0, 1.0),
+            "path": [(10.0, 1.0)] * 50,
+            "is_in_danger_zone": False,
+            "crosses_danger_zone": True,
+            "time_to_collision": None,
+        }
+        for i in range(5)
+    ],
+}
+
+
+def load_frames(video, n):
+    frames = []
+    if video is not None:
+        cap = cv2.VideoCapture(video)
+        while len(frames) < n:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    if not frames:
+        # Moving synthetic pattern when no video is given
+        x, y = np.meshgrid(np.linspace(0, 8 * np.pi, 962), np.linspace(0, 6 * np.pi, 720))
+        for i in range(n):
+            gray = (127 + 120 * np.sin(x + i * 0.1) * np.cos(y)).astype(np.uint8)
+            frames.append(cv2.merge([gray, gray[:, ::-1], gray[::-1]]))
+    return frames
+
+
+def receive(n: int, output: Queue):
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    socket.setsockopt(zmq.RCVTIMEO, 2000)
+    socket.connect(ADDRESS)
+    receiver = VizReceiver(socket)
+    received = 0
+    t0 = None
+    while received < n:
+        try:
+            frame = receiver.recv()
+        except zmq.error.Again:
+            break
+        if frame is None:
+            if socket.poll(2000) == 0:
+                break
+            continue
+        if t0 is None:
+            t0 = time.process_time()
+        received += 1
+    output.put((received, time.process_time() - t0 if t0 is not None else 0))
+    socket.close()
+
+
+def measure(codec, frames, fps):
+    context = zmq.Context()
+    socket = context.socket(zmq.XPUB)
+    socket.bind(ADDRESS)
+    publisher = VizPublisher(socket, "bench", codec=codec)
+    publisher.set_config({"bench": True})
+
+    output = Queue()
+    receiver = Process(target=receive, args=(len(frames), output))
+    receiver.start()
+    while not publisher.ready():
+        time.sleep(0.01)
+
+    t0 = time.process_time()
+    for frame in frames:
+        # Frames are copied, the raw image must not change after sending
+        if publisher.ready():
+            publisher.publish(RESULTS, frame.copy())
+        time.sleep(1 / fps)
+    time.sleep(0.5)
+    cpu = time.process_time() - t0
+    publisher.close()
+
+    received, recv_cpu = output.get()
+    receiver.join()
+    socket.close(linger=0)
+    context.term()
+    return publisher, cpu, received, recv_cpu
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of visualization transport")
+    parser.add_argument("-n", type=int, default=150, help="Number of frames")
+    parser.add_argument("--fps", type=float, default=30, help="Frame rate")
+    parser.add_argument("--video", type=str, default=None, help="Take frames from video")
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.n)
+    h, w = frames[0].shape[:2]
+    # Copy of frames in the loop is included in publisher CPU time
+    t0 = time.process_time()
+    for frame in frames:
+        frame.copy()
+    copy_cpu = (time.process_time() - t0) / len(frames)
+
+    print(f"{len(frames)} frames {w}x{h} at {args.fps} FPS")
+    print(f"{'codec':>6} {'sent':>5} {'recv':>5} {'kB/frame':>9} {'Mbit/s':>8} {'pub ms':>8} {'recv ms':>8}")
+    for codec in CODECS:
+        publisher, cpu, received, recv_cpu = measure(codec, frames, args.fps)
+        per_frame = publisher.bytes / max(publisher.frames, 1)
+        print(
+            f"{codec:>6} {publisher.frames:>5} {received:>5} {per_frame / 1e3:>9.1f} "
+            f"{per_frame * 8 * args.fps / 1e6:>8.1f} {(cpu / len(frames) - copy_cpu) * 1e3:>8.2f} "
+            f"{recv_cpu / max(received, 1) * 1e3:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -72,7 +72,35 @@ def main() -> None:
     parser.add_argument("-m", "--measuring", type=bool, help="Enable extended measuring logs", default=True)
     parser.add_argument("--viz", type=bool, help="Whether to enable remote visualization", default=True)
     parser.add_argument("--viz_zmq_port", type=int, help="Port of the ZMQ visualization server", default=5558)
+    parser.add_argument("--viz_fps", type=float, help="Maximal visualization frame rate", default=None)
+    parser.add_argument(
+        "--viz_max_size", type=int, help="Visualization images are downscaled to fit this size", default=None
+    )
+    parser.add_argument(
+        "--viz_codec", type=str, choices=["raw", "jpeg", "h264"], help="Visualization image encoding", default="raw"
+    )
+    parser.add_argument(
+        "--results_profile",
+        type=str,
+        choices=["alerts-only", "objects", "full"],
+        help="Content of results",
+        default="full",
+    )
+    parser.add_argument(
+        "--results_encoding", type=str, choices=["json", "binary"], help="Results encoding", default="json"
+    )
+    parser.add_argument(
+        "--results_keyframe_interval",
+        type=int,
+        help="Delta-encoded results with full state every N frames, 0 disables delta encoding",
+        default=0,
+    )
+    parser.add_argument(
+        "--max_frame_age", type=float, help="Frames older than this [s] are dropped by the service", default=None
+    )
     parser.add_argument("--stats", type=bool, help="Store output data sizes", default=True)
+    parser.add_argument("--raw", action="store_true", help="Send distorted images, the service skips rectification")
+    parser.add_argument("--sync_send", action="store_true", help="Rectify, encode and send images in the capture loop")
     args = parser.parse_args()
 
     global collision_warning_client
@@ -110,9 +138,18 @@ def main() -> None:
             fps=fps,
             viz=args.viz,
             viz_zmq_port=args.viz_zmq_port,
+            viz_fps=args.viz_fps,
+            viz_max_size=args.viz_max_size,
+            viz_codec=args.viz_codec,
+            results_profile=args.results_profile,
+            results_encoding=args.results_encoding,
+            results_keyframe_interval=args.results_keyframe_interval,
+            max_frame_age=args.max_frame_age,
             stream_type=StreamType(args.stream_type),
             stats=args.stats,
             extended_measuring=args.measuring,
+            rectify=not args.raw,
+            async_send=not args.sync_send,
         )
 
         # Rate timer for control the speed of a loop (fps).
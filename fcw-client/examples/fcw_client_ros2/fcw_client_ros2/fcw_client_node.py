@@ -61,8 +61,9 @@ def main(args=None) -> None:
     global collision_warning_client, publisher
 
     publisher = node.create_publisher(String, "/results", 10)
+    # Images are sent by a background thread, the subscription callback only queues them.
     collision_warning_client = CollisionWarningClient(
-        config=config, camera_config=camera_config, fps=30, results_callback=results_callback
+        config=config, camera_config=camera_config, fps=30, results_callback=results_callback, async_send=True
     )
     subscriber = node.create_subscription(Image, "/image", send_image_callback, 10)
 
@@ -3,11 +3,14 @@ from __future__ import annotations
 import logging
 import os
 import statistics
+import threading
 import time
+from collections import deque
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import Any, Callable, Dict, Optional, Union
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import numpy as np
 import yaml
@@ -16,9 +19,13 @@ from era_5g_client.client import NetAppClient
 from era_5g_client.client_base import NetAppClientBase
 from era_5g_client.dataclasses import MiddlewareInfo
 from era_5g_interface.channels import CallbackInfoClient, ChannelType
+from era_5g_interface.dataclasses.control_command import ControlCmdType, ControlCommand
+from era_5g_interface.exceptions import BackPressureException
 from era_5g_interface.interface_helpers import HEARTBEAT_CLIENT_EVENT
 from era_5g_interface.measuring import Measuring
-from fcw_core_utils.geometry import Camera
+from fcw_core_utils.geometry import Camera, fit_size
+from fcw_core_utils.results_codec import unpack_message
+from fcw_core_utils.results_delta import DeltaDecoder
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +53,9 @@ class ResultsReader:
         self.delays_recv = []
         self.delays_send = []
         self.delays_process = []
+        # Frames dropped by the service and ages of frames received by the service.
+        self.service_dropped_frames = 0
+        self.service_frame_ages: Dict[str, int] = dict()
         self.timestamps = [
             [
                 "start_timestamp_ns",
@@ -80,6 +90,10 @@ class ResultsReader:
             logger.warning(f"No results data received")
         else:
             logger.info(f"Send frames: {send_frames_count}, dropped frames: {send_frames_count - len(self.delays)}")
+            logger.info(
+                f"Frames dropped by service: {self.service_dropped_frames}, "
+                f"frame age histogram [ms]: {self.service_frame_ages}"
+            )
             logger.info(
                 f"Delay median:                 {statistics.median(self.delays) * 1.0e-9:.3f}s "
                 f"mean: {statistics.mean(self.delays) * 1.0e-9:.3f}s "
@@ -123,6 +137,8 @@ class ResultsReader:
                         logger.info(f"Dangerous distance {score:.2f}m to the object with id {tracked_id}")
         if "objects" in results:
             logger.info(f"objects {results['objects']}")
+        self.service_dropped_frames = results.get("dropped_frames", self.service_dropped_frames)
+        self.service_frame_ages = results.get("frame_age_histogram", self.service_frame_ages)
 
         # Process timestamps.
         if "timestamp" in results:
@@ -174,6 +190,34 @@ class ResultsReader:
             )
 
 
+class SendStats:
+    """Statistics of the asynchronous send pipeline of CollisionWarningClient."""
+
+    # Number of recent frames of the timing statistics.
+    WINDOW = 1000
+
+    def __init__(self) -> None:
+        self.queued = 0
+        self.sent = 0
+        # Frames replaced in the full queue by newer frames.
+        self.dropped = 0
+        # Frames not sent because of back pressure or errors.
+        self.failed = 0
+        # Time in queue and rectify + encode + send time of recent frames [ns].
+        self.queue_wait = deque(maxlen=SendStats.WINDOW)
+        self.send_time = deque(maxlen=SendStats.WINDOW)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Counts of frames and median and maximum of timings [ms] of recent frames."""
+
+        stats: Dict[str, Any] = dict(queued=self.queued, sent=self.sent, dropped=self.dropped, failed=self.failed)
+        for name, values in (("queue_wait", list(self.queue_wait)), ("send_time", list(self.send_time))):
+            if values:
+                stats[f"{name}_median_ms"] = statistics.median(values) * 1.0e-6
+                stats[f"{name}_max_ms"] = max(values) * 1.0e-6
+        return stats
+
+
 class StreamType(Enum):
     """Class for stream types."""
 
@@ -203,10 +247,21 @@ class CollisionWarningClient:
         fps: float = 30,
         viz: bool = True,
         viz_zmq_port: int = 5558,
+        viz_fps: Optional[float] = None,
+        viz_max_size: Optional[int] = None,
+        viz_codec: str = "raw",
+        results_profile: str = "full",
+        results_encoding: str = "json",
+        results_keyframe_interval: int = 0,
+        max_frame_age: Optional[float] = None,
         results_callback: Optional[Callable] = None,
         stream_type: Optional[StreamType] = StreamType.H264,
         stats: bool = False,
         extended_measuring: bool = False,
+        rectify: bool = True,
+        client_factory: Optional[Callable[..., NetAppClientBase]] = None,
+        async_send: bool = False,
+        send_queue_size: int = 1,
     ) -> None:
         """Constructor.
 
@@ -219,10 +274,30 @@ class CollisionWarningClient:
             fps (float): Video FPS. Default to 30.
             viz (bool): Whether to enable visualization. Default to True.
             viz_zmq_port (int): Port of the ZMQ server. Default to 5558.
+            viz_fps (float, optional): Maximal visualization frame rate. Default to unlimited.
+            viz_max_size (int, optional): Visualization images are downscaled to fit this size. Default to no scaling.
+            viz_codec (str): Visualization image encoding raw, jpeg or h264 (for remote viewers). Default to raw.
+            results_profile (str): Content of results alerts-only, objects (without paths) or full. Default to full.
+            results_encoding (str): Results encoding json or compact binary. Results are always passed to
+                results_callback as dict. Default to json.
+            results_keyframe_interval (int): Receive delta-encoded results with full state every
+                results_keyframe_interval frames, full results are reconstructed before passing them to
+                results_callback. JSON encoding only. Default to 0 (disabled).
+            max_frame_age (float, optional): Maximal age of frame [s] in the service, older frames are dropped before
+                detection. 0 disables dropping of old frames. Default to the service setting.
             results_callback (Callable, optional): Callback for receiving results. Default to ResultsReader.get_results.
             stream_type (StreamType, optional): Stream type JPEG or H264 or HEVC. Default to H264.
             stats (bool): Store output data sizes.
             extended_measuring (bool): Enable logging of measuring.
+            rectify (bool): Rectify images before sending. If False, raw (distorted) images are sent and the service
+                processes them without full-frame rectification. Default to True.
+            client_factory (Callable[..., NetAppClientBase], optional): Creates the client of the FCW service with
+                NetAppClientBase arguments, e.g. in-process transport of load tests (fcw_service.local_transport).
+                The heartbeat module is not used with custom clients. Default to NetAppClientBase.
+            async_send (bool): Rectify, encode and send images on a background thread, send_image only queues the
+                frame and returns immediately. The frame must not be modified after send_image. If the queue is full,
+                the oldest queued frame is dropped (latest frame wins), see send_stats. Default to False.
+            send_queue_size (int): Frames waiting for the background thread. Default to 1.
         """
 
         logger.info("Loading configuration file {cfg}".format(cfg=config))
@@ -231,6 +306,10 @@ class CollisionWarningClient:
         self.camera_config_dict = yaml.safe_load(camera_config.open())
         logger.info("Initializing camera calibration")
         self.camera = Camera.from_dict(self.camera_config_dict)
+        # Frames are rectified directly to detector input size (default max_size of YOLODetector.from_dict),
+        # the service rescales detections to rectified_size.
+        max_size = self.config_dict.get("detector", {}).get("max_size", 1024)
+        self.input_size = fit_size(self.camera.rectified_size, max_size)
 
         self.fps = fps
         # Check bad loaded FPS.
@@ -241,35 +320,68 @@ class CollisionWarningClient:
         if self.results_callback is None:
             self.results_viewer = ResultsReader(extended_measuring=extended_measuring)
             self.results_callback = self.results_viewer.get_results
+        # Reconstruction of delta-encoded results.
+        self._delta_decoder = DeltaDecoder()
         self.stream_type = stream_type
+        self.rectify = rectify
         self.frame_id = 0
+        # Rectified frame buffer reused between frames, encoders copy the frame during send.
+        self._frame_undistorted: Optional[np.ndarray] = None
+        # Asynchronous send pipeline, items are (frame, timestamp, queued time), None stops the thread.
+        self._send_stats = SendStats()
+        self._send_queue: Optional[Queue] = None
+        self._send_thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        if async_send:
+            self._send_queue = Queue(send_queue_size)
+            self._send_thread = threading.Thread(target=self._send_loop, name="FCW client send", daemon=True)
+
+        if client_factory is None:
+            # Test heartbeat module
+            self.heartbeat_client = NetAppClientBase(
+                {},
+                logging_level=logging.getLogger().level,
+                stats=stats,
+                extended_measuring=False,
+            )
 
-        # Test heartbeat module
-        self.heartbeat_client = NetAppClientBase(
-            {},
-            logging_level=logging.getLogger().level,
-            stats=stats,
-            extended_measuring=False,
-        )
-
-        logger.info(f"Register heartbeat client: {HEARTBEAT_ADDRESS}")
-        # Register heartbeat client.
-        try:
-            self.heartbeat_client.register(HEARTBEAT_ADDRESS)
-            logger.info(f"Heartbeat client registered")
+            logger.info(f"Register heartbeat client: {HEARTBEAT_ADDRESS}")
+            # Register heartbeat client.
+            try:
+                self.heartbeat_client.register(HEARTBEAT_ADDRESS)
+                logger.info(f"Heartbeat client registered")
 
-            logger.info(
-                self.heartbeat_client.send_data("GET_BEST_MIDDLEWARE_ADDRESS", HEARTBEAT_CLIENT_EVENT, blocking=True)
-            )
-        except Exception as ex:
-            self.heartbeat_client.disconnect()
-            logger.warning(f"Cannot connect to heartbeat module")
-            # raise ex
+                logger.info(
+                    self.heartbeat_client.send_data(
+                        "GET_BEST_MIDDLEWARE_ADDRESS", HEARTBEAT_CLIENT_EVENT, blocking=True
+                    )
+                )
+            except Exception as ex:
+                self.heartbeat_client.disconnect()
+                logger.warning(f"Cannot connect to heartbeat module")
+                # raise ex
+
+        # Arguments of the initialization command.
+        init_args = {
+            "config": self.config_dict,
+            "camera_config": self.camera_config_dict,
+            "fps": self.fps,
+            "viz": viz,
+            "viz_zmq_port": viz_zmq_port,
+            "viz_fps": viz_fps,
+            "viz_max_size": viz_max_size,
+            "viz_codec": viz_codec,
+            "results_profile": results_profile,
+            "results_encoding": results_encoding,
+            "results_keyframe_interval": results_keyframe_interval,
+            "max_frame_age": max_frame_age,
+            "is_rectified": rectify,
+        }
 
         # Create FCW client.
         if isinstance(netapp_info, MiddlewareAllInfo):
             self.client = NetAppClient(
-                {"results": CallbackInfoClient(ChannelType.JSON, self.results_callback)},
+                {"results": CallbackInfoClient(ChannelType.JSON, self._results_callback)},
                 logging_level=logging.getLogger().level,
                 stats=stats,
                 extended_measuring=extended_measuring,
@@ -282,21 +394,15 @@ class CollisionWarningClient:
                     task_id=netapp_info.task_id,
                     robot_id=netapp_info.robot_id,
                     resource_lock=False,
-                    args={
-                        "config": self.config_dict,
-                        "camera_config": self.camera_config_dict,
-                        "fps": self.fps,
-                        "viz": viz,
-                        "viz_zmq_port": viz_zmq_port,
-                    },
+                    args=init_args,
                 )
             except Exception as ex:
                 self.client.disconnect()
                 raise ex
             logger.info(f"Client registered")
         else:
-            self.client = NetAppClientBase(
-                {"results": CallbackInfoClient(ChannelType.JSON, self.results_callback)},
+            self.client = (client_factory or NetAppClientBase)(
+                {"results": CallbackInfoClient(ChannelType.JSON, self._results_callback)},
                 logging_level=logging.getLogger().level,
                 stats=stats,
                 extended_measuring=extended_measuring,
@@ -306,24 +412,38 @@ class CollisionWarningClient:
             try:
                 self.client.register(
                     netapp_info,
-                    args={
-                        "config": self.config_dict,
-                        "camera_config": self.camera_config_dict,
-                        "fps": self.fps,
-                        "viz": viz,
-                        "viz_zmq_port": viz_zmq_port,
-                    },
+                    args=init_args,
                 )
             except Exception as ex:
                 self.client.disconnect()
                 raise ex
             logger.info(f"Client registered")
 
+        if self._send_thread is not None:
+            self._send_thread.start()
+
+    def _results_callback(self, message: Dict[str, Any]) -> None:
+        """Decode results message and pass results to results callback.
+
+        Args:
+            message (Dict[str, Any]): Results message in JSON, binary or delta encoding.
+        """
+
+        if "delta" in message:
+            results = self._delta_decoder.decode(message)
+            if results is None:
+                # Waiting for keyframe
+                return
+        else:
+            results = unpack_message(message)
+        self.results_callback(results)
+
     def info_callback(self, data: Dict[str, Any]) -> None:
         logger.info(data)
 
     def send_image(self, frame: np.ndarray, timestamp: Optional[int] = None) -> None:
-        """Send image to FCW service including rectification.
+        """Send image to FCW service including rectification (if enabled). With asynchronous sending, the frame is
+        only queued for the send thread.
 
         Args:
             frame (np.ndarray): Image in numpy array format ("bgr24").
@@ -333,21 +453,116 @@ class CollisionWarningClient:
 
         if self.client is not None:
             self.frame_id += 1
-            frame_undistorted = self.camera.rectify_image(frame)
             if not timestamp:
                 timestamp = time.perf_counter_ns()
-            if self.stream_type is StreamType.H264:
-                self.client.send_image(frame_undistorted, "image_h264", ChannelType.H264, timestamp)
-            elif self.stream_type is StreamType.HEVC:
-                self.client.send_image(frame_undistorted, "image_hevc", ChannelType.HEVC, timestamp)
-            elif self.stream_type is StreamType.JPEG:
-                self.client.send_image(frame_undistorted, "image_jpeg", ChannelType.JPEG, timestamp)
+            if self._send_queue is None:
+                self._send_frame(frame, timestamp)
+                return
+            with self._stats_lock:
+                self._send_stats.queued += 1
+            item = (frame, timestamp, time.perf_counter_ns())
+            while True:
+                try:
+                    self._send_queue.put_nowait(item)
+                    return
+                except Full:
+                    # The oldest frame is replaced, the latest frame wins.
+                    try:
+                        self._send_queue.get_nowait()
+                        with self._stats_lock:
+                            self._send_stats.dropped += 1
+                    except Empty:
+                        pass
+
+    def send_stats(self) -> Dict[str, Any]:
+        """Statistics of asynchronous sending - counts of queued, sent, dropped and failed frames, median and maximum
+        of queue wait and send time [ms] of recent frames, and the current queue occupancy.
+
+        Returns:
+            Dictionary of statistics.
+        """
+
+        with self._stats_lock:
+            stats = self._send_stats.as_dict()
+        stats["queue_occupancy"] = self._send_queue.qsize() if self._send_queue is not None else 0
+        return stats
+
+    def _send_loop(self) -> None:
+        """Send thread of asynchronous sending."""
+
+        while True:
+            item = self._send_queue.get()
+            if item is None:
+                break
+            frame, timestamp, queued = item
+            t0 = time.perf_counter_ns()
+            try:
+                self._send_frame(frame, timestamp)
+                sent = True
+            except BackPressureException as ex:
+                logger.debug(f"BackPressureException raised while sending: {ex}")
+                sent = False
+            except Exception as ex:
+                logger.error(f"Failed to send image: {repr(ex)}")
+                sent = False
+            with self._stats_lock:
+                if sent:
+                    self._send_stats.sent += 1
+                else:
+                    self._send_stats.failed += 1
+                self._send_stats.queue_wait.append(t0 - queued)
+                self._send_stats.send_time.append(time.perf_counter_ns() - t0)
+
+    def _send_frame(self, frame: np.ndarray, timestamp: int) -> None:
+        """Rectify (if enabled), encode and send frame.
+
+        Args:
+            frame (np.ndarray): Image in numpy array format ("bgr24").
+            timestamp (int): Timestamp for frame and results synchronization.
+        """
+
+        if self.rectify:
+            frame_undistorted = self.camera.rectify_image(frame, self._frame_undistorted, size=self.input_size)
+            self._frame_undistorted = frame_undistorted
+        else:
+            frame_undistorted = frame
+        if self.stream_type is StreamType.H264:
+            self.client.send_image(frame_undistorted, "image_h264", ChannelType.H264, timestamp)
+        elif self.stream_type is StreamType.HEVC:
+            self.client.send_image(frame_undistorted, "image_hevc", ChannelType.HEVC, timestamp)
+        elif self.stream_type is StreamType.JPEG:
+            self.client.send_image(frame_undistorted, "image_jpeg", ChannelType.JPEG, timestamp)
+
+    def profile_service(self, duration: float) -> Tuple[bool, str]:
+        """Run sampling profiler of this session in FCW service, profile is written on the service side.
+
+        Args:
+            duration (float): Profiling duration [s].
+
+        Returns:
+            (started (bool), message (str)): Service response.
+        """
+
+        return self.client.send_control_command(ControlCommand(ControlCmdType.SET_STATE, data={"profile": duration}))
 
     def stop(self) -> None:
         """Print stats and disconnect from FCW service."""
 
         logger.info("Collision warning client stopping")
 
+        if self._send_thread is not None and self._send_thread.is_alive():
+            # Queued frames are dropped, the thread finishes the frame being sent.
+            while True:
+                try:
+                    self._send_queue.get_nowait()
+                    with self._stats_lock:
+                        self._send_stats.dropped += 1
+                except Empty:
+                    break
+            self._send_queue.put(None)
+            self._send_thread.join()
+            logger.info(f"Send stats: {self.send_stats()}")
+
         if hasattr(self, "results_viewer") and self.results_viewer is not None:
             self.results_viewer.stats(self.frame_id)
         if self.client is not None:
@@ -0,0 +1,201 @@
+"""
+Content-addressed cache of camera calibration artifacts
+
+Camera setup (estimation of K_new, remap tables, ground plane lookup, horizon and rotation) is done
+for every session, client and visualization. The artifacts are stored on disk under a hash of the
+camera dict, so repeated setup only maps the files. Rectifiers to other output sizes (detector input
+size) are stored under the hash and the size. Large tables are memory-mapped read-only and shared
+between processes through the page cache. Cameras with identical calibration are shared within the
+process and must be treated as read-only.
+
+The cache directory is set by FCW_CACHE_DIR environment variable (default ~/.cache/fcw/camera),
+an empty value disables the disk cache.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from shapely.geometry import LineString
+
+from fcw_core_utils.geometry import Camera, Rectifier
+
+logger = logging.getLogger(__name__)
+
+# Bump when the stored artifacts or their computation change
+CACHE_VERSION = 1
+
+_cameras: "weakref.WeakValueDictionary[str, Camera]" = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def cache_dir() -> Optional[Path]:
+    path = os.getenv("FCW_CACHE_DIR", str(Path.home() / ".cache" / "fcw" / "camera"))
+    return Path(path) if path else None
+
+
+def _to_json(o):
+    # Numpy arrays and scalars, array.array from ROS parameters
+    return o.tolist() if hasattr(o, "tolist") else str(o)
+
+
+def camera_key(d: Dict) -> str:
+    """
+    Hash of the camera dict, independent of key order
+    """
+    data = json.dumps(d, sort_keys=True, default=_to_json)
+    return hashlib.sha256(f"{CACHE_VERSION}:{data}".encode()).hexdigest()[:32]
+
+
+def _save_maps(path: Path, rectifier: Rectifier) -> None:
+    np.save(path / "map1.npy", rectifier.map1)
+    # No interpolation table with nearest neighbour interpolation
+    if rectifier.map2 is not None:
+        np.save(path / "map2.npy", rectifier.map2)
+
+
+def _load_maps(path: Path) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    map1 = np.load(path / "map1.npy", mmap_mode="r")
+    map2 = np.load(path / "map2.npy", mmap_mode="r") if (path / "map2.npy").exists() else None
+    return map1, map2
+
+
+def store(path: Path, camera: Camera) -> None:
+    """
+    Store camera artifacts to directory `path`, atomically
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=".tmp-", dir=path.parent))
+    try:
+        rectifier = camera.rectifier
+        _save_maps(tmp, rectifier)
+        np.save(tmp / "ground_map.npy", camera.ground_map)
+        np.savez(
+            tmp / "camera.npz",
+            K=camera.K,
+            D=camera.D,
+            K_new=camera.K_new,
+            RT=camera.RT,
+            RT_inv=camera.RT_inv,
+            horizon=np.array(camera.horizon.coords),
+        )
+        meta = {
+            "image_size": list(map(int, camera.image_size)),
+            "rectified_size": list(map(int, camera.rectified_size)),
+            "decimation": rectifier.decimation,
+            "interpolation": rectifier.interpolation,
+            "ground_map_step": camera.ground_map_step,
+        }
+        (tmp / "camera.json").write_text(json.dumps(meta))
+        # Fails when other process stored the same key meanwhile, which is fine
+        os.rename(tmp, path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load(path: Path) -> Camera:
+    """
+    Load camera stored by `store`, tables are memory-mapped read-only
+    """
+    meta = json.loads((path / "camera.json").read_text())
+    with np.load(path / "camera.npz") as arrays:
+        arrays = dict(arrays)
+    rectifier = Rectifier(*_load_maps(path), meta["decimation"], meta["interpolation"])
+    camera = Camera(
+        meta["image_size"],
+        meta["rectified_size"],
+        arrays["K"],
+        arrays["D"],
+        K_new=arrays["K_new"],
+        rectifier=rectifier,
+    )
+    camera.RT = arrays["RT"]
+    camera.RT_inv = arrays["RT_inv"]
+    camera.horizon = LineString(arrays["horizon"])
+    camera.ground_map = np.load(path / "ground_map.npy", mmap_mode="r")
+    camera.ground_map_step = meta["ground_map_step"]
+    return camera
+
+
+def store_rectifier(path: Path, rectifier: Rectifier) -> None:
+    """
+    Store rectifier to directory `path`, atomically
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=".tmp-", dir=path.parent))
+    try:
+        _save_maps(tmp, rectifier)
+        meta = {"decimation": rectifier.decimation, "interpolation": rectifier.interpolation}
+        (tmp / "rectifier.json").write_text(json.dumps(meta))
+        os.rename(tmp, path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_rectifier(path: Path) -> Rectifier:
+    """
+    Load rectifier stored by `store_rectifier`, maps are memory-mapped read-only
+    """
+    meta = json.loads((path / "rectifier.json").read_text())
+    return Rectifier(*_load_maps(path), meta["decimation"], meta["interpolation"])
+
+
+def cached_rectifier(key: str, size: Tuple[int, int], build: Callable[[], Rectifier]) -> Rectifier:
+    """
+    Rectifier of camera `key` to output size (w,h) from disk, built by `build` and stored when missing
+    """
+    root = cache_dir()
+    if root is None:
+        return build()
+    path = root / f"{key}-rectifier-{size[0]}x{size[1]}"
+    if (path / "rectifier.json").exists():
+        try:
+            return load_rectifier(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Broken rectifier cache {path}, rebuilding: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+    rectifier = build()
+    try:
+        store_rectifier(path, rectifier)
+    except OSError as e:
+        logger.warning(f"Cannot store rectifier cache {path}: {e}")
+    return rectifier
+
+
+def _load_or_calibrate(key: str, d: Dict) -> Camera:
+    root = cache_dir()
+    if root is None:
+        return Camera.calibrate(d)
+    path = root / key
+    if (path / "camera.json").exists():
+        try:
+            return load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Broken calibration cache {path}, recalibrating: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+    camera = Camera.calibrate(d)
+    try:
+        store(path, camera)
+    except OSError as e:
+        logger.warning(f"Cannot store calibration cache {path}: {e}")
+    return camera
+
+
+def cached_camera(d: Dict) -> Camera:
+    """
+    Camera for calibration dict, shared within the process and cached on disk
+    """
+    key = camera_key(d)
+    with _lock:
+        camera = _cameras.get(key)
+        if camera is None:
+            camera = _cameras[key] = _load_or_calibrate(key, d)
+            camera.cache_key = key
+    return camera
@@ -64,9 +64,26 @@ class PointWorldObject:
         self.xy = None
         self.vxvy = None
 
+    def set_dt(self, dt: float):
+        """
+        Change time step between updates, the state (velocity in m/s) is kept
+        """
+        self.kf.F = F_matrix(dt)
+        self.kf.Q = Q_discrete_white_noise(dim=3, dt=dt, var=0.5e-1**2, block_size=2)
+
     def update(self, location=None):
         self.kf.predict()
         self.kf.update(location, R=covariance(location, sigma=0.1, scale=0.1))
+        self._update_state()
+
+    def predict(self):
+        """
+        Move the object by its motion model without observation
+        """
+        self.kf.predict()
+        self._update_state()
+
+    def _update_state(self):
         self.xy = np.dot(self.kf.H, self.kf.x).T[0]
         self.vxvy = np.dot(np.array([[0, 1, 0, 0, 0, 0], [0, 0, 0, 0, 1, 0]]), self.kf.x).T[0]
 
@@ -116,24 +133,13 @@ def get_reference_points(trackers: Dict, camera: Camera, *, is_rectified: bool):
     img_rp = R @ bb  # (2,N) 2D ref points in distorted image
 
     if not is_rectified:
-        # If trackers are used on non-rectified image
-        img_rp = camera.rectify_points(img_rp.T).T
-
-    # points are in cam.K_new camera - normalize and convert to (3,N)
-    n = img_rp.shape[1]
-    img_rp_h = np.vstack([img_rp, np.ones((1, n))])
-    norm_rp = inv(camera.K_new) @ img_rp_h  # (3,N) normalized xyz in camera space
-
-    norm_rp = np.vstack([norm_rp, np.ones((1, n))])  # (4,N) homogeneous in 3D
+        # If trackers are used on non-rectified image, look up the ground points directly
+        world_rp = camera.distorted_to_ground(img_rp.T)
+    else:
+        # points are in cam.K_new camera
+        world_rp = camera.rectified_to_ground(img_rp.T)
 
-    X = camera.RT_inv @ norm_rp  # (3,N)
-    O = camera.RT_inv[:, -1].reshape(3, -1)
-    S = X - O
-    plane_normal = np.atleast_2d([0, 0, 1])
-    t = (plane_normal @ O[:3]) / (plane_normal @ S[:3])
-    world_rp = O - t * S
-
-    return dict(zip(trackers.keys(), world_rp.T))  # tid -> (x,y,z)
+    return dict(zip(trackers.keys(), world_rp))  # tid -> (x,y,z)
 
 
 class ForwardCollisionGuard:
@@ -146,14 +152,27 @@ class ForwardCollisionGuard:
         prediction_step: float = 0.1,
         dt: float = 1,
     ):
-        self.dt = dt
         self.objects: Dict[int, PointWorldObject] = dict()
+        self.dt = dt
         self.danger_zone = danger_zone
         self.vehicle_zone = vehicle_zone
         self.safety_radius = safety_radius  # m
         self.prediction_length = prediction_length
         self.prediction_step = prediction_step
 
+    @property
+    def dt(self) -> float:
+        return self._dt
+
+    @dt.setter
+    def dt(self, dt: float):
+        """
+        Time step between updates, motion models of tracked objects are switched too
+        """
+        self._dt = dt
+        for obj in self.objects.values():
+            obj.set_dt(dt)
+
     @staticmethod
     def from_dict(d):
         if type(d.get("danger_zone")) == dict:
@@ -174,6 +193,8 @@ class ForwardCollisionGuard:
     def update(self, ref_points: Dict):
         """
         Update state of objects tracked in world space
+
+        ref_points : tid -> (x,y,z), None keeps the object without observation (it is only predicted)
         """
         # Sync world trackers with image trackers
         for tid in list(self.objects.keys()):
@@ -182,7 +203,10 @@ class ForwardCollisionGuard:
                 logger.info(f"Tracking object with id {tid} lost")
 
         for tid in ref_points.keys():
-            if tid not in self.objects:
+            if ref_points[tid] is None:
+                if tid in self.objects:
+                    self.objects[tid].predict()
+            elif tid not in self.objects:
                 logger.info("Tracking object with id {tid}".format(tid=tid))
                 self.objects[tid] = PointWorldObject(ref_points[tid], self.dt)
             else:
@@ -0,0 +1,85 @@
+"""
+Columnar storage of per-frame results
+
+Rows of tables are buffered and written in chunks, each chunk is an .npz file with one array per column
+(<directory>/<table>-<chunk>.npz). Column types are given by a schema, so the files are compact and load without
+parsing. Chunks are written under a temporary name and renamed, written chunks are always complete.
+"""
+import os
+from glob import glob
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+# Table -> column -> dtype
+Schema = Dict[str, Dict[str, np.dtype]]
+
+
+class ColumnarWriter:
+    def __init__(self, path: str, schema: Schema, chunk_rows: int = 65536):
+        """
+        path : output directory, created if it does not exist
+        schema : column types of tables
+        chunk_rows : rows of a table buffered before its chunk is written
+        """
+        self.path = path
+        self.schema = schema
+        self.chunk_rows = chunk_rows
+        self.chunks = {table: 0 for table in schema}
+        self._buffers: Dict[str, Dict[str, List]] = {table: self._empty(table) for table in schema}
+        os.makedirs(path, exist_ok=True)
+
+    def _empty(self, table: str) -> Dict[str, List]:
+        return {column: [] for column in self.schema[table]}
+
+    def append(self, table: str, **row):
+        """
+        Add one row, all columns of the table must be given
+        """
+        buffer = self._buffers[table]
+        for column, values in buffer.items():
+            values.append(row[column])
+        if len(next(iter(buffer.values()))) >= self.chunk_rows:
+            self.flush(table)
+
+    def extend(self, table: str, **columns: Iterable):
+        """
+        Add rows given by columns of equal length
+        """
+        buffer = self._buffers[table]
+        for column, values in buffer.items():
+            values.extend(columns[column])
+        if len(next(iter(buffer.values()))) >= self.chunk_rows:
+            self.flush(table)
+
+    def flush(self, table: str = None):
+        """
+        Write buffered rows of the table (of all tables when None)
+        """
+        for name in [table] if table is not None else list(self.schema):
+            buffer = self._buffers[name]
+            if not next(iter(buffer.values())):
+                continue
+            arrays = {column: np.asarray(values, dtype=self.schema[name][column]) for column, values in buffer.items()}
+            filename = os.path.join(self.path, f"{name}-{self.chunks[name]:05d}.npz")
+            with open(filename + ".tmp", "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(filename + ".tmp", filename)
+            self.chunks[name] += 1
+            self._buffers[name] = self._empty(name)
+
+    def close(self):
+        self.flush()
+
+
+def read_table(path: str, table: str) -> Dict[str, np.ndarray]:
+    """
+    Columns of the table from all its chunks, empty dict if there are no chunks
+    """
+    chunks = []
+    for filename in sorted(glob(os.path.join(path, f"{table}-*.npz"))):
+        with np.load(filename) as chunk:
+            chunks.append({column: chunk[column] for column in chunk.files})
+    if not chunks:
+        return {}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in chunks[0]}
@@ -1,4 +1,5 @@
-from typing import Dict
+import threading
+from typing import Dict, Optional
 
 import cv2
 import numpy as np
@@ -42,10 +43,123 @@ def line_segment(l, x0, x1):
     return x1, y1, x2, y2
 
 
+def fit_size(size, max_size: int):
+    """
+    Size (w,h) downscaled so the longer side does not exceed max_size
+    """
+    w, h = size
+    if max(w, h) <= max_size:
+        return int(w), int(h)
+    scale = max(w, h) / max_size  # shape (1080, 1920), max_size=960 -> scale=1920/960 = 2
+    return int(w // scale), int(h // scale)
+
+
+def decimation_factor(map_x: np.ndarray, map_y: np.ndarray) -> int:
+    """
+    Power of two by which the source can be decimated before remap without loss of detail
+
+    The factor is estimated from the median step of the maps, i.e. how many source pixels
+    fall on one output pixel. Powers of two keep INTER_AREA decimation on its fast path.
+    """
+    sx = np.median(np.abs(np.diff(map_x, axis=1)))
+    sy = np.median(np.abs(np.diff(map_y, axis=0)))
+    f = 1
+    while 2 * f <= min(sx, sy):
+        f *= 2
+    return f
+
+
+class Rectifier:
+    """
+    Image rectification with fixed-point remap tables
+
+    Float maps are converted to CV_16SC2 (+ CV_16UC1 interpolation table) so cv2.remap
+    uses its fixed-point path. With `antialias`, the anti-aliasing is folded into a lower
+    resolution remap - the source is decimated by 2x steps with INTER_AREA (box filter)
+    and the maps address the decimated image. This replaces full-frame GaussianBlur.
+    """
+
+    def __init__(
+        self,
+        map1: np.ndarray,
+        map2: np.ndarray,
+        decimation: int = 1,
+        interpolation: int = cv2.INTER_LINEAR,
+    ):
+        """
+        map1, map2 : fixed-point maps as returned by cv2.convertMaps, addressing the decimated source
+        decimation : power of two by which the source is decimated before remap
+        """
+        self.map1, self.map2 = map1, map2
+        self.size = map1.shape[1], map1.shape[0]  # (w,h) of output
+        self.decimation = decimation
+        self.interpolation = interpolation
+        # Scratch buffers for decimated images, one set per thread
+        self._local = threading.local()
+
+    @staticmethod
+    def from_maps(
+        map_x: np.ndarray,
+        map_y: np.ndarray,
+        antialias: bool = True,
+        interpolation: Optional[int] = None,
+    ) -> "Rectifier":
+        """
+        Rectifier from float maps as returned by initUndistortRectifyMap
+        """
+        decimation = decimation_factor(map_x, map_y) if antialias else 1
+        if interpolation is None:
+            # Sampling is close to 1:1 without decimation, otherwise the residual scale needs interpolation
+            interpolation = cv2.INTER_LINEAR if decimation > 1 else cv2.INTER_NEAREST
+        if decimation > 1:
+            # Pixel centers of decimated image
+            map_x = (map_x + 0.5) / decimation - 0.5
+            map_y = (map_y + 0.5) / decimation - 0.5
+        map1, map2 = cv2.convertMaps(
+            map_x.astype(np.float32),
+            map_y.astype(np.float32),
+            cv2.CV_16SC2,
+            nninterpolation=interpolation == cv2.INTER_NEAREST,
+        )
+        return Rectifier(map1, map2, decimation, interpolation)
+
+    def _decimate(self, image: np.ndarray) -> np.ndarray:
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = dict()
+        f = 1
+        while f < self.decimation:
+            h, w = image.shape[:2]
+            h, w = h - h % 2, w - w % 2  # Exact 2x scale
+            shape = (h // 2, w // 2) + image.shape[2:]
+            buffer = buffers.get(f)
+            if buffer is None or buffer.shape != shape or buffer.dtype != image.dtype:
+                buffer = buffers[f] = np.empty(shape, image.dtype)
+            image = cv2.resize(image[:h, :w], (w // 2, h // 2), dst=buffer, interpolation=cv2.INTER_AREA)
+            f *= 2
+        return image
+
+    def __call__(self, image: np.ndarray, dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Rectify image, optionally to a caller-provided buffer of shape (h,w[,c]) given by `size`
+        """
+        if self.decimation > 1:
+            image = self._decimate(image)
+        return cv2.remap(
+            image, self.map1, self.map2, self.interpolation, dst=dst, borderMode=cv2.BORDER_CONSTANT
+        )
+
+
 class Camera:
-    def __init__(self, image_size, rectified_size, K, D, RT=None):
+    def __init__(self, image_size, rectified_size, K, D, RT=None, K_new=None, rectifier=None):
+        """
+        K_new, rectifier : precomputed rectification (e.g. from calibration cache), estimated when not given
+        """
         self.horizon = None
         self.RT_inv = None
+        # Homogeneous ground plane coordinates of distorted image pixels, built on first use
+        self.ground_map = None
+        self.ground_map_step = 4
         self.image_size = image_size
         self.rectified_size = rectified_size
         self.K = K
@@ -53,12 +167,18 @@ class Camera:
         self.RT = RT or np.eye(3, 4)
 
         # Rectification parameters
-        self.K_new = estimateCameraMatrix(
-            self.K, self.D, tuple(self.image_size), np.eye(3), new_size=tuple(self.rectified_size), fov_scale=1.2
-        )
-        self.maps = initUndistortRectifyMap(
-            self.K, self.D, np.eye(3), self.K_new, tuple(self.rectified_size), cv2.CV_32F
-        )
+        if K_new is None:
+            K_new = estimateCameraMatrix(
+                self.K, self.D, tuple(self.image_size), np.eye(3), new_size=tuple(self.rectified_size), fov_scale=1.2
+            )
+        self.K_new = K_new
+        self._maps = None
+        self.rectifier = rectifier or Rectifier.from_maps(*self.maps)
+        # Rectifiers to other output sizes, (w,h) -> Rectifier, the camera is shared between threads
+        self._rectifiers = {tuple(self.rectified_size): self.rectifier}
+        self._rectifiers_lock = threading.Lock()
+        # Key of the calibration in fcw_core_utils.calibration_cache, scaled rectifiers are cached on disk with it
+        self.cache_key: Optional[str] = None
 
         # view_direction = d.get("view_direction", "x")
         # R = np.eye(4)
@@ -66,6 +186,17 @@ class Camera:
         # T = translation_matrix(d.get("location", [0,0,1]))
         # self.RT = inv(self.T @ self.R)
 
+    @property
+    def maps(self):
+        """
+        Float maps (map_x, map_y) from distorted image to rectified_size, computed on first use
+        """
+        if self._maps is None:
+            self._maps = initUndistortRectifyMap(
+                self.K, self.D, np.eye(3), self.K_new, tuple(self.rectified_size), cv2.CV_32F
+            )
+        return self._maps
+
     def project_points(self, X, near: float = 0, to_rectified: bool = True):
         """
         X : (N,3) matrix
@@ -79,15 +210,107 @@ class Camera:
         x = x[:2, valid] / d[valid]
         return x.T, d[valid]
 
-    def rectify_image(self, image):
-        map1, map2 = self.maps
-        img = cv2.GaussianBlur(image, (3, 3), 0.5)
-        return cv2.remap(img, map1, map2, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT)
+    def rectified_scale(self, size) -> float:
+        """
+        Scale from coordinates in the rectified image resized to size (w,h) to rectified_size coordinates
+        """
+        return max(self.rectified_size) / max(size)
+
+    def scaled_rectifier(self, size) -> Rectifier:
+        """
+        Rectifier mapping the distorted image directly to the rectified image resized to size (w,h)
+
+        The rectified image and its resized version are produced in a single remap. Coordinates
+        in the output relate to rectified_size coordinates by uniform scale, see `rectified_scale`.
+        Rectifiers of cached cameras are cached on disk too.
+        """
+        size = tuple(int(x) for x in size)
+        with self._rectifiers_lock:
+            rectifier = self._rectifiers.get(size)
+            if rectifier is None:
+                if self.cache_key is not None:
+                    from fcw_core_utils.calibration_cache import cached_rectifier
+
+                    rectifier = cached_rectifier(self.cache_key, size, lambda: self._build_scaled_rectifier(size))
+                else:
+                    rectifier = self._build_scaled_rectifier(size)
+                self._rectifiers[size] = rectifier
+        return rectifier
+
+    def _build_scaled_rectifier(self, size) -> Rectifier:
+        s = 1 / self.rectified_scale(size)
+        # Scale K_new with respect to pixel centers
+        S = np.array([[s, 0, 0.5 * s - 0.5], [0, s, 0.5 * s - 0.5], [0, 0, 1]])
+        maps = initUndistortRectifyMap(self.K, self.D, np.eye(3), S @ self.K_new, size, cv2.CV_32F)
+        return Rectifier.from_maps(*maps)
+
+    def rectify_image(self, image, dst=None, size=None):
+        """
+        image : distorted image of image_size
+        dst : optional output buffer for the rectified image
+        size : optional (w,h) of the output if it should differ from rectified_size
+        """
+        rectifier = self.rectifier if size is None else self.scaled_rectifier(size)
+        return rectifier(image, dst)
 
     def rectify_points(self, x):
         y = undistortPoints(x.reshape(1, -1, 2), self.K, self.D, P=self.K_new)
         return y[0]
 
+    def rectified_to_ground(self, x, homogeneous: bool = False):
+        """
+        Intersection of rays through points in rectified image with the ground plane
+
+        x : (N,2) points in K_new
+        Returns (N,3) points on ground plane in world space, or (N,3) homogeneous (x,y,w)
+        ground plane coordinates which are smooth also across the horizon.
+        """
+        n = x.shape[0]
+        x_h = np.vstack([x.T, np.ones((1, n))])
+        norm_x = inv(self.K_new) @ x_h  # (3,N) normalized xyz in camera space
+        norm_x = np.vstack([norm_x, np.ones((1, n))])  # (4,N) homogeneous in 3D
+        X = self.RT_inv @ norm_x  # (3,N)
+        O = self.RT_inv[:, -1].reshape(3, -1)
+        S = X - O
+        if homogeneous:
+            # O - t * S, t = O_z / S_z
+            return np.vstack([O[:2] * S[2] - O[2] * S[:2], S[2]]).T
+        plane_normal = np.atleast_2d([0, 0, 1])
+        t = (plane_normal @ O[:3]) / (plane_normal @ S[:3])
+        return (O - t * S).T
+
+    def build_ground_map(self):
+        """
+        Lookup table of homogeneous ground plane coordinates for pixels of distorted image
+
+        Table is sampled with step ground_map_step pixels. The coordinates are linear in ray direction,
+        so bilinear interpolation between samples is accurate, unlike for the ground coordinates itself.
+        """
+        w, h = self.image_size
+        step = self.ground_map_step
+        xs = np.arange(0, w + step, step, dtype=np.float32)
+        ys = np.arange(0, h + step, step, dtype=np.float32)
+        x, y = np.meshgrid(xs, ys)
+        rp = self.rectify_points(np.stack([x.ravel(), y.ravel()], axis=1))
+        ground = self.rectified_to_ground(rp.astype(np.float64), homogeneous=True)
+        self.ground_map = ground.reshape(ys.size, xs.size, 3).astype(np.float32)
+
+    def distorted_to_ground(self, x):
+        """
+        Ground plane points for points in distorted image by lookup in ground_map
+
+        x : (N,2) points in distorted image
+        Returns (N,3) points on ground plane in world space
+        """
+        if self.ground_map is None:
+            self.build_ground_map()
+        p = np.asarray(x, np.float32).reshape(-1, 1, 2) / self.ground_map_step
+        g = cv2.remap(
+            self.ground_map, p[..., 0], p[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+        ).reshape(-1, 3)
+        n = g.shape[0]
+        return np.hstack([g[:, :2] / g[:, 2:], np.zeros((n, 1))])
+
     def unrectify_points(self, x):
         """
         x : (n,2) in K_new
@@ -100,6 +323,22 @@ class Camera:
 
     @staticmethod
     def from_dict(d: Dict) -> "Camera":
+        """
+        Camera from calibration dict
+
+        Cameras with identical calibration are shared within the process and the calibration
+        artifacts are cached on disk, see fcw_core_utils.calibration_cache. The returned camera
+        must be treated as read-only.
+        """
+        from fcw_core_utils.calibration_cache import cached_camera
+
+        return cached_camera(d)
+
+    @staticmethod
+    def calibrate(d: Dict) -> "Camera":
+        """
+        Estimate rectification, horizon and camera rotation from calibration dict
+        """
         image_size = d["image_size"]
         rectified_size = d["rectified_size"]
         # Measured intrinsic matrix
@@ -138,6 +377,8 @@ class Camera:
         T = translation_matrix(d.get("location", [0, 0, 1]))
         cam.RT = np.linalg.inv(T @ R)[:3]
         cam.RT_inv = (T @ R)[:3]
+        # Ground plane lookup for processing of distorted images
+        cam.build_ground_map()
 
         return cam
 
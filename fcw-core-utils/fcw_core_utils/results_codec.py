@@ -0,0 +1,200 @@
+"""
+Compact binary encoding of FCW results
+
+Results as generated by CollisionWorker (timestamps, dangerous_detections and objects) are packed into fixed-size
+little-endian records, floats are stored in single precision. Decoded results have the same structure as results
+received as JSON (detection ids are strings), time_to_collision None is stored as NaN. Object paths are optional,
+results without paths (see PROFILES) decode without them. Other fields of results (e.g. frame statistics) are
+stored as JSON.
+
+Results messages sent to clients are either the results dict itself (JSON encoding) or a dict with the timestamps
+and the encoded results in "results" field (binary encoding), see pack_message and unpack_message.
+"""
+import json
+import struct
+from typing import Any, Dict
+
+import numpy as np
+
+MAGIC = b"FCWR"
+FORMAT_VERSION = 3
+
+TIMESTAMPS = ("timestamp", "recv_timestamp", "timestamp_before_process", "timestamp_after_process", "send_timestamp")
+
+# Content of results sent to clients:
+#   alerts-only - dangerous detections and objects in or crossing danger zone, without paths
+#   objects - all tracked detections and objects near vehicle, without paths
+#   full - all tracked detections and objects near vehicle with their predicted paths
+PROFILES = ("alerts-only", "objects", "full")
+# Encoding of results sent to clients
+ENCODINGS = ("json", "binary")
+
+# Header flags
+FLAG_PATHS = 1
+
+# Fields with their own encoding, other fields are stored as JSON
+STATE = ("dangerous_detections", "objects")
+
+# magic, format version, flags, timestamps, number of detections, number of objects, size of class names table,
+# size of JSON with other fields
+_header = struct.Struct("<4sBB5qHHHH")
+
+DETECTION_DTYPE = np.dtype(
+    [
+        ("id", "<i4"),
+        ("bbox", "<f4", (4,)),
+        ("dangerous_distance", "<f4"),
+        ("age", "<i4"),
+        ("hit_streak", "<i4"),
+        ("class", "<i2"),
+        ("class_name", "<u2"),  # Index to class names table
+    ]
+)
+
+OBJECT_DTYPE = np.dtype(
+    [
+        ("id", "<i4"),
+        ("distance", "<f4"),
+        ("location", "<f4", (2,)),
+        ("is_in_danger_zone", "u1"),
+        ("crosses_danger_zone", "u1"),
+        ("time_to_collision", "<f4"),
+        ("path_length", "<u2"),
+    ]
+)
+
+
+def encode_results(results: Dict[str, Any]) -> bytes:
+    """
+    Encode results dict to bytes
+    """
+    detections = results.get("dangerous_detections", {})
+    objects = results.get("objects", [])
+
+    names = []
+    det = np.zeros(len(detections), DETECTION_DTYPE)
+    for i, (tid, d) in enumerate(detections.items()):
+        name = d.get("class_name", "")
+        if name not in names:
+            names.append(name)
+        det[i] = (
+            int(tid),
+            d["bbox"],
+            d["dangerous_distance"],
+            d["age"],
+            d["hit_streak"],
+            d["class"],
+            names.index(name),
+        )
+    names_table = "\n".join(names).encode()
+
+    obj = np.zeros(len(objects), OBJECT_DTYPE)
+    paths = []
+    has_paths = any("path" in o for o in objects)
+    for i, o in enumerate(objects):
+        ttc = o["time_to_collision"]
+        path = np.asarray(o.get("path", ()), "<f4").reshape(-1, 2)
+        obj[i] = (
+            o["id"],
+            o["distance"],
+            o["location"][:2],
+            o["is_in_danger_zone"],
+            o["crosses_danger_zone"],
+            np.nan if ttc is None else ttc,
+            path.shape[0],
+        )
+        paths.append(path)
+
+    extra = {k: v for k, v in results.items() if k not in TIMESTAMPS and k not in STATE}
+    extra_json = json.dumps(extra, separators=(",", ":")).encode() if extra else b""
+
+    header = _header.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        FLAG_PATHS if has_paths else 0,
+        *(int(results.get(k, 0)) for k in TIMESTAMPS),
+        det.size,
+        obj.size,
+        len(names_table),
+        len(extra_json),
+    )
+    parts = [header, names_table, extra_json, det.tobytes(), obj.tobytes()]
+    return b"".join(parts + [p.tobytes() for p in paths])
+
+
+def decode_results(buffer) -> Dict[str, Any]:
+    """
+    Decode results from bytes-like object
+    """
+    buffer = memoryview(buffer)
+    magic, version, flags, *values = _header.unpack_from(buffer)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported results encoding {bytes(magic)!r} version {version}")
+    timestamps, (n_det, n_obj, names_size, extra_size) = values[:5], values[5:]
+    offset = _header.size
+    names = bytes(buffer[offset : offset + names_size]).decode().split("\n")
+    offset += names_size
+    extra = json.loads(bytes(buffer[offset : offset + extra_size])) if extra_size else {}
+    offset += extra_size
+    det = np.frombuffer(buffer, DETECTION_DTYPE, n_det, offset)
+    offset += det.nbytes
+    obj = np.frombuffer(buffer, OBJECT_DTYPE, n_obj, offset)
+    offset += obj.nbytes
+    path_points = np.frombuffer(buffer, "<f4", 2 * int(obj["path_length"].sum()), offset).reshape(-1, 2)
+
+    results: Dict[str, Any] = dict(zip(TIMESTAMPS, timestamps))
+    results["dangerous_detections"] = {
+        str(d["id"]): {
+            "bbox": d["bbox"].tolist(),
+            "dangerous_distance": float(d["dangerous_distance"]),
+            "age": int(d["age"]),
+            "hit_streak": int(d["hit_streak"]),
+            "class": int(d["class"]),
+            "class_name": names[d["class_name"]],
+        }
+        for d in det
+    }
+    objects = []
+    start = 0
+    for o in obj:
+        end = start + int(o["path_length"])
+        ttc = float(o["time_to_collision"])
+        status = {
+            "id": int(o["id"]),
+            "distance": float(o["distance"]),
+            "location": o["location"].tolist(),
+        }
+        if flags & FLAG_PATHS:
+            status["path"] = path_points[start:end].tolist()
+        status["is_in_danger_zone"] = bool(o["is_in_danger_zone"])
+        status["crosses_danger_zone"] = bool(o["crosses_danger_zone"])
+        status["time_to_collision"] = None if np.isnan(ttc) else ttc
+        objects.append(status)
+        start = end
+    results["objects"] = objects
+    results.update(extra)
+    return results
+
+
+def pack_message(results: Dict[str, Any], encoding: str = "json") -> Dict[str, Any]:
+    """
+    Results message for client in given encoding (one of ENCODINGS)
+    """
+    if encoding == "json":
+        return results
+    if encoding == "binary":
+        # Timestamps stay readable for measuring of the transport
+        message = {k: results[k] for k in TIMESTAMPS if k in results}
+        message["results"] = encode_results(results)
+        return message
+    raise ValueError(f"Unknown results encoding {encoding}, use one of {list(ENCODINGS)}")
+
+
+def unpack_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Results from message in any encoding
+    """
+    data = message.get("results")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return decode_results(data)
+    return message
@@ -0,0 +1,128 @@
+"""
+Delta encoding of FCW results stream
+
+Consecutive results differ little, the same objects are tracked with slightly moved boxes. DeltaEncoder sends
+a keyframe with the full state periodically and only changes in between - new and removed ids and the changed
+fields of the others. Values are quantized (QUANTIZATION) before comparison, so small changes below the
+quantization step are not sent. DeltaDecoder on the client side reconstructs the full (quantized) results.
+
+Message has the timestamps and other fields of results (sent as they are), "delta" field with its sequence number,
+keyframe flag and removed ids, and "dangerous_detections" ({id: changed fields}) and "objects" ([{"id": id, changed
+fields}]) fields.
+"""
+from typing import Any, Dict, Optional
+
+from fcw_core_utils.results_codec import STATE
+
+# Quantization steps - bounding boxes [px], distances, locations and paths [m], time to collision [s]
+QUANTIZATION = {
+    "bbox": 0.5,
+    "dangerous_distance": 0.01,
+    "distance": 0.01,
+    "location": 0.01,
+    "path": 0.01,
+    "time_to_collision": 0.01,
+}
+
+
+def _quantize(value, step: float):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [_quantize(v, step) for v in value]
+    return round(round(value / step) * step, 6)
+
+
+def quantize(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy of detection or object dict with quantized values
+    """
+    return {k: _quantize(v, QUANTIZATION[k]) if k in QUANTIZATION else v for k, v in item.items()}
+
+
+class DeltaEncoder:
+    def __init__(self, keyframe_interval: int = 30):
+        """
+        keyframe_interval : full state is sent every keyframe_interval frames
+        """
+        self.keyframe_interval = keyframe_interval
+        self._seq = 0
+        self._detections: Dict[str, Dict[str, Any]] = {}
+        self._objects: Dict[int, Dict[str, Any]] = {}
+
+    def encode(self, results: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Delta message of results
+        """
+        keyframe = self._seq % self.keyframe_interval == 0
+        detections = {str(tid): quantize(d) for tid, d in results.get("dangerous_detections", {}).items()}
+        objects = {o["id"]: quantize(o) for o in results.get("objects", [])}
+        delta = {"seq": self._seq, "key": keyframe}
+        message = {k: v for k, v in results.items() if k not in STATE}
+        message["delta"] = delta
+        if keyframe:
+            message["dangerous_detections"] = detections
+            message["objects"] = list(objects.values())
+        else:
+            message["dangerous_detections"] = self._changes(self._detections, detections)
+            message["objects"] = [{"id": oid, **c} for oid, c in self._changes(self._objects, objects).items()]
+            delta["removed_detections"] = [tid for tid in self._detections if tid not in detections]
+            delta["removed_objects"] = [oid for oid in self._objects if oid not in objects]
+        self._detections = detections
+        self._objects = objects
+        self._seq += 1
+        return message
+
+    @staticmethod
+    def _changes(previous: Dict, current: Dict) -> Dict:
+        changes = {}
+        for key, item in current.items():
+            old = previous.get(key)
+            if old is None:
+                changes[key] = item
+                continue
+            changed = {k: v for k, v in item.items() if old.get(k) != v}
+            if changed:
+                changes[key] = changed
+        return changes
+
+
+class DeltaDecoder:
+    """
+    Reconstructs results from delta messages. Decoded results share the state of the decoder and must not be
+    modified.
+    """
+
+    def __init__(self):
+        self._seq: Optional[int] = None
+        self._detections: Dict[str, Dict[str, Any]] = {}
+        self._objects: Dict[int, Dict[str, Any]] = {}
+
+    def decode(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Full results, None until the first keyframe or after a lost message until the next keyframe
+        """
+        delta = message["delta"]
+        if delta["key"]:
+            self._detections = {str(tid): d for tid, d in message["dangerous_detections"].items()}
+            self._objects = {o["id"]: o for o in message["objects"]}
+        elif self._seq is None or delta["seq"] != self._seq + 1:
+            self._seq = None
+            return None
+        else:
+            for tid in delta["removed_detections"]:
+                self._detections.pop(str(tid), None)
+            for oid in delta["removed_objects"]:
+                self._objects.pop(oid, None)
+            for tid, changes in message["dangerous_detections"].items():
+                # Changed entries are replaced, the previous results stay valid
+                tid = str(tid)
+                self._detections[tid] = {**self._detections.get(tid, {}), **changes}
+            for changes in message["objects"]:
+                oid = changes["id"]
+                self._objects[oid] = {**self._objects.get(oid, {}), **changes}
+        self._seq = delta["seq"]
+        results = {k: v for k, v in message.items() if k not in STATE and k != "delta"}
+        results["dangerous_detections"] = dict(self._detections)
+        results["objects"] = list(self._objects.values())
+        return results
@@ -0,0 +1,98 @@
+"""
+Ring of frame slots in shared memory
+
+Frames are handed over between processes by writing them into a free slot and passing only a small descriptor
+(slot, shape, dtype) through a pipe or queue. The consumer views the frame in place and releases the slot when done.
+Free slots circulate in a multiprocessing queue, so the ring bounds the number of frames in flight.
+
+The ring is created by the owner process and passed to child processes as a Process argument, children attach
+to the same shared memory.
+"""
+import os
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+
+class FrameDescriptor(NamedTuple):
+    slot: int
+    shape: tuple
+    dtype: str
+
+
+class ShmRing:
+    def __init__(self, slots: int, slot_size: int, context=None):
+        """
+        slots : number of frames in flight
+        slot_size : maximal frame size in bytes
+        context : multiprocessing context of the processes using the ring, default context when None
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self._shm = SharedMemory(create=True, size=slots * slot_size)
+        # Forked children get the ring without pickling
+        self._owner_pid = os.getpid()
+        self._free = Queue() if context is None else context.Queue()
+        for i in range(slots):
+            self._free.put(i)
+
+    def __getstate__(self):
+        return dict(slots=self.slots, slot_size=self.slot_size, name=self._shm.name, free=self._free)
+
+    def __setstate__(self, state):
+        self.slots = state["slots"]
+        self.slot_size = state["slot_size"]
+        self._shm = SharedMemory(name=state["name"])
+        self._owner_pid = None
+        self._free = state["free"]
+
+    def acquire(self, block: bool = True, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        Free slot, None when no slot is free in time (or at all when block is False)
+        """
+        try:
+            return self._free.get(block, timeout)
+        except Empty:
+            return None
+
+    def release(self, slot: int):
+        """
+        Return slot to the ring
+        """
+        self._free.put(slot)
+
+    def view(self, d: FrameDescriptor) -> np.ndarray:
+        """
+        Array in shared memory described by the descriptor, valid until the slot is released
+        """
+        return np.ndarray(d.shape, np.dtype(d.dtype), self._shm.buf, d.slot * self.slot_size)
+
+    def write(self, slot: int, array: np.ndarray) -> FrameDescriptor:
+        """
+        Copy array to the slot
+        """
+        if array.nbytes > self.slot_size:
+            raise ValueError(f"Frame of {array.nbytes} B does not fit slot of {self.slot_size} B")
+        d = FrameDescriptor(slot, array.shape, array.dtype.str)
+        np.copyto(self.view(d), array)
+        return d
+
+    def put(self, array: np.ndarray, block: bool = True, timeout: Optional[float] = None) -> Optional[FrameDescriptor]:
+        """
+        Copy array to a free slot, None when no slot is free (the frame is dropped)
+        """
+        slot = self.acquire(block, timeout)
+        if slot is None:
+            return None
+        return self.write(slot, array)
+
+    def close(self):
+        """
+        Detach from the shared memory, the owner also frees it
+        """
+        self._shm.close()
+        if self._owner_pid == os.getpid():
+            self._shm.unlink()
@@ -0,0 +1,39 @@
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from fcw_core_utils.collision import ForwardCollisionGuard
+
+
+def make_guard(dt: float) -> ForwardCollisionGuard:
+    return ForwardCollisionGuard(
+        danger_zone=Polygon([(0, -2), (30, -2), (30, 2), (0, 2)]),
+        vehicle_zone=box(-2, -1, 2, 1),
+        safety_radius=50,
+        prediction_length=4,
+        prediction_step=0.1,
+        dt=dt,
+    )
+
+
+def test_dt_switch_keeps_velocity_and_ttc():
+    # Object approaching front of the vehicle (x=2) at 5 m/s, observed at 10 FPS
+    fps, speed, x0 = 10, 5.0, 50.0
+    guard = make_guard(1 / fps)
+    t = 0.0
+
+    def observe():
+        guard.update({1: np.array([x0 - speed * t, 0.0, 0.0])})
+        (status,) = guard.label_objects()
+        assert np.isclose(guard.objects[1].relative_speed, speed, rtol=0.05)
+        assert np.isclose(status.time_to_collision, (x0 - speed * t - 2) / speed, rtol=0.05)
+
+    for _ in range(70):
+        guard.update({1: np.array([x0 - speed * t, 0.0, 0.0])})
+        t += 1 / fps
+    observe()
+    # Detection cadence is switched, the object is observed every cadence frames
+    for cadence in (2, 1):
+        guard.dt = cadence / fps
+        for _ in range(3):
+            t += cadence / fps
+            observe()
@@ -0,0 +1,224 @@
+"""
+Offline Early Collision Warning over many recordings
+
+Videos of a directory (camera config of a video is the yaml file of the same name, or the --camera file) or of
+a manifest (yaml or json list of {"video": path, "camera": path, "name": optional name}) are processed by fcw_offline
+in a pool of processes. Each process loads the detector once and processes whole videos.
+
+Results of a video are written to <output>/<name>/, its summary.json is the checkpoint - videos with summary are
+skipped when the run is repeated, partial results of interrupted videos are removed and the videos are processed
+again. At the end, results of all videos are merged into <output>/index.json (summaries of videos) and columnar
+tables in <output>/merged/ with "video" column (index of the video in index.json).
+"""
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from argparse import ArgumentParser, FileType
+from glob import glob
+from typing import Dict, List, Optional
+
+import cv2
+import yaml
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+logger = logging.getLogger("FCW batch")
+
+from fcw_core_utils.columnar import ColumnarWriter, read_table
+from fcw_core.fcw_offline import SCHEMA, process_video
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov")
+# Period of progress reports [s]
+PROGRESS_PERIOD = 5.0
+
+# Detector of the pool process, loaded by the first video
+_detector = None
+# Queue of processed frame counts of the pool process
+_progress = None
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Process recordings by FCW in a pool of processes")
+
+    parser.add_argument("-c", "--config", type=FileType("r"), required=True, help="Collision warning config")
+    parser.add_argument("--camera", type=str, default=None, help="Camera settings of videos without their own")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output directory of results")
+    parser.add_argument(
+        "--processes", type=int, default=None, help="Number of processes, CPU count / torch threads by default"
+    )
+    parser.add_argument("--torch_threads", type=int, default=1, help="Torch threads of each process")
+    parser.add_argument("--batch", type=int, default=8, help="Frames detected by one detector call")
+    parser.add_argument("--raw", action="store_true", help="Process distorted images")
+    parser.add_argument("--no_merge", action="store_true", help="Do not merge results of videos")
+    parser.add_argument("source", type=str, help="Directory of videos or manifest file (yaml or json)")
+
+    return parser.parse_args()
+
+
+def find_videos(source: str, default_camera: Optional[str] = None) -> List[Dict]:
+    """
+    Videos with their camera configs and names from directory or manifest file
+    """
+    if os.path.isdir(source):
+        paths = sorted(p for p in glob(os.path.join(source, "*")) if p.lower().endswith(VIDEO_EXTENSIONS))
+        videos = [dict(video=p) for p in paths]
+    else:
+        with open(source) as f:
+            videos = yaml.safe_load(f)  # JSON is YAML too
+        # Paths of manifest are relative to the manifest
+        base = os.path.dirname(source)
+        for v in videos:
+            v["video"] = os.path.join(base, v["video"])
+            if "camera" in v:
+                v["camera"] = os.path.join(base, v["camera"])
+    for v in videos:
+        if "camera" not in v:
+            own = os.path.splitext(v["video"])[0] + ".yaml"
+            v["camera"] = own if os.path.exists(own) else default_camera
+        if v["camera"] is None:
+            raise ValueError(f"No camera config of {v['video']}")
+        v.setdefault("name", os.path.splitext(os.path.basename(v["video"]))[0])
+    names = [v["name"] for v in videos]
+    if len(set(names)) != len(names):
+        raise ValueError("Names of videos are not unique, set names in manifest")
+    return videos
+
+
+def _init_process(torch_threads: int, progress):
+    global _progress
+    _progress = progress
+    import torch
+
+    torch.set_num_threads(torch_threads)
+
+
+def _process(task: Dict) -> Dict:
+    global _detector
+    from fcw_core.yolo_detector import YOLODetector
+
+    video, config_dict, output, batch, raw = task["video"], task["config"], task["output"], task["batch"], task["raw"]
+    try:
+        if _detector is None:
+            _detector = YOLODetector.from_dict(config_dict.get("detector", {}))
+        with open(video["camera"]) as f:
+            camera_dict = yaml.safe_load(f)
+        summary = process_video(
+            config_dict,
+            camera_dict,
+            video["video"],
+            output,
+            batch=batch,
+            raw=raw,
+            progress=_progress.put,
+            detector=_detector,
+        )
+    except Exception as ex:
+        logger.error(f"Failed to process {video['video']}: {repr(ex)}")
+        return dict(name=video["name"], error=repr(ex))
+    summary["name"] = video["name"]
+    summary["camera"] = video["camera"]
+    # Checkpoint - the video is complete
+    with open(os.path.join(output, "summary.json.tmp"), "w") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(os.path.join(output, "summary.json.tmp"), os.path.join(output, "summary.json"))
+    return summary
+
+
+def _clear(path: str):
+    """
+    Remove partial results of interrupted video
+    """
+    for filename in glob(os.path.join(path, "*.npz")) + glob(os.path.join(path, "*.tmp")):
+        os.remove(filename)
+
+
+def merge(output: str, summaries: List[Dict]):
+    """
+    Write index of videos and merged tables with video column
+    """
+    with open(os.path.join(output, "index.json"), "w") as f:
+        json.dump(summaries, f, indent=2)
+    schema = {table: dict(columns, video="int32") for table, columns in SCHEMA.items()}
+    writer = ColumnarWriter(os.path.join(output, "merged"), schema)
+    _clear(writer.path)
+    for index, summary in enumerate(summaries):
+        for table in SCHEMA:
+            columns = read_table(os.path.join(output, summary["name"]), table)
+            if columns:
+                rows = len(next(iter(columns.values())))
+                writer.extend(table, video=[index] * rows, **columns)
+    writer.close()
+
+
+def main(args=None):
+    args = parse_arguments()
+
+    config_dict = yaml.safe_load(args.config)
+    videos = find_videos(args.source, args.camera)
+    processes = args.processes or max(1, (os.cpu_count() or 1) // args.torch_threads)
+
+    done: Dict[str, Dict] = {}
+    tasks = []
+    total_frames = 0
+    for v in videos:
+        path = os.path.join(args.output, v["name"])
+        checkpoint = os.path.join(path, "summary.json")
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                done[v["name"]] = json.load(f)
+            continue
+        os.makedirs(path, exist_ok=True)
+        _clear(path)
+        video = cv2.VideoCapture(v["video"])
+        total_frames += max(int(video.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+        video.release()
+        tasks.append(dict(video=v, config=config_dict, output=path, batch=args.batch, raw=args.raw))
+    logger.info(
+        f"{len(videos)} videos, {len(done)} done before, {len(tasks)} to process ({total_frames} frames) "
+        f"in {processes} processes with {args.torch_threads} torch threads"
+    )
+
+    progress = multiprocessing.Queue()
+    failed = []
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes, initializer=_init_process, initargs=(args.torch_threads, progress)) as pool:
+        results = pool.imap_unordered(_process, tasks)
+        frames = 0
+        finished = 0
+        last_report = start_time
+        while finished < len(tasks):
+            try:
+                summary = results.next(timeout=0.5)
+            except multiprocessing.TimeoutError:
+                summary = None
+            while not progress.empty():
+                frames += progress.get()
+            if summary is not None:
+                finished += 1
+                if "error" in summary:
+                    failed.append(summary)
+                else:
+                    done[summary["name"]] = summary
+                    logger.info(f"{summary['name']} done: {summary['frames']} frames, {summary['fps']:.1f} FPS")
+            now = time.perf_counter()
+            if now - last_report > PROGRESS_PERIOD or finished == len(tasks):
+                last_report = now
+                fps = frames / (now - start_time)
+                eta = (total_frames - frames) / fps if fps > 0 and total_frames > frames else 0
+                logger.info(
+                    f"Progress: {finished}/{len(tasks)} videos, {frames}/{total_frames} frames, {fps:.1f} FPS, "
+                    f"ETA {eta:.0f}s"
+                )
+
+    if failed:
+        logger.error(f"{len(failed)} videos failed (run again to retry): {[f['name'] for f in failed]}")
+    if not args.no_merge:
+        summaries = [done[v["name"]] for v in videos if v["name"] in done]
+        merge(args.output, summaries)
+        logger.info(f"Results of {len(summaries)} videos merged to {args.output}/index.json and {args.output}/merged")
+
+
+if __name__ == "__main__":
+    main()
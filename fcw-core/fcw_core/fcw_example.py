@@ -3,6 +3,7 @@ Early Collision Warning system
 """
 import json
 from argparse import ArgumentParser, FileType
+from multiprocessing import Process, Queue
 import statistics
 from datetime import datetime
 import cv2
@@ -24,10 +25,13 @@ from fcw_core.yolo_detector import YOLODetector
 
 from fcw_core.vizualization import *
 from fcw_core_utils.rate_timer import RateTimer
+from fcw_core_utils.shm_ring import ShmRing
 
 # os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;udp"
 
 start_timestamp = datetime.now().strftime("%Y-%d-%m_%H-%M-%S")
+# Period of checking the render process while waiting for a free frame slot [s]
+RENDER_CHECK_PERIOD = 0.5
 
 
 def parse_arguments():
@@ -39,11 +43,97 @@ def parse_arguments():
     parser.add_argument("--viz", action="store_true")
     parser.add_argument("-t", "--play_time", type=int, help="Video play time in seconds", default=60)
     parser.add_argument("--fps", type=int, help="Video FPS", default=None)
+    parser.add_argument(
+        "--raw", action="store_true", help="Process distorted images, only reference points are undistorted"
+    )
+    parser.add_argument(
+        "--render_queue",
+        type=int,
+        default=4,
+        help="Frames queued for the render process. Without output video, frames are dropped when the queue is full, "
+        "with output video the processing waits so the output is complete",
+    )
     parser.add_argument("source_video", type=str, help="Video stream (file or url)")
 
     return parser.parse_args()
 
 
+def render_loop(
+    ring: ShmRing, frames: Queue, camera_dict: dict, danger_zone: Polygon, raw: bool, fps: float, output_path, viz
+):
+    """
+    Render process - draws (frame, snapshot) pairs from the queue, shows them and writes them to output video
+    """
+    camera = Camera.from_dict(camera_dict)
+    # Prepare static stuff for visualization
+    logo = Overlay.from_pil(cog_logo((64, 64)))
+    overlay = static_overlay(camera, danger_zone)
+    marker_image, marker_anchor = vehicle_marker_image(scale=3)
+    marker = Overlay.from_pil(marker_image)
+    # Buffers of the rectified inset
+    img_undistorted = img_gray = img_inset = None
+
+    if viz:
+        try:
+            cv2.namedWindow("FCW")
+        except Exception as ex:
+            logger.debug(repr(ex))
+    output = None
+    if output_path is not None:
+        output = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"MP4V"), fps, camera.image_size)
+
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        descriptor, snapshot = item
+        # Drawn in place in the shared memory slot
+        cv_image = ring.view(descriptor)
+
+        # Rectified image in grayscale with static layers, trackers and objects
+        img_undistorted = camera.rectify_image(cv_image, img_undistorted)
+        img_gray = cv2.cvtColor(img_undistorted, cv2.COLOR_BGR2GRAY, dst=img_gray)
+        img_inset = cv2.cvtColor(img_gray, cv2.COLOR_GRAY2BGR, dst=img_inset)
+        overlay.blend(img_inset)
+        # Trackers are in coordinates of distorted image in raw mode
+        if not raw:
+            draw_image_trackers(img_inset, snapshot["boxes"], snapshot["reliable"])
+        draw_world_objects(img_inset, camera, snapshot["locations"], snapshot["paths"])
+
+        # Base layer is the camera image
+        if raw:
+            draw_image_trackers(cv_image, snapshot["boxes"], snapshot["reliable"])
+        draw_tracking_status(cv_image, snapshot["status"])
+        mark_vehicles(cv_image, camera, snapshot["locations"], marker, marker_anchor)
+        logo.blend(cv_image, 8, 16 + 8)
+        # Pic with rectified image and vizualized trackers
+        h, h1, w1 = cv_image.shape[0], img_inset.shape[0], img_inset.shape[1]
+        cv_image[h - h1 - 8 : h - 8, 8 : 8 + w1] = img_inset
+
+        if viz:
+            try:
+                # Display the image
+                cv2.imshow("FCW", cv_image)
+                cv2.waitKey(1)
+            except Exception as ex:
+                logger.debug(repr(ex))
+
+        if output is not None:
+            output.write(cv_image)
+
+        cv_image = None
+        ring.release(descriptor.slot)
+
+    if output is not None:
+        output.release()
+    ring.close()
+
+    try:
+        cv2.destroyAllWindows()
+    except Exception as ex:
+        logger.debug(repr(ex))
+
+
 def main(args=None):
     args = parse_arguments()
     logger.info("Starting Forward Collision Guard")
@@ -65,12 +155,6 @@ def main(args=None):
     shape = height, width
     logger.info("Video {W}x{H}, {fps} FPS".format(W=width, H=height, fps=fps))
 
-    if args.viz:
-        try:
-            cv2.namedWindow("FCW")
-        except Exception as ex:
-            logger.debug(repr(ex))
-
     # Init object detector
     detector = YOLODetector.from_dict(config_dict.get("detector", {}))
 
@@ -88,22 +172,23 @@ def main(args=None):
     logger.info("Loading camera configuration {cfg}".format(cfg=args.camera.name))
     camera_dict = yaml.safe_load(args.camera)
     camera = Camera.from_dict(camera_dict)
+    if args.raw:
+        logger.info("Processing distorted images")
 
     render_output = args.viz or args.output is not None
     if render_output:
-        logger.warning("RENDERING OUTPUT - LOWER PERFOMANCE")
-
-    if args.output is not None:
-        output = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*"MP4V"), fps, camera.image_size)
-
-    if render_output:
-        # Prepare static stuff for visualization
-        logo = cog_logo((64, 64))
-        coord_sys = draw_world_coordinate_system(camera.rectified_size, camera)
-        coord_sys.putalpha(64)
-        danger_zone = draw_danger_zone(camera.rectified_size, camera, guard.danger_zone)
-        horizon = draw_horizon(camera.rectified_size, camera, width=1, fill=(255, 255, 0, 64))
-        marker, marker_anchor = vehicle_marker_image(scale=3)
+        # Rendering and encoding runs in separate process, frames are passed through shared memory
+        ring = ShmRing(args.render_queue, height * width * 3)
+        render_queue = Queue()
+        renderer = Process(
+            target=render_loop,
+            args=(ring, render_queue, camera_dict, guard.danger_zone, args.raw, fps, args.output, args.viz),
+            daemon=True,
+        )
+        renderer.start()
+        # Complete output video is rendered, otherwise frames are dropped when the renderer is late
+        render_block = args.output is not None
+        render_dropped = 0
 
     delays = []
     measuring_items = {
@@ -119,6 +204,14 @@ def main(args=None):
 
     rate_timer = RateTimer(rate=fps, iteration_miss_warning=True)
 
+    # Distorted image is rectified directly to detector input size, detections are scaled to rectified_size
+    input_size = detector.input_size(camera.rectified_size)
+    input_scale = 1 if args.raw else camera.rectified_scale(input_size)
+    # Rectified image buffer reused between frames
+    img_input = None
+
+    renderer_failed = False
+
     # FCW Loop
     start_time = time.time_ns()
     while time.time_ns() - start_time < args.play_time * 1.0e+9:
@@ -128,12 +221,15 @@ def main(args=None):
             break
         key_timestamp = time.perf_counter_ns()
 
-        img_undistorted = camera.rectify_image(img)
+        if not args.raw:
+            img_input = camera.rectify_image(img, img_input, size=input_size)
+        else:
+            img_input = img
         time0 = time.perf_counter_ns()
         measuring.log_measuring(key_timestamp, "worker_recv_timestamp", time0)
         measuring.log_measuring(key_timestamp, "worker_before_process_timestamp", time0)
         # Detect object in image
-        detections = detector.detect(img_undistorted)
+        detections = detector.detect(img_input, scale=input_scale)
         # Get bounding boxes as numpy array
         detections = detections_to_numpy(detections)
         # Update state of image trackers
@@ -145,7 +241,7 @@ def main(args=None):
         }
 
         # Get 3D locations of objects
-        ref_pt = get_reference_points(tracked_objects, camera, is_rectified=True)
+        ref_pt = get_reference_points(tracked_objects, camera, is_rectified=not args.raw)
         # Update state of objects in world
         guard.update(ref_pt)
         # Get list of current offenses
@@ -160,60 +256,42 @@ def main(args=None):
         measuring.store_measuring(key_timestamp)
 
         if render_output:
-            # Visualization
-            base_undistorted = Image.fromarray(img_undistorted[..., ::-1], "RGB").convert("L").convert("RGBA")
-            # Base layer is the camera image
-            base = Image.fromarray(img[..., ::-1], "RGB").convert("RGBA")
-            # Layers showing various information
-            sz = base_undistorted.size
-            layers = [
-                (coord_sys, None),
-                (danger_zone, None),
-                (horizon, None),
-                (draw_image_trackers(sz, tracker.trackers), None),
-                (draw_world_objects(sz, camera, guard.objects.values()), None),
-            ]
-
-            # Compose layers together
-            compose_layers(base_undistorted, *layers)
-            O = list(guard.label_objects(include_distant=False))
-            w, h = base.size
-            w1, h1 = base_undistorted.size
-            compose_layers(
-                base,  # Original image
-                (tracking_info((w, 16), O), (0, 0)),
-                (mark_vehicles(camera.image_size, guard.objects.values(), camera, marker, marker_anchor), None),
-                (logo, (8, 16 + 8)),
-                (base_undistorted, (8, h - h1 - 8)),  # Pic with rectified image and vizualized trackers
-            )
-            # Convert to OpenCV for display
-            cv_image = np.array(base.convert("RGB"))[..., ::-1]
-
-        if args.viz:
-            try:
-                # Display the image
-                cv2.imshow("FCW", cv_image)
-                cv2.waitKey(1)
-            except Exception as ex:
-                logger.debug(repr(ex))
-
-        if args.output is not None:
-            output.write(cv_image)
+            # Visualization, frame with snapshot of tracker and guard state is passed to the render process
+            descriptor = ring.put(img, block=render_block, timeout=RENDER_CHECK_PERIOD if render_block else None)
+            while descriptor is None and render_block and renderer.is_alive():
+                descriptor = ring.put(img, timeout=RENDER_CHECK_PERIOD)
+            if not renderer.is_alive():
+                logger.error(f"Render process exited with code {renderer.exitcode}, output is incomplete")
+                renderer_failed = True
+                break
+            if descriptor is None:
+                render_dropped += 1
+            else:
+                objects = list(guard.objects.values())
+                snapshot = dict(
+                    boxes=[t.get_state()[0] for t in tracker.trackers],
+                    # TODO: call it.is_reliable()
+                    reliable=[not (t.age < 3 or t.hit_streak == 0) for t in tracker.trackers],
+                    locations=np.array([[o.kf.x[0, 0], o.kf.x[3, 0]] for o in objects]).reshape(-1, 2),
+                    paths=[np.array(o.future_path(5).coords) for o in objects],
+                    status=tracking_status(list(guard.label_objects(include_distant=False))),
+                )
+                render_queue.put((descriptor, snapshot))
 
         rate_timer.sleep()  # sleep until next frame should be sent (with given fps)
 
-    if args.output is not None:
-        output.release()
+    if render_output:
+        logger.info(f"Waiting for render process, {render_dropped} frames dropped")
+        render_queue.put(None)
+        renderer.join()
+        ring.close()
 
     logger.info(f"-----")
     end_time = time.time_ns()
     logger.info(f"Total streaming time: {(end_time - start_time) * 1.0e-9:.3f}s")
     logger.info(f"Delay median: {statistics.median(delays) * 1.0e-9:.3f}s")
-
-    try:
-        cv2.destroyAllWindows()
-    except Exception as ex:
-        logger.debug(repr(ex))
+    if renderer_failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+"""
+Offline Early Collision Warning - recorded video processed as fast as possible
+
+Frames are decoded and rectified by a prefetch thread, detection runs in batches and tracking and collision guard
+are fed in frame order. There is no pacing, the video is processed at the speed of the pipeline. Per-frame results
+are written in columnar chunks (fcw_core_utils.columnar) to the output directory:
+
+    frames: frame, video_time [s], detections, tracked, dangerous, process_time [s] (batch time per frame)
+    objects: frame, id, class, x1, y1, x2, y2 (image box), x, y (location in vehicle space, nan if unknown),
+        distance [m], time_to_collision [s] (nan if not colliding), in_danger_zone, crosses_danger_zone, dangerous
+"""
+import json
+import logging
+import sys
+import time
+from argparse import ArgumentParser, FileType
+from queue import Queue
+from threading import Event, Thread
+from typing import Callable, Dict, Optional
+
+import cv2
+import numpy as np
+import yaml
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+logger = logging.getLogger("FCW offline")
+
+from fcw_core_utils.collision import get_reference_points, ForwardCollisionGuard
+from fcw_core_utils.columnar import ColumnarWriter
+from fcw_core_utils.geometry import Camera
+from fcw_core.detection import detections_to_numpy
+from fcw_core.sort import Sort
+from fcw_core.yolo_detector import YOLODetector
+
+SCHEMA = {
+    "frames": {
+        "frame": np.int32,
+        "video_time": np.float64,
+        "detections": np.int32,
+        "tracked": np.int32,
+        "dangerous": np.int32,
+        "process_time": np.float32,
+    },
+    "objects": {
+        "frame": np.int32,
+        "id": np.int32,
+        "class": np.int16,
+        "x1": np.float32,
+        "y1": np.float32,
+        "x2": np.float32,
+        "y2": np.float32,
+        "x": np.float32,
+        "y": np.float32,
+        "distance": np.float32,
+        "time_to_collision": np.float32,
+        "in_danger_zone": np.bool_,
+        "crosses_danger_zone": np.bool_,
+        "dangerous": np.bool_,
+    },
+}
+
+
+def parse_arguments():
+    parser = ArgumentParser(description="Process recorded video by FCW as fast as possible")
+
+    parser.add_argument("-c", "--config", type=FileType("r"), required=True, help="Collision warning config")
+    parser.add_argument("--camera", type=FileType("r"), required=True, help="Camera settings")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output directory of results")
+    parser.add_argument("--batch", type=int, default=8, help="Frames detected by one detector call")
+    parser.add_argument("--prefetch", type=int, default=32, help="Frames decoded ahead")
+    parser.add_argument("--max_frames", type=int, default=None, help="Stop after this number of frames")
+    parser.add_argument("--fps", type=float, help="Video FPS", default=None)
+    parser.add_argument(
+        "--raw", action="store_true", help="Process distorted images, only reference points are undistorted"
+    )
+    parser.add_argument("source_video", type=str, help="Video file")
+
+    return parser.parse_args()
+
+
+class FramePrefetcher(Thread):
+    """
+    Decodes and rectifies frames ahead of the processing, items of the queue are (frame, video_time, image) and None
+    at the end of the video. Exception of decoding or rectification is kept in error, the consumer re-raises it
+    """
+
+    def __init__(
+        self,
+        video: cv2.VideoCapture,
+        camera: Optional[Camera],
+        input_size,
+        prefetch: int,
+        max_frames: Optional[int] = None,
+    ):
+        """
+        video : opened video
+        camera : rectification camera, images are not rectified when None
+        input_size : size of rectified images (detector input size)
+        prefetch : maximal number of frames in the queue
+        max_frames : stop after this number of frames
+        """
+        super().__init__(name="Frame prefetcher", daemon=True)
+        self.video = video
+        self.camera = camera
+        self.input_size = input_size
+        self.max_frames = max_frames
+        self.frames: Queue = Queue(prefetch)
+        self.error: Optional[Exception] = None
+        self._stop_event = Event()
+
+    def stop(self):
+        self._stop_event.set()
+        # Unblock put of the prefetcher
+        while self.is_alive():
+            while not self.frames.empty():
+                self.frames.get_nowait()
+            self.join(0.1)
+
+    def run(self):
+        frame = 0
+        try:
+            while not self._stop_event.is_set() and (self.max_frames is None or frame < self.max_frames):
+                ret, img = self.video.read()
+                if not ret or img is None:
+                    break
+                video_time = self.video.get(cv2.CAP_PROP_POS_MSEC) * 1.0e-3
+                if self.camera is not None:
+                    # New buffer for each frame, several frames are queued
+                    img = self.camera.rectify_image(img, size=self.input_size)
+                self.frames.put((frame, video_time, img))
+                frame += 1
+        except Exception as ex:
+            self.error = ex
+        finally:
+            # The consumer is not left waiting when decoding fails
+            self.frames.put(None)
+
+
+def process_video(
+    config_dict: Dict,
+    camera_dict: Dict,
+    source_video: str,
+    output: str,
+    batch: int = 8,
+    prefetch: int = 32,
+    raw: bool = False,
+    fps: Optional[float] = None,
+    max_frames: Optional[int] = None,
+    progress: Optional[Callable[[int], None]] = None,
+    detector: Optional[YOLODetector] = None,
+) -> Dict:
+    """
+    Process video and write results to the output directory
+
+    progress : called with the number of frames processed since the last call
+    detector : detector of the config, loaded when None (reused between videos)
+
+    Returns summary of the run (frames, processing time, video time...)
+    """
+    video = cv2.VideoCapture(source_video)
+    if not video.isOpened():
+        raise Exception(f"Cannot open video file {source_video}")
+    fps = fps or video.get(cv2.CAP_PROP_FPS)
+
+    if detector is None:
+        detector = YOLODetector.from_dict(config_dict.get("detector", {}))
+    tracker = Sort.from_dict(config_dict.get("tracker", {}))
+    tracker.dt = 1 / fps
+    guard = ForwardCollisionGuard.from_dict(config_dict.get("fcw", {}))
+    guard.dt = 1 / fps
+    camera = Camera.from_dict(camera_dict)
+
+    # Distorted image is rectified directly to detector input size, detections are scaled to rectified_size
+    input_size = detector.input_size(camera.rectified_size)
+    if raw:
+        input_scale = camera.image_size[0] / int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    else:
+        input_scale = camera.rectified_scale(input_size)
+
+    prefetcher = FramePrefetcher(video, None if raw else camera, input_size, prefetch, max_frames)
+    prefetcher.start()
+    writer = ColumnarWriter(output, SCHEMA)
+
+    frames = 0
+    video_time = 0.0
+    start_time = time.perf_counter()
+    ended = False
+    try:
+        while not ended:
+            items = []
+            while len(items) < batch:
+                item = prefetcher.frames.get()
+                if item is None:
+                    if prefetcher.error is not None:
+                        # Truncated run must not look complete
+                        raise Exception(f"Failed to read frame {frames + len(items)}") from prefetcher.error
+                    ended = True
+                    break
+                items.append(item)
+            if not items:
+                break
+            time0 = time.perf_counter()
+            batch_detections = detector.detect_batch([img for _, _, img in items], [input_scale] * len(items))
+            rows = []
+            for (frame, video_time, _), detections in zip(items, batch_detections):
+                tracker.update(detections_to_numpy(detections))
+                # Represent trackers as dict  tid -> KalmanBoxTracker
+                tracked_objects = {
+                    t.id: t for t in tracker.trackers
+                    if t.hit_streak > tracker.min_hits and t.time_since_update < 1 and t.age > 3
+                }
+                guard.update(get_reference_points(tracked_objects, camera, is_rectified=not raw))
+                dangerous_objects = guard.dangerous_objects()
+                statuses = {s.id: s for s in guard.label_objects(include_distant=True)}
+                _write_objects(writer, frame, tracked_objects, statuses, dangerous_objects)
+                rows.append(
+                    dict(
+                        frame=frame,
+                        video_time=video_time,
+                        detections=len(detections),
+                        tracked=len(tracked_objects),
+                        dangerous=len(dangerous_objects),
+                    )
+                )
+            # Batch time per frame
+            process_time = (time.perf_counter() - time0) / len(items)
+            for row in rows:
+                writer.append("frames", process_time=process_time, **row)
+            frames += len(items)
+            if progress is not None:
+                progress(len(items))
+    finally:
+        prefetcher.stop()
+        writer.close()
+        video.release()
+
+    processing_time = time.perf_counter() - start_time
+    return dict(
+        video=source_video,
+        frames=frames,
+        video_time=video_time,
+        processing_time=processing_time,
+        fps=frames / processing_time if processing_time > 0 else 0.0,
+    )
+
+
+def _write_objects(writer: ColumnarWriter, frame: int, tracked_objects: Dict, statuses: Dict, dangerous_objects):
+    rows = {column: [] for column in SCHEMA["objects"]}
+    for tid, t in tracked_objects.items():
+        x1, y1, x2, y2 = t.get_state()[0]
+        status = statuses.get(tid)
+        rows["frame"].append(frame)
+        rows["id"].append(tid)
+        rows["class"].append(t.label)
+        rows["x1"].append(x1)
+        rows["y1"].append(y1)
+        rows["x2"].append(x2)
+        rows["y2"].append(y2)
+        if status is not None:
+            rows["x"].append(status.location.x)
+            rows["y"].append(status.location.y)
+            rows["distance"].append(status.distance)
+            rows["time_to_collision"].append(np.nan if status.time_to_collision is None else status.time_to_collision)
+            rows["in_danger_zone"].append(status.is_in_danger_zone)
+            rows["crosses_danger_zone"].append(status.crosses_danger_zone)
+        else:
+            for column in ("x", "y", "distance", "time_to_collision"):
+                rows[column].append(np.nan)
+            rows["in_danger_zone"].append(False)
+            rows["crosses_danger_zone"].append(False)
+        rows["dangerous"].append(tid in dangerous_objects)
+    writer.extend("objects", **rows)
+
+
+def main(args=None):
+    args = parse_arguments()
+
+    config_dict = yaml.safe_load(args.config)
+    camera_dict = yaml.safe_load(args.camera)
+    logger.info(f"Processing {args.source_video} to {args.output}, batch {args.batch}")
+    summary = process_video(
+        config_dict,
+        camera_dict,
+        args.source_video,
+        args.output,
+        batch=args.batch,
+        prefetch=args.prefetch,
+        raw=args.raw,
+        fps=args.fps,
+        max_frames=args.max_frames,
+    )
+    logger.info(
+        f"{summary['frames']} frames processed in {summary['processing_time']:.1f}s ({summary['fps']:.1f} FPS), "
+        f"{summary['video_time'] / max(summary['processing_time'], 1e-9):.1f}x real time"
+    )
+    with open(f"{args.output}/summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,24 @@
 """
+Rendering of FCW state over camera images
+
+Static layers (coordinate grid, danger zone, horizon) are drawn with PIL once and cached as a single
+premultiplied BGRA overlay per camera and danger zone, see `static_overlay`. Per-frame primitives are drawn
+directly on BGR frames with OpenCV.
 """
 
-from typing import Iterable, List
+from functools import lru_cache
+import threading
+from typing import List, Sequence
+import weakref
 
+import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from shapely.geometry import LineString, Polygon
 import os.path
 from os import path
 
-from fcw_core import sort
-from fcw_core_utils.collision import PointWorldObject, ObjectStatus
+from fcw_core_utils.collision import ObjectStatus
 from fcw_core_utils.geometry import Camera
 
 this_dir, this_filename = os.path.split(__file__)
@@ -35,71 +43,6 @@ def draw_horizon(size: tuple, cam: Camera, **kwargs):
     return image
 
 
-def compose_layers(base: Image.Image, *layers: Iterable[tuple]):
-    for l, dest in layers:
-        base.alpha_composite(l, dest or (0, 0))
-
-
-def draw_image_trackers(
-    size: tuple,
-    trackers: List[sort.KalmanBoxTracker],
-):
-    """
-
-    """
-    image = Image.new("RGBA", size)
-    draw = ImageDraw.Draw(image)
-
-    for t in trackers:
-        x1, y1, x2, y2 = t.get_state()[0]
-        color = (0, 255, 0, 64)
-        outline = (0, 255, 0, 128)
-        if t.age < 3 or t.hit_streak == 0:  # TODO: call it.is_reliable()
-            color = (255, 255, 0, 32)
-            outline = None
-        draw.rectangle((x1, y1, x2, y2), fill=color, outline=outline)
-
-    return image
-
-
-def draw_world_objects(
-    size: tuple,
-    camera: Camera,
-    objects: Iterable[PointWorldObject]
-):
-    image = Image.new("RGBA", size)
-    draw = ImageDraw.Draw(image)
-
-    # for o in objects:
-    #     x1, y1, x2, y2 = tracked_objects[tid].get_state()[0]
-    #     # objects_draw.rectangle([x1, y1, x2, y2], outline=(255, 0, 0), width=2)
-    #     objects_draw.rectangle((x1, y1, x2, y2), fill=(255, 0, 0, 64))
-    #     dist = Point(o.location).distance(guard.vehicle_zone)
-    #     info = f"{dist:.1f} m"
-    #     objects_draw.text(
-    #         (0.5 * (x1 + x2), 0.5 * (y1 + y2)), info, align="center", font=font,
-    #         stroke_fill=(255, 255, 255), stroke_width=1, fill=(0, 0, 0)
-    #         )
-
-    for o in objects:
-
-        X = np.atleast_2d([o.kf.x[0, 0], o.kf.x[3, 0], 0])
-        scr_loc, _ = camera.project_points(X)
-        if scr_loc.size > 0:
-            x, y = scr_loc[0]
-            draw.line([(x - 10, y), (x + 10, y)], fill=(255, 255, 0, 128), width=3)
-            draw.line([(x, y - 10), (x, y + 10)], fill=(255, 255, 0, 128), width=3)
-
-        X = np.array(o.future_path(5).coords)
-        n = X.shape[0]
-        X = np.hstack([X, np.zeros((n, 1))])
-        scr_loc, _ = camera.project_points(X, near=5)
-        scr_loc = list(map(tuple, scr_loc))
-        draw.line(scr_loc, fill=(0, 255, 0, 255), width=1)
-
-    return image
-
-
 def draw_danger_zone(size: tuple, camera: Camera, zone: Polygon):
     image = Image.new("RGBA", size)
     draw = ImageDraw.Draw(image)
@@ -146,16 +89,10 @@ def draw_world_coordinate_system(size: tuple, camera: Camera):
     return image
 
 
-def tracking_info(
-    size: tuple,
-    object_status: List[ObjectStatus]
-):
-    image = Image.new("RGBA", size, color=(0, 0, 0, 255))
-    draw = ImageDraw.Draw(image)
-
-    info_text = f"Tracking {len(object_status)}"
-    draw.text((8, 0), info_text, fill=(255, 255, 255), font=_font)
-
+def tracking_status(object_status: List[ObjectStatus]) -> tuple:
+    """
+    Summary of object statuses displayed by `tracking_info`: (count, caution, warning, danger, ttc)
+    """
     caution_status = any(
         s.crosses_danger_zone for s in object_status
     )
@@ -168,6 +105,31 @@ def tracking_info(
         s.time_to_collision > 0 for s in object_status if s.time_to_collision is not None
     )
 
+    ttc = None
+    if danger_status:
+        ttc = round(min(
+            s.time_to_collision for s in object_status if s.time_to_collision is not None
+        ), 1)
+
+    return len(object_status), caution_status, warning_status, danger_status, ttc
+
+
+def tracking_info(
+    size: tuple,
+    object_status: List[ObjectStatus]
+):
+    return tracking_info_from_status(size, tracking_status(object_status))
+
+
+def tracking_info_from_status(size: tuple, status: tuple):
+    count, caution_status, warning_status, danger_status, ttc = status
+
+    image = Image.new("RGBA", size, color=(0, 0, 0, 255))
+    draw = ImageDraw.Draw(image)
+
+    info_text = f"Tracking {count}"
+    draw.text((8, 0), info_text, fill=(255, 255, 255), font=_font)
+
     caution_color = (255, 255, 0) if caution_status else (64, 64, 64)
     draw.text((100, 0), "CAUTION", fill=caution_color, font=_font, align="left")
 
@@ -178,9 +140,6 @@ def tracking_info(
     draw.text((260, 0), "DANGER", fill=danger_color, font=_font, align="left")
 
     if danger_status:
-        ttc = min(
-            s.time_to_collision for s in object_status if s.time_to_collision is not None
-        )
         draw.text((320, 0), f"ttc = {ttc:0.1f} s", fill=(255, 0, 0), font=_font, align="left")
 
     return image
@@ -215,16 +174,163 @@ def vehicle_marker_image(scale: int = 1):
     return marker_image.resize((w * scale, h * scale), Image.NEAREST), (7 * scale, 0)
 
 
+class Overlay:
+    """
+    Premultiplied BGRA image blended over BGR frames
+    """
+
+    def __init__(self, rgba: np.ndarray):
+        """
+        rgba : (H,W,4) uint8 image with straight alpha
+        """
+        bgr = np.ascontiguousarray(rgba[..., 2::-1])
+        alpha = cv2.merge([rgba[..., 3]] * 3)
+        self.bgr = cv2.multiply(bgr, alpha, scale=1 / 255)
+        self.inv_alpha = cv2.subtract(255, alpha)
+        self.size = rgba.shape[1], rgba.shape[0]
+
+    @staticmethod
+    def from_pil(image: Image.Image) -> "Overlay":
+        return Overlay(np.asarray(image.convert("RGBA")))
+
+    def blend(self, image: np.ndarray, x: int = 0, y: int = 0):
+        """
+        Blend the overlay over BGR image in place with top-left corner at (x, y), clipped to the image
+        """
+        w, h = self.size
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, image.shape[1]), min(y + h, image.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        roi = image[y0:y1, x0:x1]
+        src = np.s_[y0 - y : y1 - y, x0 - x : x1 - x]
+        cv2.multiply(roi, self.inv_alpha[src], dst=roi, scale=1 / 255)
+        cv2.add(roi, self.bgr[src], dst=roi)
+
+
+# Camera -> {danger zone WKB: Overlay}
+_static_overlays = weakref.WeakKeyDictionary()
+_static_overlays_lock = threading.Lock()
+
+
+def static_overlay(camera: Camera, zone: Polygon) -> Overlay:
+    """
+    Coordinate grid, danger zone and horizon composed into single overlay of rectified_size, cached
+    """
+    with _static_overlays_lock:
+        overlays = _static_overlays.setdefault(camera, {})
+        overlay = overlays.get(zone.wkb)
+        if overlay is None:
+            size = tuple(camera.rectified_size)
+            image = draw_world_coordinate_system(size, camera)
+            image.putalpha(64)
+            image.alpha_composite(draw_danger_zone(size, camera, zone))
+            image.alpha_composite(draw_horizon(size, camera, width=1, fill=(255, 255, 0, 64)))
+            overlay = overlays[zone.wkb] = Overlay.from_pil(image)
+    return overlay
+
+
+def blend_rect(image: np.ndarray, x1, y1, x2, y2, color: tuple, alpha: float):
+    """
+    Fill rectangle (inclusive corners) in BGR image with color of given opacity, clipped to the image
+    """
+    h, w = image.shape[:2]
+    x1, y1 = max(int(x1), 0), max(int(y1), 0)
+    x2, y2 = min(int(x2), w - 1), min(int(y2), h - 1)
+    if x1 > x2 or y1 > y2:
+        return
+    roi = image[y1 : y2 + 1, x1 : x2 + 1]
+    cv2.multiply(roi, (1 - alpha,) * 3, dst=roi)
+    cv2.add(roi, tuple(c * alpha for c in color), dst=roi)
+
+
+def draw_image_trackers(image: np.ndarray, boxes: np.ndarray, reliable: Sequence[bool]):
+    """
+    Draw tracker boxes (N,4) [x1, y1, x2, y2] in BGR image, unreliable trackers are faint
+    """
+    for (x1, y1, x2, y2), r in zip(boxes, reliable):
+        if r:
+            blend_rect(image, x1, y1, x2, y2, (0, 255, 0), 0.25)
+            # Outline
+            for rect in ((x1, y1, x2, y1), (x1, y2, x2, y2), (x1, y1 + 1, x1, y2 - 1), (x2, y1 + 1, x2, y2 - 1)):
+                blend_rect(image, *rect, (0, 255, 0), 0.5)
+        else:
+            blend_rect(image, x1, y1, x2, y2, (0, 255, 255), 0.125)
+
+
+def draw_world_objects(
+    image: np.ndarray,
+    camera: Camera,
+    locations: np.ndarray,
+    paths: List[np.ndarray],
+    to_rectified: bool = True,
+):
+    """
+    Draw object locations (N,2) as crosses and their future paths (list of (M,2)) in BGR image
+
+    All points are projected by single call of camera.project_points.
+    """
+    if len(locations) == 0:
+        return
+    locations = np.asarray(locations, np.float64).reshape(-1, 2)
+    n = locations.shape[0]
+    lengths = [len(p) for p in paths]
+    X = np.vstack([locations] + [np.asarray(p, np.float64).reshape(-1, 2) for p in paths])
+    X = np.hstack([X, np.zeros((X.shape[0], 1))])
+    # Validity is evaluated per primitive, locations are in front of camera, paths further than 5 m
+    x, d = camera.project_points(X, near=-np.inf, to_rectified=to_rectified)
+
+    for (cx, cy), depth in zip(x[:n], d[:n]):
+        if depth > 0:
+            blend_rect(image, cx - 10, cy - 1, cx + 10, cy + 1, (0, 255, 255), 0.5)
+            blend_rect(image, cx - 1, cy - 10, cx + 1, cy - 2, (0, 255, 255), 0.5)
+            blend_rect(image, cx - 1, cy + 2, cx + 1, cy + 10, (0, 255, 255), 0.5)
+
+    polylines = []
+    offsets = np.cumsum([n] + lengths)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        pts = x[start:end][d[start:end] > 5]
+        if pts.shape[0] > 1:
+            polylines.append(np.round(pts).astype(np.int32))
+    if polylines:
+        cv2.polylines(image, polylines, False, (0, 255, 0), 1, cv2.LINE_AA)
+
+
 def mark_vehicles(
-    size: tuple, objects: Iterable[PointWorldObject], camera: Camera, marker: Image, anchor: tuple = (0, 0)
+    image: np.ndarray,
+    camera: Camera,
+    locations: np.ndarray,
+    marker: Overlay,
+    anchor: tuple = (0, 0),
+    to_rectified: bool = False,
 ):
-    image = Image.new("RGBA", size, color=(0, 0, 0, 0))
+    """
+    Blend marker over BGR image at projected object locations (N,2)
+    """
+    if len(locations) == 0:
+        return
+    X = np.hstack([np.asarray(locations, np.float64).reshape(-1, 2), np.zeros((len(locations), 1))])
+    x, _ = camera.project_points(X, near=1, to_rectified=to_rectified)
     ax, ay = anchor
-    # loc (N,2) xy
-    for o in objects:
-        X = np.atleast_2d([o.kf.x[0, 0], o.kf.x[3, 0], 0])
-        scr_loc, _ = camera.project_points(X, near=1, to_rectified=False)
-        if scr_loc.shape[0] > 0:
-            x, y = scr_loc[0]
-            image.paste(marker, (int(x - ax), int(y - ay)))
-    return image
+    for cx, cy in x:
+        marker.blend(image, int(cx - ax), int(cy - ay))
+
+
+@lru_cache(maxsize=256)
+def _tracking_info_strip(width: int, status: tuple) -> np.ndarray:
+    return np.asarray(tracking_info_from_status((width, 16), status).convert("RGB"))[..., ::-1].copy()
+
+
+def draw_tracking_info(image: np.ndarray, object_status: List[ObjectStatus]):
+    """
+    Copy status strip to the top of BGR image, strips are cached by displayed state
+    """
+    draw_tracking_status(image, tracking_status(object_status))
+
+
+def draw_tracking_status(image: np.ndarray, status: tuple):
+    """
+    Copy status strip for summary from `tracking_status` to the top of BGR image
+    """
+    strip = _tracking_info_strip(image.shape[1], status)
+    image[: strip.shape[0]] = strip
@@ -18,10 +18,12 @@ import torch
 from shapely.geometry import box
 import gc
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 from fcw_core.detection import ObjectObservation
+from fcw_core_utils.geometry import fit_size
 
 
 class YOLODetector:
@@ -39,19 +41,13 @@ class YOLODetector:
         self.model = torch.hub.load("ultralytics/yolov5", model, pretrained=True, trust_repo=True)
         self.model.agnostic = False
         self.model.iou = 0.7
-        classes = classes or YOLODetector.default_classes
-        if classes is not None:
-            # Init detected classes
-            # Inverted name index: name -> class_id
-            name_idx = dict(((name, class_id) for class_id, name in self.model.names.items()))
-            # List class_id specified by names in classes passed as parameter, ignoring unknown classes
-            self.model.classes = [
-                name_idx[nm] for nm in classes if nm in name_idx
-            ] or None  # ... or None - in case og empty list leave None value not empty list
+        self.set_classes(classes)
         self.model.conf = min_score
         self.max_size = max_size
         self.filter_in_frame = filter_in_frame
         self.min_area = min_area
+        # Durations [ns] of stages of the last detection - preprocess, inference, postprocess
+        self.timings: Dict[str, int] = {}
 
     def __del__(self):
         self.memory_stats()
@@ -62,6 +58,30 @@ class YOLODetector:
         torch.cuda.empty_cache()
         self.memory_stats()
 
+    def set_classes(self, classes: Iterable[str] = None):
+        """
+        Set detected classes by names, default_classes when None
+        """
+        classes = classes or YOLODetector.default_classes
+        if classes is not None:
+            # Init detected classes
+            # Inverted name index: name -> class_id
+            name_idx = dict(((name, class_id) for class_id, name in self.model.names.items()))
+            # List class_id specified by names in classes passed as parameter, ignoring unknown classes
+            self.model.classes = [
+                name_idx[nm] for nm in classes if nm in name_idx
+            ] or None  # ... or None - in case og empty list leave None value not empty list
+
+    def configure(self, d: Dict):
+        """
+        Apply configuration (see from_dict) except the model in place, the model is not reloaded
+        """
+        self.set_classes(d.get("classes"))
+        self.model.conf = d.get("min_score", 0.3)
+        self.max_size = d.get("max_size", 1024)
+        self.filter_in_frame = d.get("filter_in_frame", False)
+        self.min_area = d.get("min_area")
+
     @staticmethod
     def memory_stats():
         logger.info(f"torch.cuda.memory_allocated(): {torch.cuda.memory_allocated() / 1024 ** 2}")
@@ -78,20 +98,60 @@ class YOLODetector:
             min_area=d.get("min_area"),
         )
 
-    def detect(self, image):
-        h, w = image.shape[:2]
-        if max(h, w) > self.max_size:
-            scale = max(h, w) / self.max_size  # shape (1080, 1920), max_size=960 -> scale=1920/960 = 2
-            dst_size = (int(w // scale), int(h // scale))
-            image = cv2.resize(image, dst_size, interpolation=cv2.INTER_LINEAR)
-        else:
-            scale = 1
+    def input_size(self, size):
+        """
+        Size (w,h) to which the detector resizes images of given size
+
+        Images already of this size are passed to the model without resampling.
+        """
+        return fit_size(size, self.max_size)
+
+    def detect(self, image, scale: float = 1):
+        """
+        image : image in detector input size, or larger which is resized
+        scale : scale of detection coordinates, e.g. rectified_size / image size when image was rectified
+            directly to detector input size, so boxes are rescaled exactly once
+        """
+        return self.detect_batch([image], [scale])[0]
+
+    def detect_batch(self, images, scales=None):
+        """
+        Detect objects in several images (e.g. of several cameras) by one model call
+
+        images : images, see detect
+        scales : scales of detection coordinates of the images, see detect, 1 by default
+        """
+        t0 = time.perf_counter_ns()
+        scales = list(scales) if scales is not None else [1] * len(images)
+        inputs = []
+        frame_shapes = []
+        for i, image in enumerate(images):
+            h, w = image.shape[:2]
+            # Frame size in coordinates of detections
+            frame_shapes.append((h * scales[i], w * scales[i]))
+            dst_size = self.input_size((w, h))
+            if dst_size != (w, h):
+                image = cv2.resize(image, dst_size, interpolation=cv2.INTER_LINEAR)
+                # Detections are rescaled to the original image and by requested scale at once
+                scales[i] *= max(h, w) / self.max_size
+            inputs.append(np.transpose(image, [2, 0, 1]))
+        t1 = time.perf_counter_ns()
 
         # Run detection
-        res = self.model(np.transpose(image, [2, 0, 1]))
-
-        # Convert detections
-        det = res.xyxy[0].cpu().numpy()
+        res = self.model(inputs if len(inputs) > 1 else inputs[0])
+        t2 = time.perf_counter_ns()
+
+        all_detections = [
+            self._convert(det, scale, frame_shape) for det, scale, frame_shape in zip(res.xyxy, scales, frame_shapes)
+        ]
+        self.timings = {"preprocess": t1 - t0, "inference": t2 - t1, "postprocess": time.perf_counter_ns() - t2}
+        return all_detections
+
+    def _convert(self, det, scale: float, frame_shape):
+        """
+        Filtered detections of one image from model output
+        """
+        det = det.cpu().numpy()
         rects, scores, labels = np.split(det, [4, 5], axis=1)
         labels = labels.ravel().astype(np.int32).tolist()
         scores = scores.ravel().tolist()
@@ -111,7 +171,7 @@ class YOLODetector:
 
         # Filter objects that are in the frame
         if self.filter_in_frame:
-            is_in_frame = lambda d: d.is_in_frame((h, w), margin=10)
+            is_in_frame = lambda d: d.is_in_frame(frame_shape, margin=10)
             all_detections = filter(is_in_frame, all_detections)
 
         # Filter objects with sufficient size
@@ -20,6 +20,9 @@ OUTPUT_TOPIC = str(os.getenv("OUTPUT_TOPIC", "/res"))
 
 NETAPP_INPUT_QUEUE = int(os.getenv("NETAPP_INPUT_QUEUE", 1))
 
+# Config sections applied to running worker by CollisionWorker.reconfigure, other changes start new worker.
+RECONFIGURABLE_SECTIONS = ("detector", "tracker", "fcw", "slo")
+
 
 class Worker(CollisionWorker):
     """Worker class."""
@@ -33,6 +36,7 @@ class Worker(CollisionWorker):
         fps: float,
         viz: bool,
         viz_zmq_port: int,
+        is_rectified: bool = True,
         **kw,
     ) -> None:
         super().__init__(
@@ -43,6 +47,7 @@ class Worker(CollisionWorker):
             fps=fps,
             viz=viz,
             viz_zmq_port=viz_zmq_port,
+            is_rectified=is_rectified,
             **kw,
         )
         self.publisher = publisher
@@ -129,13 +134,19 @@ class FCWServiceNode(rclpy.node.Node):
             fps=self.config_dict.get("fps", 30),
             viz=self.config_dict.get("visualization", False),
             viz_zmq_port=self.config_dict.get("viz_zmq_port", 5558),
+            viz_fps=self.config_dict.get("viz_fps"),
+            viz_max_size=self.config_dict.get("viz_max_size"),
+            viz_codec=self.config_dict.get("viz_codec", "raw"),
+            results_profile=self.config_dict.get("results_profile", "full"),
+            is_rectified=self.config_dict.get("is_rectified", True),
             daemon=True,
         )
         # Start worker.
         self.worker.start()
 
     def parameter_callback(self, parameters: List[rclpy.Parameter]) -> SetParametersResult:
-        """Parameter callback - ROS 2 parameter service used for FCW parameters. Starts new Worker with new parameters.
+        """Parameter callback - ROS 2 parameter service used for FCW parameters. Changes of detector, tracker, FCW
+        and SLO sections and of camera config are applied to the running Worker, other changes start new Worker.
 
         Args:
             parameters (List[rclpy.Parameter]): FCW parameters.
@@ -153,14 +164,23 @@ class FCWServiceNode(rclpy.node.Node):
 
             parameters_dict = parameters_to_dict(parameters_dict)
 
+            old_config_dict = self.config_dict
             self.config_dict = parameters_dict.get("config", self.config_dict)
             self.camera_config_dict = parameters_dict.get("camera_config", self.camera_config_dict)
             print(self.config_dict)
             print(self.camera_config_dict)
 
+            is_reconfigurable = all(
+                self.config_dict.get(key) == old_config_dict.get(key)
+                for key in set(self.config_dict) | set(old_config_dict)
+                if key not in RECONFIGURABLE_SECTIONS
+            )
             # Start worker only with camera config.
             if self.camera_config_dict:
-                self.start()
+                if self.worker is not None and self.worker.is_alive() and is_reconfigurable:
+                    self.worker.reconfigure(self.config_dict, self.camera_config_dict)
+                else:
+                    self.start()
         except Exception as ex:
             self.get_logger().error(f"Parameter callback exception: {repr(ex)}")
             return SetParametersResult(successful=False)
@@ -1,9 +1,9 @@
+import os
 import time
-from dataclasses import asdict
 from multiprocessing import Queue
 from queue import Empty
-from threading import Thread, Event
-from typing import Callable, Any
+from threading import Thread, Event, Lock
+from typing import Callable, Any, List, Optional, Tuple
 
 import zmq
 from zmq import ZMQError
@@ -13,9 +13,19 @@ from fcw_core.detection import *
 from fcw_core.sort import Sort, KalmanBoxTracker
 from fcw_core.yolo_detector import YOLODetector
 from fcw_core_utils.collision import *
+from fcw_core_utils.results_codec import ENCODINGS, PROFILES, pack_message
+from fcw_core_utils.results_delta import DeltaEncoder
+from fcw_service.latency_controller import DetectorLevel, LatencyController
+from fcw_service.metrics import FRAME_AGE_BOUNDS_MS, BucketHistogram, StageMetrics, Summary
+from fcw_service.profiler import SamplingProfiler
+from fcw_service.viz_transport import VizPublisher
 
 logger = logging.getLogger(__name__)
 
+# Number of consecutive ports tried from viz_zmq_port when publishing visualization, the visualization service
+# subscribes to the whole range.
+VIZ_PORT_RANGE = int(os.getenv("VIZ_PORT_RANGE", 16))
+
 
 class CollisionWorker(Thread):
     """FCW worker. Reads data from passed queue, performs FCW processing and returns results using callback."""
@@ -30,6 +40,16 @@ class CollisionWorker(Thread):
         send_error_function: Callable[[Dict[str, Any]], None] = None,
         viz: bool = False,
         viz_zmq_port: int = 5558,
+        is_rectified: bool = True,
+        viz_session: Optional[str] = None,
+        viz_fps: Optional[float] = None,
+        viz_max_size: Optional[int] = None,
+        viz_codec: str = "raw",
+        results_profile: str = "full",
+        results_encoding: str = "json",
+        results_keyframe_interval: int = 0,
+        max_frame_age: Optional[float] = None,
+        detector: Optional[YOLODetector] = None,
         **kw,
     ) -> None:
         """Constructor.
@@ -42,40 +62,115 @@ class CollisionWorker(Thread):
             fps (float): Framerate.
             send_error_function (Callable[[Dict], None]): Callback used to send errors.
             viz (bool): Enable visualization?
-            viz_zmq_port (int): Visualization ZeroMQ port.
+            viz_zmq_port (int): Visualization ZeroMQ port. The first free port of VIZ_PORT_RANGE ports from
+                viz_zmq_port is used.
+            is_rectified (bool): Are received images rectified? If False, detection and tracking run on distorted
+                images and only reference points are undistorted.
+            viz_session (str, optional): Session name in visualization, the thread name by default.
+            viz_fps (float, optional): Maximal visualization frame rate, independent of processing rate. Unlimited
+                by default.
+            viz_max_size (int, optional): Visualization images are downscaled to fit this size. Not scaled by default.
+            viz_codec (str): Visualization image encoding - raw (default), jpeg or h264. Compressed images are
+                encoded by a background thread.
+            results_profile (str): Content of results - alerts-only, objects or full (default), see
+                fcw_core_utils.results_codec.PROFILES.
+            results_encoding (str): Encoding of results - json (default) or compact binary.
+            results_keyframe_interval (int): Send delta-encoded results with full state every
+                results_keyframe_interval frames, see fcw_core_utils.results_delta. Disabled if 0 (default). Delta
+                encoding is JSON only.
+            max_frame_age (float, optional): Maximal age of frame [s] (since it was received), older frames are
+                dropped before detection. Frames are not dropped for age by default.
+            detector (YOLODetector, optional): Pre-loaded detector of the detector configuration (see
+                fcw_service.warm_pool), loaded by the worker by default.
             **kw: Thread arguments.
         """
 
         super().__init__(**kw)
 
+        if results_profile not in PROFILES:
+            raise ValueError(f"Unknown results profile {results_profile}, use one of {list(PROFILES)}")
+        if results_encoding not in ENCODINGS:
+            raise ValueError(f"Unknown results encoding {results_encoding}, use one of {list(ENCODINGS)}")
+        if results_keyframe_interval > 0 and results_encoding != "json":
+            raise ValueError("Delta-encoded results can not be combined with binary encoding")
+        self._results_profile = results_profile
+        self._results_encoding = results_encoding
+        self._delta_encoder = DeltaEncoder(results_keyframe_interval) if results_keyframe_interval > 0 else None
+
         self._stop_event = Event()
+        # Held while a frame is processed, configuration is switched between frames (see reconfigure).
+        self._config_lock = Lock()
+        # Set when the worker loop runs.
+        self.running = Event()
         self.image_queue = image_queue
         self._send_function = send_function
         self._send_error_function = send_error_function
         self._frame_id = 0
         self.latency_measurements: LatencyMeasurements = LatencyMeasurements()
+        # Stale frames are dropped, only the latest waiting frame is processed.
+        self._max_frame_age = max_frame_age
+        self.dropped_frames = 0
+        self.frame_ages = BucketHistogram(FRAME_AGE_BOUNDS_MS)
+        # Frames dropped before the worker, reported by the server in metadata.
+        self._ingest_dropped_frames = 0
+        # Durations of processing stages.
+        self.stage_metrics = StageMetrics()
+        # Sampling profiler, runs only on request.
+        self._profiler: Optional[SamplingProfiler] = None
         self._viz = viz
-
-        logger.info("Initializing object detector")
-        self._detector = YOLODetector.from_dict(config.get("detector", {}))
+        self._is_rectified = is_rectified
+
+        self._detector_config = config.get("detector", {})
+        if detector is not None:
+            self._detector = detector
+        else:
+            logger.info("Initializing object detector")
+            self._detector = YOLODetector.from_dict(self._detector_config)
         logger.info("Initializing image tracker")
         self._tracker = Sort.from_dict(config.get("tracker", {}))
         logger.info("Initializing forward collision guard")
         self._guard = ForwardCollisionGuard.from_dict(config.get("fcw", {}))
         self._guard.dt = 1 / fps
+        self._fps = fps
+        # Latency-SLO controller switching detector levels, loaded detectors by model name.
+        self._controller = LatencyController.from_dict(config.get("slo", {}), self._detector_config, self.name)
+        self._detectors: Dict[str, YOLODetector] = {self._detector_config.get("model", "yolov5n6"): self._detector}
+        self._loading: Optional[Thread] = None
+        # Incremented by reconfiguration of the detector, detectors loaded for older configuration are dropped.
+        self._detector_generation = 0
+        self._failed_models = set()
+        self._cadence = 1
+        self._last_results: Optional[Dict[str, Any]] = None
         logger.info("Initializing camera calibration")
         self._camera = Camera.from_dict(camera_config)
-        self._config = dict(config=config, camera_config=camera_config)
+        self._config = dict(config=config, camera_config=camera_config, is_rectified=is_rectified)
 
         # Visualization stuff.
+        self.viz_session = viz_session or self.name
+        self.viz_zmq_port = None
         if self._viz:
-            try:
-                self._context = zmq.Context()
-                self._socket = self._context.socket(zmq.PUB)
-                logger.info(f"Publishing visualization on ZeroMQ tcp://*:{viz_zmq_port}")
-                self._socket.bind("tcp://*:%s" % viz_zmq_port)
-            except ZMQError as e:
-                logger.error(f"Visualization was disabled on this worker: {e}")
+            self._context = zmq.Context()
+            # XPUB tracks subscribers, the visualization work is skipped when nobody watches.
+            self._socket = self._context.socket(zmq.XPUB)
+            # Sessions share the port range, take the first free port.
+            for port in range(viz_zmq_port, viz_zmq_port + VIZ_PORT_RANGE):
+                try:
+                    self._socket.bind("tcp://*:%s" % port)
+                except ZMQError:
+                    continue
+                self.viz_zmq_port = port
+                logger.info(f"Publishing visualization of session {self.viz_session} on ZeroMQ tcp://*:{port}")
+                self._viz_publisher = VizPublisher(
+                    self._socket, self.viz_session, viz_fps, viz_max_size, viz_codec
+                )
+                self._viz_publisher.set_config(self._config)
+                break
+            else:
+                logger.error(
+                    f"Visualization was disabled on this worker: no free port in {viz_zmq_port}-"
+                    f"{viz_zmq_port + VIZ_PORT_RANGE - 1}"
+                )
+                self._socket.close()
                 self._viz = False
 
     def stop(self) -> None:
@@ -91,42 +186,311 @@ class CollisionWorker(Thread):
         """FCW worker loop. Periodically reads images from python internal queue process them."""
 
         logger.info(f"{self.name} thread is running.")
+        self.running.set()
 
         while not self._stop_event.is_set():
             # Get image and metadata from input queue.
             metadata: Dict[str, Any]
             image: np.ndarray
+            queue_occupancy = self._queue_occupancy()
             try:
                 metadata, image = self.image_queue.get(block=True, timeout=1)
             except Empty:
                 continue
+            metadata, image = self._latest_frame(metadata, image)
+            if self._is_stale(metadata):
+                continue
             # Store timestamp before processing.
             metadata["timestamp_before_process"] = time.perf_counter_ns()
+            self.stage_metrics.record("queue_wait", metadata["timestamp_before_process"] - metadata["recv_timestamp"])
             self._frame_id += 1
             # logger.info(f"Worker received frame id: {self.frame_id} {metadata['timestamp']}")
-            try:
-                detections = self._process_image(image)
-                # Store timestamp after processing.
-                metadata["timestamp_after_process"] = time.perf_counter_ns()
-                # Generate results.
-                results = self._generate_results(detections, metadata)
-                # Send results via the provided callback.
-                self._send_function(results)
-
-                self.latency_measurements.store_latency(time.perf_counter_ns() - metadata["recv_timestamp"])
-
-                if self._viz:
-                    # If visualisation is enabled, send image with results over ZeroMQ.
-                    self._send_image_with_results(image, results)
-
-            except Exception as ex:
-                logger.error(f"Exception with image processing ({type(ex)}): {repr(ex)}")
-                if self._send_error_function:
-                    self._send_error_function({"message": f"Exception with image processing ({type(ex)}): {repr(ex)}"})
-                raise ex
+            # Configuration is switched between frames.
+            with self._config_lock:
+                try:
+                    repeated = self._last_results is not None and self._frame_id % self._cadence != 0
+                    if repeated:
+                        # Detection is skipped on this frame, results of the last processed frame are repeated.
+                        metadata["timestamp_after_process"] = time.perf_counter_ns()
+                        results = self._repeat_results(metadata)
+                    else:
+                        detections = self._process_image(image)
+                        # Store timestamp after processing.
+                        metadata["timestamp_after_process"] = time.perf_counter_ns()
+                        # Generate results.
+                        results = self._generate_results(detections, metadata)
+                        self._last_results = results
+                        self.stage_metrics.record(
+                            "labeling", time.perf_counter_ns() - metadata["timestamp_after_process"]
+                        )
+                    self._ingest_dropped_frames = metadata.get("dropped_frames", self._ingest_dropped_frames)
+                    results["dropped_frames"] = self._ingest_dropped_frames + self.dropped_frames
+                    results["frame_age_histogram"] = self.frame_ages.as_dict()
+                    # Send results via the provided callback.
+                    t0 = time.perf_counter_ns()
+                    if self._delta_encoder is not None:
+                        message = self._delta_encoder.encode(results)
+                    else:
+                        message = pack_message(results, self._results_encoding)
+                    t1 = time.perf_counter_ns()
+                    self._send_function(message)
+                    t2 = time.perf_counter_ns()
+                    self.stage_metrics.record("serialization", t1 - t0)
+                    self.stage_metrics.record("send", t2 - t1)
+                    self.stage_metrics.record("total", t2 - metadata["recv_timestamp"])
+
+                    if not repeated:
+                        # Repeated results have no inference in their latency, they would bias the measurements.
+                        self.latency_measurements.store_latency(t2 - metadata["recv_timestamp"])
+                        if self._controller is not None:
+                            self._controller.update(t2 - metadata["recv_timestamp"], queue_occupancy)
+                            self._apply_level(self._controller.current)
+
+                    if self._viz and self._viz_publisher.ready():
+                        # If visualisation is enabled and watched, send image with results over ZeroMQ.
+                        t0 = time.perf_counter_ns()
+                        self._send_image_with_results(image, results)
+                        self.stage_metrics.record("viz_publish", time.perf_counter_ns() - t0)
+
+                except Exception as ex:
+                    logger.error(f"Exception with image processing ({type(ex)}): {repr(ex)}")
+                    if self._send_error_function:
+                        self._send_error_function(
+                            {"message": f"Exception with image processing ({type(ex)}): {repr(ex)}"}
+                        )
+                    raise ex
+
+        if self._viz:
+            # Release the port for other sessions.
+            self._viz_publisher.close()
+            self._socket.close(linger=0)
 
         logger.info(f"{self.name} thread is stopping.")
 
+    def _latest_frame(self, metadata: Dict[str, Any], image: np.ndarray) -> Tuple[Dict[str, Any], np.ndarray]:
+        """Take the latest frame waiting in the input queue, older frames are dropped.
+
+        Args:
+            metadata (Dict[str, Any]): Metadata of frame taken from the queue.
+            image (np.ndarray): Image taken from the queue.
+
+        Returns:
+            Metadata and image of the latest frame.
+        """
+
+        while True:
+            try:
+                newer = self.image_queue.get_nowait()
+            except Empty:
+                return metadata, image
+            self._record_age(metadata)
+            self.dropped_frames += 1
+            metadata, image = newer
+
+    def _record_age(self, metadata: Dict[str, Any]) -> int:
+        age = time.perf_counter_ns() - metadata.get("recv_timestamp", 0)
+        self.frame_ages.add(age * 1.0e-6)
+        return age
+
+    def _is_stale(self, metadata: Dict[str, Any]) -> bool:
+        """Record age of the frame and check it against the maximal age, stale frames are counted as dropped.
+
+        Args:
+            metadata (Dict[str, Any]): Metadata of the frame.
+
+        Returns:
+            True if the frame should be dropped.
+        """
+
+        age = self._record_age(metadata)
+        if self._max_frame_age is not None and age > self._max_frame_age * 1.0e9:
+            self.dropped_frames += 1
+            logger.debug(f"{self.name}: dropped frame {age * 1.0e-6:.0f} ms old")
+            return True
+        return False
+
+    def reconfigure(self, config: Dict, camera_config: Dict) -> List[str]:
+        """Apply new FCW and camera config to the running worker. Only the changed components are rebuilt - tracker
+        and guard parameters are set in place (tracks are kept), detector thresholds are applied to the loaded model
+        and the model is loaded only if it changed. New components are prepared in the calling thread and switched
+        atomically between frames.
+
+        Args:
+            config (Dict): FCW config.
+            camera_config (Dict): Camera config.
+
+        Returns:
+            Names of reconfigured components.
+        """
+
+        old_config = self._config["config"]
+        changed = []
+        detector_config = config.get("detector", {})
+        detector = None
+        if detector_config != self._detector_config:
+            changed.append("detector")
+            if detector_config.get("model", "yolov5n6") != self._detector_config.get("model", "yolov5n6"):
+                logger.info(f"{self.name}: loading detector {detector_config.get('model', 'yolov5n6')}")
+                detector = YOLODetector.from_dict(detector_config)
+        tracker = None
+        if config.get("tracker", {}) != old_config.get("tracker", {}):
+            changed.append("tracker")
+            tracker = Sort.from_dict(config.get("tracker", {}))
+        guard = None
+        if config.get("fcw", {}) != old_config.get("fcw", {}):
+            changed.append("guard")
+            guard = ForwardCollisionGuard.from_dict(config.get("fcw", {}))
+        camera = None
+        if camera_config != self._config["camera_config"]:
+            changed.append("camera")
+            camera = Camera.from_dict(camera_config)
+        controller = self._controller
+        if config.get("slo", {}) != old_config.get("slo", {}):
+            changed.append("slo")
+        if "detector" in changed or "slo" in changed:
+            # Ladder of the controller is derived from the detector config.
+            controller = LatencyController.from_dict(config.get("slo", {}), detector_config, self.name)
+
+        with self._config_lock:
+            if "detector" in changed:
+                if detector is not None:
+                    self._detector = detector
+                    self._failed_models = set()
+                else:
+                    # Models of the controller levels are dropped, they have old thresholds.
+                    self._detector = self._detectors.get(self._detector_config.get("model", "yolov5n6"), self._detector)
+                self._detector.configure(detector_config)
+                self._detector_config = detector_config
+                self._detectors = {detector_config.get("model", "yolov5n6"): self._detector}
+                # Running load has the old configuration, its detector is dropped.
+                self._detector_generation += 1
+                self._loading = None
+            if tracker is not None:
+                self._tracker.max_age = tracker.max_age
+                self._tracker.min_hits = tracker.min_hits
+                self._tracker.iou_threshold = tracker.iou_threshold
+            if guard is not None:
+                self._guard.danger_zone = guard.danger_zone
+                self._guard.vehicle_zone = guard.vehicle_zone
+                self._guard.safety_radius = guard.safety_radius
+                self._guard.prediction_length = guard.prediction_length
+                self._guard.prediction_step = guard.prediction_step
+            if camera is not None:
+                self._camera = camera
+            if controller is not self._controller:
+                self._controller = controller
+                self._cadence = 1
+                self._guard.dt = 1 / self._fps
+            self._config = dict(self._config, config=config, camera_config=camera_config)
+            if self._viz:
+                self._viz_publisher.set_config(self._config)
+
+        logger.info(f"{self.name}: reconfigured {', '.join(changed) or 'nothing'}")
+        return changed
+
+    def metrics_summary(self) -> Dict[str, Summary]:
+        """Summaries of durations of processing stages, see fcw_service.metrics.StageMetrics."""
+
+        return self.stage_metrics.summary()
+
+    def start_profiling(self, duration: float, output_dir: str, tag: Optional[str] = None) -> bool:
+        """Profile the worker thread by a sampling profiler for the duration, see fcw_service.profiler.
+
+        Args:
+            duration (float): Profiling duration [s].
+            output_dir (str): Directory of collapsed stacks and per-function summary files.
+            tag (str, optional): Tag of output files (session id), the thread name by default.
+
+        Returns:
+            False if the worker is not running or it is being profiled already.
+        """
+
+        if not self.is_alive() or (self._profiler is not None and self._profiler.is_running()):
+            return False
+        self._profiler = SamplingProfiler(self.ident, tag or self.name.replace(" ", "_"), output_dir)
+        self._profiler.start(duration)
+        return True
+
+    def _queue_occupancy(self) -> float:
+        """Occupancy of the input queue, 1 if it is full."""
+
+        maxsize = getattr(self.image_queue, "maxsize", 0)
+        return self.image_queue.qsize() / maxsize if maxsize > 0 else 0.0
+
+    def _apply_level(self, level: DetectorLevel) -> None:
+        """Use detector configuration of the controller level. A model which is not loaded yet is loaded by
+        a background thread, the current detector is used meanwhile.
+
+        Args:
+            level (DetectorLevel): Detector level.
+        """
+
+        if self._cadence != level.cadence:
+            # Tracked objects move between detections for cadence frames, motion models of existing objects are
+            # switched by the guard.
+            self._cadence = level.cadence
+            self._guard.dt = level.cadence / self._fps
+        detector = self._detectors.get(level.model)
+        if detector is None:
+            loading = self._loading is not None and self._loading.is_alive()
+            if not loading and level.model not in self._failed_models:
+                self._loading = Thread(
+                    target=self._load_detector,
+                    args=(level.model, dict(self._detector_config), self._detector_generation),
+                    name=f"{self.name} detector loader",
+                    daemon=True,
+                )
+                self._loading.start()
+            detector = self._detector
+        elif detector is not self._detector:
+            logger.info(f"{self.name}: using detector {level.model}")
+            self._detector = detector
+        detector.max_size = level.max_size
+
+    def _load_detector(self, model: str, detector_config: Dict, generation: int) -> None:
+        """Load detector of the model with detector configuration of the given generation. The detector is dropped
+        if the worker was reconfigured meanwhile.
+
+        Args:
+            model (str): Model name.
+            detector_config (Dict): Detector configuration when the load started.
+            generation (int): Detector configuration generation when the load started.
+        """
+
+        logger.info(f"{self.name}: loading detector {model}")
+        try:
+            detector = YOLODetector.from_dict(dict(detector_config, model=model))
+        except Exception as ex:
+            logger.error(f"{self.name}: failed to load detector {model}: {repr(ex)}")
+            with self._config_lock:
+                if generation == self._detector_generation:
+                    self._failed_models.add(model)
+            return
+        with self._config_lock:
+            if generation != self._detector_generation:
+                logger.info(f"{self.name}: detector {model} dropped, the worker was reconfigured")
+                return
+            self._detectors[model] = detector
+
+    def _repeat_results(self, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Results of the last processed frame with timestamps of the current frame.
+
+        Args:
+            metadata (Dict[str, Any]): 5G-ERA Network Application specific metadata related to the current frame.
+
+        Returns:
+            Dictionary of results.
+        """
+
+        return dict(
+            self._last_results,
+            timestamp=metadata.get("timestamp", 0),
+            recv_timestamp=metadata.get("recv_timestamp", 0),
+            timestamp_before_process=metadata["timestamp_before_process"],
+            timestamp_after_process=metadata["timestamp_after_process"],
+            send_timestamp=time.perf_counter_ns(),
+        )
+
     def _process_image(self, image: np.ndarray) -> Dict[int, KalmanBoxTracker]:
         """Process image by FCW.
 
@@ -137,8 +501,10 @@ class CollisionWorker(Thread):
             Dictionary of KalmanBoxTrackers.
         """
 
-        # Detect object in image.
-        detections = self._detector.detect(image)
+        detections = self._detector.detect(image, scale=self._detection_scale(image, self._camera))
+        for stage, duration in self._detector.timings.items():
+            self.stage_metrics.record(stage, duration)
+        t0 = time.perf_counter_ns()
         # Get bounding boxes as numpy array.
         detections = detections_to_numpy(detections)
         # Update state of image trackers.
@@ -147,24 +513,45 @@ class CollisionWorker(Thread):
         tracked_objects: Dict[int, KalmanBoxTracker] = {
             t.id: t for t in self._tracker.trackers if t.hit_streak > self._tracker.min_hits and t.time_since_update < 1
         }
+        t1 = time.perf_counter_ns()
         # Get 3D locations of objects.
-        ref_points = get_reference_points(tracked_objects, self._camera, is_rectified=True)
+        ref_points = get_reference_points(tracked_objects, self._camera, is_rectified=self._is_rectified)
+        t2 = time.perf_counter_ns()
         # Update state of objects in world.
         self._guard.update(ref_points)
+        t3 = time.perf_counter_ns()
+        self.stage_metrics.record("tracking", t1 - t0)
+        self.stage_metrics.record("reference_points", t2 - t1)
+        self.stage_metrics.record("guard_update", t3 - t2)
 
         return tracked_objects
 
+    def _detection_scale(self, image: np.ndarray, camera: Camera) -> float:
+        """Scale of detection coordinates of the image. Image can be rectified directly to detector input size,
+        detections are scaled to rectified_size coordinates. Distorted images are processed in image_size coordinates.
+
+        Args:
+            image (np.ndarray): Image to be processed.
+            camera (Camera): Camera of the image.
+
+        Returns:
+            Scale of detection coordinates.
+        """
+
+        h, w = image.shape[:2]
+        if self._is_rectified:
+            return camera.rectified_scale((w, h))
+        return camera.image_size[0] / w
+
     def _send_image_with_results(self, image: np.ndarray, results: Dict[str, Any]) -> None:
-        """Send a numpy array with metadata.
+        """Publish image with results for visualization. The image is sent without copy.
 
         Args:
             image (np.ndarray): Image.
             results (Dict[str, Any]): FCW results.
         """
 
-        md = dict(dtype=str(image.dtype), shape=image.shape, results=dict(results, config=self._config))
-        self._socket.send_json(md, 0 | zmq.SNDMORE)
-        self._socket.send(image, 0, copy=True, track=False)
+        self._viz_publisher.publish(results, image)
 
     def _generate_results(
         self, tracked_objects: Dict[int, KalmanBoxTracker], metadata: Dict[str, Any]
@@ -179,34 +566,48 @@ class CollisionWorker(Thread):
             Dictionary of results.
         """
 
+        alerts_only = self._results_profile == "alerts-only"
+        with_paths = self._results_profile == "full"
+
         # Get list of current offenses.
         dangerous_objects = self._guard.dangerous_objects()
         dangerous_detections = dict()
 
-        # Get object statuses.
-        object_statuses = list(self._guard.label_objects(include_distant=False))
-
         if tracked_objects is not None:
             for tid, t in tracked_objects.items():
+                if alerts_only and tid not in dangerous_objects:
+                    continue
                 x1, y1, x2, y2 = t.get_state()[0]
                 det = dict()
-                det["bbox"] = [x1, y1, x2, y2]
-                det["dangerous_distance"] = 0
-                det["age"] = t.age
-                det["hit_streak"] = t.hit_streak
-                det["class"] = t.label
+                det["bbox"] = [float(x1), float(y1), float(x2), float(y2)]
+                det["dangerous_distance"] = 0.0
+                det["age"] = int(t.age)
+                det["hit_streak"] = int(t.hit_streak)
+                det["class"] = int(t.label)
                 det["class_name"] = self._detector.model.names[t.label]
 
                 if tid in dangerous_objects.keys():
                     dist = Point(dangerous_objects[tid].location).distance(self._guard.vehicle_zone)
-                    det["dangerous_distance"] = dist
+                    det["dangerous_distance"] = float(dist)
                 dangerous_detections[tid] = det
 
-            # Make object statuses serializable - convert from shapely types.
-            for i in range(len(object_statuses)):
-                object_statuses[i].location = object_statuses[i].location.coords[0]
-                object_statuses[i].path = [pts for pts in object_statuses[i].path.coords]
-            object_statuses = [asdict(object_status) for object_status in object_statuses]
+            # Make object statuses serializable - plain Python types instead of shapely and numpy ones.
+            object_statuses = []
+            for status in self._guard.label_objects(include_distant=False):
+                if alerts_only and not (status.is_dangerous or status.crosses_danger_zone):
+                    continue
+                obj = {
+                    "id": int(status.id),
+                    "distance": float(status.distance),
+                    "location": status.location.coords[0],
+                }
+                if with_paths:
+                    obj["path"] = list(status.path.coords)
+                obj["is_in_danger_zone"] = bool(status.is_in_danger_zone)
+                obj["crosses_danger_zone"] = bool(status.crosses_danger_zone)
+                ttc = status.time_to_collision
+                obj["time_to_collision"] = None if ttc is None else float(ttc)
+                object_statuses.append(obj)
 
             return {
                 "timestamp": metadata.get("timestamp", 0),
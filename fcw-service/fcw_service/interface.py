@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import sys
@@ -5,17 +6,22 @@ import time
 import traceback
 from dataclasses import dataclass
 from queue import Queue
-from typing import Dict, Tuple, Any
+from typing import Dict, Tuple, Any, Optional, Union
 
 import numpy as np
+import yaml
 
 from era_5g_interface.channels import CallbackInfoServer, ChannelType, DATA_NAMESPACE, DATA_ERROR_EVENT
 from era_5g_interface.dataclasses.control_command import ControlCommand, ControlCmdType
 from era_5g_interface.interface_helpers import HeartbeatSender
 from era_5g_interface.task_handler_internal_q import TaskHandlerInternalQ
 from era_5g_server.server import NETAPP_STATUS_ADDRESS, NetworkApplicationServer, generate_application_heartbeat_data
+from fcw_service.metrics import FRAME_AGE_BOUNDS_MS, BucketHistogram, MetricsServer, prometheus_text
 from fcw_core.yolo_detector import YOLODetector
 from fcw_service.collision_worker import CollisionWorker
+from fcw_service.multi_camera_worker import MultiCameraWorker
+from fcw_service.warm_pool import WarmDetectorPool
+from fcw_service.worker_pool import ProcessWorker, WorkerPool
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 logger = logging.getLogger("FCW interface")
@@ -24,6 +30,23 @@ logger = logging.getLogger("FCW interface")
 NETAPP_PORT = int(os.getenv("NETAPP_PORT", 5896))
 # Input queue size.
 NETAPP_INPUT_QUEUE = int(os.getenv("NETAPP_INPUT_QUEUE", 1))
+# Number of worker processes, sessions are spread among them. Workers run as threads of the server if 0.
+NETAPP_WORKER_PROCESSES = int(os.getenv("NETAPP_WORKER_PROCESSES", 0))
+# Shared-memory frame slots of each worker process and their size in bytes.
+NETAPP_FRAME_SLOTS = int(os.getenv("NETAPP_FRAME_SLOTS", 4))
+NETAPP_FRAME_SLOT_SIZE = int(os.getenv("NETAPP_FRAME_SLOT_SIZE", 1920 * 1080 * 3))
+# Default maximal age of frames [s], older frames are dropped before detection. Disabled if 0.
+NETAPP_MAX_FRAME_AGE = float(os.getenv("NETAPP_MAX_FRAME_AGE", 0))
+# Maximal number of cameras of multi-camera sessions.
+NETAPP_MAX_CAMERAS = int(os.getenv("NETAPP_MAX_CAMERAS", 4))
+# Number of pre-loaded detectors for instant start of thread workers, disabled if 0.
+NETAPP_WARM_WORKERS = int(os.getenv("NETAPP_WARM_WORKERS", 1))
+# FCW config with detector section of pre-loaded detectors, default detector configuration if empty.
+NETAPP_WARM_CONFIG = str(os.getenv("NETAPP_WARM_CONFIG", ""))
+# Port of local HTTP metrics endpoint (Prometheus text format on /metrics). Disabled if 0.
+NETAPP_METRICS_PORT = int(os.getenv("NETAPP_METRICS_PORT", 0))
+# Directory of profiles of sessions (see fcw_service.profiler).
+NETAPP_PROFILE_DIR = str(os.getenv("NETAPP_PROFILE_DIR", "profiles"))
 # Event name for image error.
 IMAGE_ERROR_EVENT = str("image_error")
 
@@ -35,7 +58,9 @@ class TaskAndWorker:
     """Class for task and worker."""
 
     task: TaskHandlerInternalQ
-    worker: CollisionWorker
+    worker: Union[CollisionWorker, MultiCameraWorker, ProcessWorker]
+    # Frames replaced in the full input queue.
+    dropped_frames: int = 0
 
 
 class Server(NetworkApplicationServer):
@@ -43,29 +68,63 @@ class Server(NetworkApplicationServer):
 
     def __init__(
         self,
+        worker_processes: int = 0,
+        metrics_port: int = 0,
+        warm_workers: int = 0,
+        warm_detector_config: Optional[Dict] = None,
+        heartbeat: bool = True,
         **kwargs,
     ) -> None:
         """Constructor.
 
         Args:
+            worker_processes (int): Number of worker processes, workers run as threads if 0.
+            metrics_port (int): Port of local HTTP metrics endpoint, disabled if 0.
+            warm_workers (int): Number of pre-loaded detectors of thread workers, disabled if 0.
+            warm_detector_config (Dict, optional): Detector configuration of pre-loaded detectors.
+            heartbeat (bool): Send heartbeat to the middleware status address.
             *args: NetworkApplicationServer arguments.
             **kwargs: NetworkApplicationServer arguments.
         """
 
-        super().__init__(
-            callbacks_info={
-                "image_h264": CallbackInfoServer(ChannelType.H264, self.image_callback),
-                "image_hevc": CallbackInfoServer(ChannelType.HEVC, self.image_callback),
-                "image_jpeg": CallbackInfoServer(ChannelType.JPEG, self.image_callback),
-            },
-            **kwargs,
-        )
+        callbacks_info = {
+            "image_h264": CallbackInfoServer(ChannelType.H264, self.image_callback),
+            "image_hevc": CallbackInfoServer(ChannelType.HEVC, self.image_callback),
+            "image_jpeg": CallbackInfoServer(ChannelType.JPEG, self.image_callback),
+        }
+        # Other cameras of multi-camera sessions, each stream has its own decoder.
+        for camera in range(1, NETAPP_MAX_CAMERAS):
+            callback = functools.partial(self.image_callback, camera=camera)
+            callbacks_info[f"image_h264_{camera}"] = CallbackInfoServer(ChannelType.H264, callback)
+            callbacks_info[f"image_hevc_{camera}"] = CallbackInfoServer(ChannelType.HEVC, callback)
+            callbacks_info[f"image_jpeg_{camera}"] = CallbackInfoServer(ChannelType.JPEG, callback)
+
+        super().__init__(callbacks_info=callbacks_info, **kwargs)
 
         # List of registered tasks.
         self.tasks: Dict[str, TaskAndWorker] = dict()
 
+        # Pool of worker processes, started on demand.
+        self.worker_pool: Optional[WorkerPool] = None
+        if worker_processes > 0:
+            self.worker_pool = WorkerPool(
+                worker_processes, NETAPP_FRAME_SLOTS, NETAPP_FRAME_SLOT_SIZE, NETAPP_INPUT_QUEUE
+            )
+
+        # Pre-loaded detectors for thread workers, refilled in the background.
+        self.warm_pool: Optional[WarmDetectorPool] = None
+        if warm_workers > 0 and self.worker_pool is None:
+            self.warm_pool = WarmDetectorPool(warm_workers, warm_detector_config)
+
+        # Local metrics endpoint.
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_port > 0:
+            self.metrics_server = MetricsServer(metrics_port, self.generate_metrics, profile=self.profile_session)
+
         # Create Heartbeat sender
-        self.heartbeat_sender = HeartbeatSender(NETAPP_STATUS_ADDRESS, self.generate_heartbeat_data)
+        self.heartbeat_sender: Optional[HeartbeatSender] = None
+        if heartbeat:
+            self.heartbeat_sender = HeartbeatSender(NETAPP_STATUS_ADDRESS, self.generate_heartbeat_data)
 
     def generate_heartbeat_data(self):
         """Application heartbeat data generation using queue info and latencies."""
@@ -73,23 +132,69 @@ class Server(NetworkApplicationServer):
         latencies = []
         queue_occupancy = 0
         queue_size = 0
+        dropped_frames = 0
+        frame_ages = BucketHistogram(FRAME_AGE_BOUNDS_MS)
         for task_and_worker in self.tasks.values():
             queue_occupancy += task_and_worker.task.data_queue_occupancy()
             queue_size += task_and_worker.task.data_queue_size()
             latencies.extend(task_and_worker.worker.latency_measurements.get_latencies())
+            dropped_frames += task_and_worker.dropped_frames + task_and_worker.worker.dropped_frames
+            frame_ages.merge(task_and_worker.worker.frame_ages.counts)
         avg_latency = 0
         if len(latencies) > 0:
             avg_latency = float(np.mean(np.array(latencies)))
 
-        return generate_application_heartbeat_data(avg_latency, queue_size, queue_occupancy, len(self.tasks))
+        data = generate_application_heartbeat_data(avg_latency, queue_size, queue_occupancy, len(self.tasks))
+        data["droppedFrames"] = dropped_frames
+        data["frameAgeHistogram"] = frame_ages.as_dict()
+        # Percentiles of stage durations [ms] by session.
+        data["stageLatency"] = {
+            eio_sid: {
+                stage: {k: round(v * 1e3, 3) for k, v in summary.items() if k.startswith("p")}
+                for stage, summary in task_and_worker.worker.metrics_summary().items()
+            }
+            for eio_sid, task_and_worker in list(self.tasks.items())
+        }
+        return data
+
+    def generate_metrics(self) -> str:
+        """Metrics of all sessions in Prometheus text format."""
+
+        tasks = list(self.tasks.items())
+        return prometheus_text(
+            {eio_sid: t.worker.metrics_summary() for eio_sid, t in tasks},
+            {eio_sid: t.dropped_frames + t.worker.dropped_frames for eio_sid, t in tasks},
+        )
+
+    def profile_session(self, eio_sid: str, duration: float) -> Tuple[bool, str]:
+        """Start sampling profiler of the session worker, profile files are written to NETAPP_PROFILE_DIR.
+
+        Args:
+            eio_sid (str): Session id.
+            duration (float): Profiling duration [s].
 
-    def image_callback(self, sid: str, data: Dict[str, Any]) -> None:
+        Returns:
+            (started (bool), message (str)): If False, the profiler was not started.
+        """
+
+        task_and_worker = self.tasks.get(eio_sid)
+        if task_and_worker is None:
+            return False, f"Unknown session {eio_sid}"
+        if duration <= 0:
+            return False, f"Invalid profiling duration {duration}"
+        if not task_and_worker.worker.start_profiling(duration, NETAPP_PROFILE_DIR, eio_sid):
+            return False, f"Session {eio_sid} is not running or it is being profiled already"
+        logger.info(f"Profiling session {eio_sid} for {duration} s")
+        return True, f"Profiling session {eio_sid} for {duration} s to {NETAPP_PROFILE_DIR}"
+
+    def image_callback(self, sid: str, data: Dict[str, Any], camera: int = 0) -> None:
         """Allows to receive decoded image using the websocket transport.
 
         Args:
             sid (str): Namespace sid.
             data (Dict[str, Any]): Data dict including decoded frame (data["frame"]) and send timestamp
                 (data["timestamp"]).
+            camera (int): Camera index of multi-camera session, 0 for single-camera sessions.
         """
 
         eio_sid = self.get_eio_sid_of_data(sid)
@@ -106,8 +211,23 @@ class Server(NetworkApplicationServer):
             self.disconnect(sid)
             return
 
-        task = self.tasks[eio_sid].task
-        task.store_data({"timestamp": data["timestamp"], "recv_timestamp": time.perf_counter_ns()}, data["frame"])
+        task_and_worker = self.tasks[eio_sid]
+        if camera > 0 and camera >= len(getattr(task_and_worker.worker, "camera_names", ())):
+            logger.error(f"Frame of unknown camera {camera}, eio_sid {eio_sid}")
+            self.send_data({"message": f"Frame of unknown camera {camera}"}, DATA_ERROR_EVENT, sid=sid)
+            return
+        if task_and_worker.task.data_queue_occupancy() >= 1:
+            # The oldest frame is replaced, the latest frame wins.
+            task_and_worker.dropped_frames += 1
+        task_and_worker.task.store_data(
+            {
+                "timestamp": data["timestamp"],
+                "recv_timestamp": time.perf_counter_ns(),
+                "dropped_frames": task_and_worker.dropped_frames,
+                "camera": camera,
+            },
+            data["frame"],
+        )
 
     def command_callback(self, command: ControlCommand, sid: str) -> Tuple[bool, str]:
         """Process initialization control command - create task, worker and start the worker.
@@ -134,27 +254,66 @@ class Server(NetworkApplicationServer):
             args = command.data
             config = {}
             camera_config = {}
+            cameras = None
             fps = 30
             viz = True
             viz_zmq_port = 5558
+            is_rectified = True
+            viz_session = eio_sid
+            viz_fps = None
+            viz_max_size = None
+            viz_codec = "raw"
+            results_profile = "full"
+            results_encoding = "json"
+            results_keyframe_interval = 0
+            max_frame_age = NETAPP_MAX_FRAME_AGE or None
             if args:
                 config = args.get("config", config)
                 camera_config = args.get("camera_config", camera_config)
+                cameras = args.get("cameras", cameras)
                 fps = args.get("fps", fps)
                 viz = args.get("viz", viz)
                 viz_zmq_port = args.get("viz_zmq_port", viz_zmq_port)
+                is_rectified = args.get("is_rectified", is_rectified)
+                viz_session = args.get("viz_session", viz_session)
+                viz_fps = args.get("viz_fps", viz_fps)
+                viz_max_size = args.get("viz_max_size", viz_max_size)
+                viz_codec = args.get("viz_codec", viz_codec)
+                results_profile = args.get("results_profile", results_profile)
+                results_encoding = args.get("results_encoding", results_encoding)
+                results_keyframe_interval = args.get("results_keyframe_interval", results_keyframe_interval)
+                if args.get("max_frame_age") is not None:
+                    # 0 disables the server default
+                    max_frame_age = args["max_frame_age"] or None
                 logger.info(f"Config: {config}")
                 logger.info(f"Camera config: {camera_config}")
-                logger.info(f"ZeroMQ visualization: {viz}, port: {viz_zmq_port}")
+                if cameras:
+                    logger.info(f"Cameras: {list(cameras.keys())}")
+                logger.info(
+                    f"ZeroMQ visualization: {viz}, port: {viz_zmq_port}, session: {viz_session}, fps: {viz_fps}, "
+                    f"max size: {viz_max_size}, codec: {viz_codec}"
+                )
+                logger.info(f"Rectified images: {is_rectified}")
+                logger.info(
+                    f"Results profile: {results_profile}, encoding: {results_encoding}, "
+                    f"keyframe interval: {results_keyframe_interval}"
+                )
+                logger.info(f"Maximal frame age: {max_frame_age}")
+
+            if cameras and len(cameras) > NETAPP_MAX_CAMERAS:
+                message = f"Too many cameras {len(cameras)}, maximum is {NETAPP_MAX_CAMERAS}"
+                logger.error(message)
+                self.send_command_error(message, sid)
+                return False, message
 
-            # Queue with received images.
-            image_queue = Queue(NETAPP_INPUT_QUEUE)
+            # Queue with received images, of all cameras of multi-camera session.
+            image_queue = Queue(NETAPP_INPUT_QUEUE * (len(cameras) if cameras else 1))
 
             task = TaskHandlerInternalQ(image_queue)
 
             try:
-                # Create worker.
-                worker = CollisionWorker(
+                # Create worker, in a worker process if the pool is used.
+                worker_args = dict(
                     image_queue=image_queue,
                     send_function=lambda results: self.send_data(
                         data=results, event="results",
@@ -168,9 +327,29 @@ class Server(NetworkApplicationServer):
                     ),
                     viz=viz,
                     viz_zmq_port=viz_zmq_port,
+                    viz_session=viz_session,
+                    viz_fps=viz_fps,
+                    viz_max_size=viz_max_size,
+                    viz_codec=viz_codec,
+                    results_profile=results_profile,
+                    results_encoding=results_encoding,
+                    results_keyframe_interval=results_keyframe_interval,
+                    max_frame_age=max_frame_age,
+                    is_rectified=is_rectified,
                     name=f"Collision Worker {eio_sid}",
-                    daemon=True,
                 )
+                if cameras:
+                    # Multi-camera sessions run as threads.
+                    del worker_args["camera_config"]
+                    worker = MultiCameraWorker(daemon=True, camera_configs=cameras, **worker_args)
+                elif self.worker_pool is not None:
+                    worker = self.worker_pool.create_worker(eio_sid, **worker_args)
+                else:
+                    detector = None
+                    if self.warm_pool is not None:
+                        detector = self.warm_pool.take(config.get("detector", {}))
+                        logger.info(f"Pre-loaded detector used: {detector is not None}")
+                    worker = CollisionWorker(daemon=True, detector=detector, **worker_args)
             except Exception as ex:
                 logger.error(f"Failed to create CollisionWorker: {repr(ex)}")
                 logger.error(traceback.format_exc())
@@ -179,16 +358,20 @@ class Server(NetworkApplicationServer):
 
             self.tasks[eio_sid] = TaskAndWorker(task, worker)
             self.tasks[eio_sid].worker.start()
-            t0 = time.perf_counter_ns()
-            while True:
-                if self.tasks[eio_sid].worker.is_alive():
-                    break
-                if time.perf_counter_ns() > t0 + 5 * 1.0e9:
-                    logger.error(f"Timed out to start worker, eio_sid {eio_sid}, sid {sid}")
-                    return False, f"Timed out to start worker"
+            if not self.tasks[eio_sid].worker.running.wait(5):
+                logger.error(f"Timed out to start worker, eio_sid {eio_sid}, sid {sid}")
+                return False, f"Timed out to start worker"
 
             logger.info(f"Task handler and worker created and started: {eio_sid}")
 
+        elif command and command.cmd_type == ControlCmdType.SET_STATE and "profile" in (command.data or {}):
+            # Sampling profiler of the session worker for given number of seconds.
+            try:
+                duration = float(command.data["profile"])
+            except (TypeError, ValueError):
+                return False, f"Invalid profiling duration {command.data['profile']}"
+            return self.profile_session(eio_sid, duration)
+
         logger.info(
             f"Control command applied, eio_sid {eio_sid}, sid {sid}, "
             f"results sid {self.get_sid_of_data(eio_sid)}, command {command}"
@@ -234,16 +417,41 @@ def main():
 
     logger.info(f"The size of the queue set to: {NETAPP_INPUT_QUEUE}")
 
-    logger.info("Initializing default object detector for faster first startup")
-    detector = YOLODetector.from_dict({})
-    del detector
-
-    server = Server(port=NETAPP_PORT, host="0.0.0.0", extended_measuring=EXTENDED_MEASURING)
+    warm_detector_config = {}
+    if NETAPP_WORKER_PROCESSES > 0:
+        logger.info(f"Workers run in up to {NETAPP_WORKER_PROCESSES} processes")
+    elif NETAPP_WARM_WORKERS > 0:
+        if NETAPP_WARM_CONFIG:
+            with open(NETAPP_WARM_CONFIG) as f:
+                warm_detector_config = yaml.safe_load(f).get("detector", {})
+        logger.info(f"Pre-loading {NETAPP_WARM_WORKERS} detectors: {warm_detector_config}")
+
+    if NETAPP_WORKER_PROCESSES > 0 or NETAPP_WARM_WORKERS <= 0:
+        logger.info("Initializing default object detector for faster first startup")
+        detector = YOLODetector.from_dict({})
+        del detector
+
+    server = Server(
+        worker_processes=NETAPP_WORKER_PROCESSES,
+        metrics_port=NETAPP_METRICS_PORT,
+        warm_workers=NETAPP_WARM_WORKERS,
+        warm_detector_config=warm_detector_config,
+        port=NETAPP_PORT,
+        host="0.0.0.0",
+        extended_measuring=EXTENDED_MEASURING,
+    )
 
     try:
         server.run_server()
     except KeyboardInterrupt:
         logger.info("Terminating ...")
+    finally:
+        if server.worker_pool is not None:
+            server.worker_pool.close()
+        if server.metrics_server is not None:
+            server.metrics_server.close()
+        if server.warm_pool is not None:
+            server.warm_pool.close()
 
 
 if __name__ == "__main__":
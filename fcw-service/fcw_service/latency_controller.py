@@ -0,0 +1,225 @@
+"""
+Latency-SLO controller of FCW workers
+
+The controller keeps the end-to-end latency of a session (receiving of frame to sending of results) under a target.
+It steps through a ladder of detector configurations - detector model, detector input size (max_size) and detection
+cadence (detection on every n-th frame) - from the configured one to the cheapest. A level is degraded when the
+latency or the input queue occupancy exceeds the limits and restored when the load drops. Only frames which ran
+detection are observed - results repeated between detections are fast and would make a cadence level look underloaded.
+
+Configuration (section "slo" of FCW config):
+
+    slo:
+      target_latency: 0.15  # [s] end-to-end latency target, the controller is disabled without it
+      interval: 1.0  # [s] evaluation period
+      max_queue_occupancy: 0.9  # average input queue occupancy considered as overload
+      down_after: 2  # consecutive overloaded evaluations before degrading
+      up_after: 5  # consecutive underloaded evaluations before restoring
+      up_ratio: 0.5  # latency under up_ratio * target_latency is considered as underload
+      window: 10  # number of recent latencies averaged by evaluation
+      ladder:  # optional, derived from detector config by default
+        - {model: yolov5m6, max_size: 1024, cadence: 1}
+        - {model: yolov5n6, max_size: 512, cadence: 2}
+"""
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The cheapest model used by the default ladder
+FALLBACK_MODEL = "yolov5n6"
+
+
+@dataclass
+class DetectorLevel:
+    """Detector configuration of a controller level."""
+
+    model: str
+    max_size: int
+    # Detection on every n-th frame
+    cadence: int = 1
+
+    def __str__(self) -> str:
+        return f"{self.model} max_size {self.max_size} cadence {self.cadence}"
+
+
+def default_ladder(detector_config: Dict) -> List[DetectorLevel]:
+    """Ladder from configured detector to the smallest model with half of input size and detection on every third
+    frame.
+
+    Args:
+        detector_config (Dict): Detector configuration (see YOLODetector.from_dict).
+
+    Returns:
+        Levels from the most to the least expensive.
+    """
+
+    model = detector_config.get("model", "yolov5n6")
+    max_size = detector_config.get("max_size", 1024)
+
+    def size(ratio: float) -> int:
+        # YOLO input is padded to multiples of 32
+        return max(32 * round(max_size * ratio / 32), 320)
+
+    candidates = [
+        DetectorLevel(model, max_size, 1),
+        DetectorLevel(model, size(0.75), 1),
+        DetectorLevel(model, size(0.5), 1),
+        DetectorLevel(model, size(0.5), 2),
+        DetectorLevel(FALLBACK_MODEL, size(0.5), 2),
+        DetectorLevel(FALLBACK_MODEL, size(0.5), 3),
+    ]
+    ladder = []
+    for level in candidates:
+        if level not in ladder:
+            ladder.append(level)
+    return ladder
+
+
+class LatencyController:
+    """Selects detector level of a session from its latencies and input queue occupancy."""
+
+    def __init__(
+        self,
+        target_latency: float,
+        ladder: List[DetectorLevel],
+        interval: float = 1.0,
+        max_queue_occupancy: float = 0.9,
+        down_after: int = 2,
+        up_after: int = 5,
+        up_ratio: float = 0.5,
+        window: int = 10,
+        name: str = "",
+    ) -> None:
+        """Constructor.
+
+        Args:
+            target_latency (float): Target end-to-end latency [s].
+            ladder (List[DetectorLevel]): Levels from the most to the least expensive, the first one is used first.
+            interval (float): Evaluation period [s].
+            max_queue_occupancy (float): Average input queue occupancy considered as overload.
+            down_after (int): Consecutive overloaded evaluations before degrading.
+            up_after (int): Consecutive underloaded evaluations before restoring.
+            up_ratio (float): Latency under up_ratio * target_latency is considered as underload.
+            window (int): Number of recent latencies averaged by evaluation.
+            name (str): Session name used in log.
+        """
+
+        if not ladder:
+            raise ValueError("Ladder of detector levels is empty")
+        self.target_latency = target_latency
+        self.ladder = ladder
+        self.interval = interval
+        self.max_queue_occupancy = max_queue_occupancy
+        self.down_after = down_after
+        self.up_after = up_after
+        self.up_ratio = up_ratio
+        self.name = name
+        self.level = 0
+        self.switches = 0
+        self._occupancy: List[float] = []
+        # Latencies [ns] of frames which ran detection
+        self._latencies: Deque[int] = deque(maxlen=window)
+        self._evaluated = time.monotonic()
+        self._overloaded = 0
+        self._underloaded = 0
+
+    @staticmethod
+    def from_dict(d: Dict, detector_config: Dict, name: str = "") -> Optional["LatencyController"]:
+        """Controller from "slo" configuration section, None if no target latency is configured.
+
+        Args:
+            d (Dict): Controller configuration.
+            detector_config (Dict): Detector configuration, used for the default ladder.
+            name (str): Session name used in log.
+        """
+
+        if not d or not d.get("target_latency"):
+            return None
+        if "ladder" in d:
+            ladder = [
+                DetectorLevel(
+                    level.get("model", detector_config.get("model", "yolov5n6")),
+                    level.get("max_size", detector_config.get("max_size", 1024)),
+                    level.get("cadence", 1),
+                )
+                for level in d["ladder"]
+            ]
+        else:
+            ladder = default_ladder(detector_config)
+        return LatencyController(
+            target_latency=d["target_latency"],
+            ladder=ladder,
+            interval=d.get("interval", 1.0),
+            max_queue_occupancy=d.get("max_queue_occupancy", 0.9),
+            down_after=d.get("down_after", 2),
+            up_after=d.get("up_after", 5),
+            up_ratio=d.get("up_ratio", 0.5),
+            window=d.get("window", 10),
+            name=name,
+        )
+
+    @property
+    def current(self) -> DetectorLevel:
+        return self.ladder[self.level]
+
+    def update(self, latency: int, queue_occupancy: float) -> Optional[DetectorLevel]:
+        """Observe the session after a frame which ran detection. Frames with repeated results (cadence) must not be
+        observed. The level is evaluated once per interval.
+
+        Args:
+            latency (int): End-to-end latency of the frame [ns].
+            queue_occupancy (float): Input queue occupancy before the frame was taken.
+
+        Returns:
+            New level if the level was switched, None otherwise.
+        """
+
+        self._occupancy.append(queue_occupancy)
+        self._latencies.append(latency)
+        now = time.monotonic()
+        if now - self._evaluated < self.interval:
+            return None
+        self._evaluated = now
+        occupancy = float(np.mean(self._occupancy))
+        self._occupancy.clear()
+        latency = float(np.mean(self._latencies)) * 1.0e-9
+
+        if latency > self.target_latency or occupancy > self.max_queue_occupancy:
+            self._overloaded += 1
+            self._underloaded = 0
+        elif latency < self.up_ratio * self.target_latency and occupancy <= self.max_queue_occupancy:
+            self._underloaded += 1
+            self._overloaded = 0
+        else:
+            self._overloaded = self._underloaded = 0
+
+        if self._overloaded >= self.down_after and self.level < len(self.ladder) - 1:
+            reason = (
+                f"latency {latency * 1e3:.0f} ms, queue occupancy {occupancy:.0%} over target "
+                f"{self.target_latency * 1e3:.0f} ms, {self.max_queue_occupancy:.0%}"
+            )
+            return self._switch(self.level + 1, reason)
+        if self._underloaded >= self.up_after and self.level > 0:
+            reason = (
+                f"latency {latency * 1e3:.0f} ms under {self.up_ratio * self.target_latency * 1e3:.0f} ms, "
+                f"queue occupancy {occupancy:.0%}"
+            )
+            return self._switch(self.level - 1, reason)
+        return None
+
+    def _switch(self, level: int, reason: str) -> DetectorLevel:
+        logger.info(
+            f"{self.name}: detector level {self.level} -> {level} ({self.ladder[self.level]} -> "
+            f"{self.ladder[level]}), {reason}"
+        )
+        self.level = level
+        self.switches += 1
+        # Measurements of the previous level do not count
+        self._overloaded = self._underloaded = 0
+        return self.ladder[level]
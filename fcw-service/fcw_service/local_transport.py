@@ -0,0 +1,151 @@
+"""
+In-process stand-in of the 5G-ERA transport
+
+LocalServer is the FCW Server whose clients are connected in the same process instead of Socket.IO: frames, control
+commands and results are passed as Python objects, without encoding and network. LocalClient has the interface of
+era_5g_client NetAppClientBase used by CollisionWarningClient (register, send_image, send_control_command,
+disconnect), so the client runs unchanged with client_factory=functools.partial(LocalClient, server).
+
+Used by load tests of the service without network services (heartbeat to the middleware is not sent), measured
+throughput and latencies do not include the cost of image codecs and transport.
+"""
+import copy
+import itertools
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from era_5g_interface.channels import CallbackInfoClient, ChannelType
+from era_5g_interface.dataclasses.control_command import ControlCmdType, ControlCommand
+from fcw_service.interface import Server
+
+logger = logging.getLogger(__name__)
+
+
+class LocalServer(Server):
+    """FCW Server with in-process clients, sid of a client is used for all namespaces."""
+
+    def __init__(self, **kwargs) -> None:
+        """Constructor.
+
+        Args:
+            **kwargs: Server arguments, port is not used, heartbeat is disabled by default.
+        """
+
+        kwargs.setdefault("port", 0)
+        kwargs.setdefault("heartbeat", False)
+        super().__init__(**kwargs)
+        self._clients: Dict[str, "LocalClient"] = dict()
+        self._sids = (f"local-{i}" for i in itertools.count())
+        self._lock = threading.Lock()
+        # Send functions of Socket.IO channels are replaced.
+        self.send_data = self._send_data
+
+    def connect(self, client: "LocalClient") -> str:
+        """Connect client, returns its sid."""
+
+        with self._lock:
+            sid = next(self._sids)
+            self._clients[sid] = client
+        return sid
+
+    def get_sid_of_data(self, eio_sid: str) -> str:
+        return eio_sid
+
+    def get_sid_of_control(self, eio_sid: str) -> str:
+        return eio_sid
+
+    def get_eio_sid_of_data(self, sid: str) -> str:
+        return sid
+
+    def get_eio_sid_of_control(self, sid: str) -> str:
+        return sid
+
+    def _send_data(
+        self, data: Dict[str, Any], event: str, channel_type: ChannelType = ChannelType.JSON, sid=None, **kw
+    ) -> None:
+        client = self._clients.get(sid)
+        if client is not None:
+            client.receive(event, data)
+
+    def send_command_error(self, message: str, sid: str):
+        logger.error(f"Command error of client {sid}: {message}")
+
+    def receive_image(self, sid: str, event: str, data: Dict[str, Any]) -> None:
+        """Image of client, event is image_<codec> or image_<codec>_<camera> as in Socket.IO transport."""
+
+        parts = event.split("_")
+        camera = int(parts[2]) if len(parts) > 2 else 0
+        self.image_callback(sid, data, camera=camera)
+
+    def disconnect(self, sid: str) -> None:
+        """Disconnect client by sid, its task and worker are deleted."""
+
+        with self._lock:
+            client = self._clients.pop(sid, None)
+        if client is not None:
+            self.disconnect_callback(sid)
+            client.sid = None
+
+
+class LocalClient:
+    """In-process client of LocalServer with the interface of NetAppClientBase."""
+
+    def __init__(self, server: LocalServer, callbacks_info: Dict[str, CallbackInfoClient], **kw) -> None:
+        """Constructor.
+
+        Args:
+            server (LocalServer): Server of the client.
+            callbacks_info (Dict[str, CallbackInfoClient]): Callbacks of events sent by the server.
+            **kw: Other NetAppClientBase arguments, not used.
+        """
+
+        self.server = server
+        self.callbacks_info = callbacks_info
+        self.sid: Optional[str] = None
+
+    def register(self, netapp_address: Any = None, args: Optional[Dict[str, Any]] = None, **kw) -> None:
+        """Connect to the server and initialize the session by INIT command with args."""
+
+        self.sid = self.server.connect(self)
+        initialized, message = self.send_control_command(ControlCommand(ControlCmdType.INIT, data=args))
+        if not initialized:
+            self.disconnect()
+            raise ConnectionError(f"Failed to initialize the network application: {message}")
+
+    def send_image(
+        self,
+        frame: np.ndarray,
+        event: str,
+        channel_type: ChannelType,
+        timestamp: Optional[int] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        **kw,
+    ) -> None:
+        if self.sid is None:
+            raise ConnectionError("Client is not connected to server.")
+        # Frame buffer of the client is reused, the transport sends a copy (decoded frame).
+        data = {"timestamp": timestamp, "frame": frame.copy()}
+        if metadata:
+            data["metadata"] = metadata
+        self.server.receive_image(self.sid, event, data)
+
+    def send_data(self, data: Dict[str, Any], event: str, *args, **kw) -> None:
+        logger.debug(f"Data event {event} of local client is not handled by the server")
+
+    def send_control_command(self, control_command: ControlCommand) -> Tuple[bool, str]:
+        if self.sid is None:
+            raise ConnectionError("Client is not connected to server.")
+        # Command is serialized in the Socket.IO transport, the server must not share its data with the client.
+        return self.server.command_callback(copy.deepcopy(control_command), self.sid)
+
+    def receive(self, event: str, data: Dict[str, Any]) -> None:
+        callback_info = self.callbacks_info.get(event)
+        if callback_info is not None:
+            callback_info.callback(data)
+
+    def disconnect(self) -> None:
+        if self.sid is not None:
+            self.server.disconnect(self.sid)
@@ -0,0 +1,237 @@
+"""
+Metrics of FCW workers reported in results, heartbeat and local HTTP endpoint
+
+Durations of processing stages are recorded per session in histograms with logarithmic buckets (HDR-style) - memory
+is constant and percentiles have bounded relative error. The local HTTP endpoint serves percentile summaries of all
+sessions in Prometheus text format, its admin path starts the sampling profiler of a session (fcw_service.profiler).
+"""
+import logging
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of frame age histogram buckets [ms], the last bucket is unbounded
+FRAME_AGE_BOUNDS_MS = (10, 20, 50, 100, 200, 500, 1000)
+
+# Processing stages of CollisionWorker
+STAGES = (
+    "queue_wait",  # Frame received - processing started
+    "preprocess",  # Detector input preparation (resize)
+    "inference",  # Detector model
+    "postprocess",  # Conversion and filtering of detections
+    "tracking",  # Sort.update
+    "reference_points",  # get_reference_points
+    "guard_update",  # ForwardCollisionGuard.update
+    "labeling",  # Labeling of objects and building of results
+    "serialization",  # Results encoding
+    "send",  # Sending results
+    "viz_publish",  # Publishing visualization
+    "total",  # Frame received - results sent
+)
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Summary of histogram, see LatencyHistogram.summary
+Summary = Dict[str, float]
+
+
+class BucketHistogram:
+    """Counts of values in buckets given by their upper bounds, values over the last bound fall to overflow bucket."""
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        """Constructor.
+
+        Args:
+            bounds (Sequence[float]): Increasing upper bounds of buckets (inclusive).
+        """
+
+        self.bounds = list(bounds)
+        self.counts: List[int] = [0] * (len(self.bounds) + 1)
+
+    def add(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+    def merge(self, counts: Iterable[int]) -> None:
+        """Add counts of other histogram with the same bounds."""
+
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+
+    def as_dict(self) -> Dict[str, int]:
+        """Counts by upper bound, "inf" for the overflow bucket."""
+
+        keys = [f"{b:g}" for b in self.bounds] + ["inf"]
+        return dict(zip(keys, self.counts))
+
+
+class LatencyHistogram:
+    """Histogram of durations with logarithmic buckets, relative error of percentiles is bounded by precision."""
+
+    def __init__(self, lowest: float = 1.0e-6, highest: float = 100.0, precision: float = 0.02) -> None:
+        """Constructor.
+
+        Args:
+            lowest (float): Lowest distinguished duration [s], shorter durations fall to the first bucket.
+            highest (float): Highest distinguished duration [s], longer durations fall to the last bucket.
+            precision (float): Relative error of percentiles.
+        """
+
+        self.lowest = lowest
+        # Bucket upper bound is (1 + 2 * precision) times its lower bound, the middle is within precision
+        self._log_ratio = math.log1p(2 * precision)
+        self._buckets = int(math.ceil(math.log(highest / lowest) / self._log_ratio)) + 1
+        self.counts = np.zeros(self._buckets + 1, np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        """Record duration [s]."""
+
+        if value > self.lowest:
+            i = min(int(math.log(value / self.lowest) / self._log_ratio) + 1, self._buckets)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        """Duration [s] at quantile q (0-1)."""
+
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        if i == 0:
+            return self.lowest
+        # Geometric middle of the bucket
+        value = self.lowest * math.exp((i - 0.5) * self._log_ratio)
+        return min(value, self.max)
+
+    def summary(self, quantiles: Sequence[float] = QUANTILES) -> Summary:
+        """Count, sum, maximum and percentiles ("p50", "p90"...) of durations [s]."""
+
+        summary = {"count": self.count, "sum": self.sum, "max": self.max}
+        for q in quantiles:
+            summary[f"p{q * 100:g}"] = self.percentile(q)
+        return summary
+
+
+class StageMetrics:
+    """Duration histograms of processing stages of one session."""
+
+    def __init__(self, stages: Sequence[str] = STAGES) -> None:
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+
+    def record(self, stage: str, duration_ns: int) -> None:
+        """Record duration of the stage [ns]."""
+
+        self.histograms[stage].record(duration_ns * 1.0e-9)
+
+    def summary(self) -> Dict[str, Summary]:
+        """Summaries of stages with recorded durations."""
+
+        return {stage: h.summary() for stage, h in self.histograms.items() if h.count > 0}
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(stages: Dict[str, Dict[str, Summary]], dropped_frames: Dict[str, int]) -> str:
+    """Metrics of sessions in Prometheus text exposition format.
+
+    Args:
+        stages (Dict[str, Dict[str, Summary]]): Stage summaries by session.
+        dropped_frames (Dict[str, int]): Dropped frames by session.
+
+    Returns:
+        Metrics text.
+    """
+
+    lines = [
+        "# HELP fcw_stage_duration_seconds Duration of FCW processing stages.",
+        "# TYPE fcw_stage_duration_seconds summary",
+    ]
+    for session, summaries in stages.items():
+        for stage, summary in summaries.items():
+            labels = f'session="{_label(session)}",stage="{_label(stage)}"'
+            for q in QUANTILES:
+                lines.append(f'fcw_stage_duration_seconds{{{labels},quantile="{q:g}"}} {summary[f"p{q * 100:g}"]:.9g}')
+            lines.append(f"fcw_stage_duration_seconds_sum{{{labels}}} {summary['sum']:.9g}")
+            lines.append(f"fcw_stage_duration_seconds_count{{{labels}}} {summary['count']:d}")
+    lines += [
+        "# HELP fcw_dropped_frames_total Frames dropped before processing.",
+        "# TYPE fcw_dropped_frames_total counter",
+    ]
+    for session, dropped in dropped_frames.items():
+        lines.append(f'fcw_dropped_frames_total{{session="{_label(session)}"}} {dropped:d}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Local HTTP server of metrics in Prometheus text format on /metrics.
+
+    Admin endpoint /profile?session=<session id>&seconds=<duration> starts the sampling profiler of the session.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        collect: Callable[[], str],
+        host: str = "127.0.0.1",
+        profile: Optional[Callable[[str, float], Tuple[bool, str]]] = None,
+    ) -> None:
+        """Constructor, the server runs in a background thread.
+
+        Args:
+            port (int): HTTP port.
+            collect (Callable[[], str]): Callback generating metrics text.
+            host (str): Address to bind, local only by default.
+            profile (Callable[[str, float], Tuple[bool, str]], optional): Callback starting the profiler of
+                a session for given duration [s], the profile endpoint is disabled without it.
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self._reply(200, collect(), "text/plain; version=0.0.4")
+                elif url.path == "/profile" and profile is not None:
+                    query = parse_qs(url.query)
+                    try:
+                        ok, message = profile(query["session"][0], float(query.get("seconds", ["10"])[0]))
+                    except (KeyError, ValueError):
+                        self._reply(400, "Use /profile?session=<session id>&seconds=<duration>\n")
+                        return
+                    self._reply(200 if ok else 409, message + "\n")
+                else:
+                    self.send_error(404)
+
+            def _reply(self, code: int, text: str, content_type: str = "text/plain") -> None:
+                body = text.encode()
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="Metrics server", daemon=True)
+        self._thread.start()
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
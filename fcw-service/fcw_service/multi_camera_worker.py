@@ -0,0 +1,215 @@
+"""
+FCW worker of a vehicle with several cameras
+
+Frames of all cameras of a session (e.g. front and rear camera with view_direction x and -x) come through one input
+queue, the camera index is in the frame metadata ("camera"). The worker gathers the latest frame of each camera and
+detects objects in all of them by one batched detector call. Each camera has its own image tracker, reference points
+of all cameras are in the vehicle space of their camera configs and go to a single ForwardCollisionGuard.
+
+Track ids are unique among cameras (KalmanBoxTracker counter is global). Objects of a camera without a frame in the
+batch are kept by the guard and only predicted, until the camera sends no frames for CAMERA_TIMEOUT. Results have
+the camera names of tracked objects in "cameras" field ({name: [track ids]}) and the frame timestamps of cameras in
+"camera_timestamps" field ({name: timestamp}).
+"""
+import logging
+import time
+from queue import Empty
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from fcw_core.sort import KalmanBoxTracker, Sort
+from fcw_core.detection import detections_to_numpy
+from fcw_core_utils.collision import get_reference_points
+from fcw_core_utils.geometry import Camera
+from fcw_service.collision_worker import CollisionWorker
+
+logger = logging.getLogger(__name__)
+
+# Objects of a camera without frames for this time [s] are lost
+CAMERA_TIMEOUT = 1.0
+
+
+class MultiCameraWorker(CollisionWorker):
+    """FCW worker of several named cameras with batched detection and one collision guard."""
+
+    def __init__(
+        self,
+        image_queue,
+        send_function,
+        config: Dict,
+        camera_configs: Dict[str, Dict],
+        fps: float,
+        batch_window: Optional[float] = None,
+        **kw,
+    ) -> None:
+        """Constructor.
+
+        Args:
+            image_queue (Queue): The queue with to-be-processed images of all cameras, metadata["camera"] is
+                the index of camera in camera_configs.
+            send_function (Callable[[Dict], None]): Callback used to send results.
+            config (Dict): FCW config.
+            camera_configs (Dict[str, Dict]): Camera configs by camera names.
+            fps (float): Framerate of each camera.
+            batch_window (float, optional): Time to wait for frames of other cameras after a frame is received [s],
+                half of frame period by default.
+            **kw: CollisionWorker arguments. Visualization is not supported.
+        """
+
+        if not camera_configs:
+            raise ValueError("No camera config of multi-camera worker")
+        if kw.pop("viz", False):
+            logger.warning("Visualization is not supported by multi-camera worker")
+        names = list(camera_configs.keys())
+        super().__init__(image_queue, send_function, config, camera_configs[names[0]], fps, viz=False, **kw)
+        self.camera_names = names
+        self._cameras: List[Camera] = [self._camera] + [Camera.from_dict(camera_configs[n]) for n in names[1:]]
+        self._trackers: List[Sort] = [self._tracker] + [Sort.from_dict(config.get("tracker", {})) for _ in names[1:]]
+        self._config["camera_config"] = camera_configs
+        self._batch_window = batch_window if batch_window is not None else 0.5 / fps
+        # Tracked objects of the last frame of each camera.
+        self._tracked: List[Dict[int, KalmanBoxTracker]] = [dict() for _ in names]
+        self._last_frame = [time.monotonic()] * len(names)
+
+    def _latest_frame(
+        self, metadata: Dict[str, Any], image: np.ndarray
+    ) -> Tuple[Dict[str, Any], Dict[int, np.ndarray]]:
+        """Gather the latest frame of each camera, wait up to batch window for frames of other cameras. Older and
+        stale frames are dropped.
+
+        Args:
+            metadata (Dict[str, Any]): Metadata of frame taken from the queue.
+            image (np.ndarray): Image taken from the queue.
+
+        Returns:
+            Metadata of the earliest received frame of the batch and images by camera index.
+        """
+
+        frames: Dict[int, Tuple[Dict[str, Any], np.ndarray]] = dict()
+        deadline = time.monotonic() + self._batch_window
+        frame = (metadata, image)
+        while True:
+            camera = frame[0].get("camera", 0)
+            if not 0 <= camera < len(self._cameras):
+                logger.error(f"{self.name}: frame of unknown camera {camera}")
+            else:
+                if camera in frames:
+                    self._record_age(frames[camera][0])
+                    self.dropped_frames += 1
+                frames[camera] = frame
+            try:
+                timeout = deadline - time.monotonic()
+                if len(frames) < len(self._cameras) and timeout > 0:
+                    frame = self.image_queue.get(block=True, timeout=timeout)
+                else:
+                    frame = self.image_queue.get_nowait()
+            except Empty:
+                break
+
+        frames = {camera: f for camera, f in frames.items() if not CollisionWorker._is_stale(self, f[0])}
+        if not frames:
+            return dict(metadata, stale=True), dict()
+        first = min(frames.values(), key=lambda f: f[0].get("recv_timestamp", 0))[0]
+        metadata = dict(first)
+        metadata["camera_timestamps"] = {self.camera_names[c]: f[0].get("timestamp", 0) for c, f in frames.items()}
+        metadata["dropped_frames"] = max(f[0].get("dropped_frames", 0) for f in frames.values())
+        return metadata, {camera: f[1] for camera, f in frames.items()}
+
+    def _is_stale(self, metadata: Dict[str, Any]) -> bool:
+        # Frames of the batch are checked by _latest_frame.
+        return metadata.get("stale", False)
+
+    def _process_image(self, images: Dict[int, np.ndarray]) -> Dict[int, KalmanBoxTracker]:
+        """Process frames of cameras by FCW.
+
+        Args:
+            images (Dict[int, np.ndarray]): Images by camera index.
+
+        Returns:
+            Dictionary of KalmanBoxTrackers of all cameras.
+        """
+
+        cameras = sorted(images.keys())
+        batch = [images[c] for c in cameras]
+        scales = [self._detection_scale(images[c], self._cameras[c]) for c in cameras]
+        detections = self._detector.detect_batch(batch, scales)
+        for stage, duration in self._detector.timings.items():
+            self.stage_metrics.record(stage, duration)
+        t0 = time.perf_counter_ns()
+        now = time.monotonic()
+        for camera, last_frame in enumerate(self._last_frame):
+            if camera in images:
+                self._last_frame[camera] = now
+            elif now - last_frame > CAMERA_TIMEOUT and self._tracked[camera]:
+                logger.warning(f"{self.name}: no frames of camera {self.camera_names[camera]}")
+                self._tracked[camera] = dict()
+        for camera, camera_detections in zip(cameras, detections):
+            tracker = self._trackers[camera]
+            tracker.update(detections_to_numpy(camera_detections))
+            self._tracked[camera] = {
+                t.id: t for t in tracker.trackers if t.hit_streak > tracker.min_hits and t.time_since_update < 1
+            }
+        t1 = time.perf_counter_ns()
+        # Reference points of all cameras in vehicle space, objects of cameras without frame are only predicted.
+        ref_points = dict()
+        for camera, tracked_objects in enumerate(self._tracked):
+            if camera in images:
+                camera_points = get_reference_points(
+                    tracked_objects, self._cameras[camera], is_rectified=self._is_rectified
+                )
+                ref_points.update(camera_points)
+            else:
+                ref_points.update({tid: None for tid in tracked_objects})
+        t2 = time.perf_counter_ns()
+        self._guard.update(ref_points)
+        t3 = time.perf_counter_ns()
+        self.stage_metrics.record("tracking", t1 - t0)
+        self.stage_metrics.record("reference_points", t2 - t1)
+        self.stage_metrics.record("guard_update", t3 - t2)
+
+        tracked = dict()
+        for tracked_objects in self._tracked:
+            tracked.update(tracked_objects)
+        return tracked
+
+    def _generate_results(
+        self, tracked_objects: Dict[int, KalmanBoxTracker], metadata: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Results of CollisionWorker with cameras of tracked objects and timestamps of camera frames."""
+
+        results = super()._generate_results(tracked_objects, metadata)
+        results["cameras"] = {name: list(self._tracked[c].keys()) for c, name in enumerate(self.camera_names)}
+        results["camera_timestamps"] = metadata.get("camera_timestamps", {})
+        return results
+
+    def reconfigure(self, config: Dict, camera_configs: Dict[str, Dict]) -> List[str]:
+        """Apply new FCW config and camera configs, see CollisionWorker.reconfigure. Cameras can not be added or
+        removed.
+
+        Args:
+            config (Dict): FCW config.
+            camera_configs (Dict[str, Dict]): Camera configs by camera names.
+
+        Returns:
+            Names of reconfigured components.
+        """
+
+        if list(camera_configs.keys()) != self.camera_names:
+            raise ValueError(f"Cameras of multi-camera worker are {self.camera_names}")
+        changed = super().reconfigure(config, self._config["camera_config"])
+        cameras = None
+        if camera_configs != self._config["camera_config"]:
+            changed.append("camera")
+            cameras = [Camera.from_dict(camera_configs[n]) for n in self.camera_names]
+        with self._config_lock:
+            # The first tracker was reconfigured by CollisionWorker.
+            for tracker in self._trackers[1:]:
+                tracker.max_age = self._tracker.max_age
+                tracker.min_hits = self._tracker.min_hits
+                tracker.iou_threshold = self._tracker.iou_threshold
+            if cameras is not None:
+                self._cameras = cameras
+                self._camera = cameras[0]
+            self._config["camera_config"] = camera_configs
+        return changed
@@ -0,0 +1,126 @@
+"""
+Sampling profiler of a running thread
+
+The profiler samples the stack of one thread (sys._current_frames) from a background thread for a given time and then
+stops itself. Nothing is installed into the profiled thread, so there is no overhead when the profiler is not running
+and the overhead of a running profiler is given by the sampling interval only.
+
+Results are written to the output directory as:
+    <tag>-<time>.collapsed - collapsed stacks ("frame;frame;frame count" lines) for flamegraph.pl or speedscope
+    <tag>-<time>.txt - per-function summary, samples in the function itself (self) and in the function or its callees
+        (total)
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Longest allowed profiling [s]
+MAX_DURATION = 300.0
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+
+class SamplingProfiler:
+    """Profiler of one thread running in its own background thread for a limited time."""
+
+    def __init__(self, thread_id: int, tag: str, output_dir: str, interval: float = 0.005) -> None:
+        """Constructor.
+
+        Args:
+            thread_id (int): Identifier (Thread.ident) of the profiled thread.
+            tag (str): Tag of output files, e.g. session id.
+            output_dir (str): Directory of output files, created if it does not exist.
+            interval (float): Sampling interval [s].
+        """
+
+        self.thread_id = thread_id
+        self.tag = tag
+        self.output_dir = output_dir
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float) -> None:
+        """Start sampling for the duration [s], the results are written when the sampling ends."""
+
+        duration = min(duration, MAX_DURATION)
+        self._thread = threading.Thread(target=self._run, args=(duration,), name=f"Profiler {self.tag}", daemon=True)
+        self._thread.start()
+        logger.info(f"Profiling {self.tag} for {duration:g} s")
+
+    def stop(self) -> None:
+        """Stop sampling early, the results are written."""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, duration: float) -> None:
+        end = time.monotonic() + duration
+        while not self._stop_event.wait(self.interval) and time.monotonic() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                # The profiled thread ended
+                break
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+        try:
+            collapsed, summary = self.write()
+            logger.info(f"Profile of {self.tag} ({self.samples} samples) written to {collapsed} and {summary}")
+        except OSError as ex:
+            logger.error(f"Failed to write profile of {self.tag}: {repr(ex)}")
+
+    def function_summary(self) -> Dict[str, Tuple[int, int]]:
+        """Self and total samples by function."""
+
+        self_samples: Counter = Counter()
+        total_samples: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] += count
+            # Recursive functions count once per sample
+            for name in set(frames):
+                total_samples[name] += count
+        return {name: (self_samples[name], total) for name, total in total_samples.items()}
+
+    def write(self) -> Tuple[str, str]:
+        """Write collapsed stacks and per-function summary.
+
+        Returns:
+            Paths of collapsed stacks and summary files.
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.tag}-{time.strftime('%Y%m%d-%H%M%S')}")
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(base + ".txt", "w") as f:
+            f.write(f"# {self.tag}: {self.samples} samples, interval {self.interval * 1e3:g} ms\n")
+            f.write(f"{'self':>8} {'self %':>7} {'total':>8} {'total %':>7}  function\n")
+            summary = sorted(self.function_summary().items(), key=lambda item: item[1], reverse=True)
+            for name, (self_count, total) in summary:
+                f.write(
+                    f"{self_count:8d} {100 * self_count / max(self.samples, 1):6.1f}% "
+                    f"{total:8d} {100 * total / max(self.samples, 1):6.1f}%  {name}\n"
+                )
+        return base + ".collapsed", base + ".txt"
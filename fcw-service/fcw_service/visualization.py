@@ -1,22 +1,25 @@
+"""
+Visualization of Forward Collision Warning Service sessions
+
+Subscribes to visualization publishers of all workers in a range of ZeroMQ ports and renders each session in its own
+thread to RTSP stream rtsp://localhost:{rtsp_port}/video/{session}. Every session has its own short queue of frames,
+a session that can not keep up drops its oldest frames without affecting the others.
+"""
 import cv2
 import argparse
 import logging
+import os
+import re
 import sys
 import threading
 import time
-from queue import Full, Queue
-from typing import Optional, Dict, Any
-
-USE_DISPLAY = 1
-
-if USE_DISPLAY:
-    cv2.namedWindow("Visualization")
+from queue import Empty, Full, Queue
+from typing import Optional, Dict, Any, Tuple
 
 import av
 from av.container.output import OutputContainer
 from av.stream import Stream
 
-import numpy
 import zmq
 from zmq import Socket, Context
 
@@ -24,227 +27,271 @@ logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger("FCW visualization")
 
 from fcw_core.vizualization import *
+from fcw_service.viz_transport import VizReceiver
 
+# Number of consecutive ports used by workers, see fcw_service.collision_worker.VIZ_PORT_RANGE
+VIZ_PORT_RANGE = int(os.getenv("VIZ_PORT_RANGE", 16))
+# Frames waiting for rendering in each session, the oldest are dropped when the session is late
+SESSION_QUEUE_SIZE = 2
+# Session is closed when no frame is received for this time [s]
+SESSION_TIMEOUT = 10
 
 
-def recv_array(socket: Socket, flags=0, copy=True, track=False) -> (Dict[str, Any], np.ndarray):
-    """recv a numpy array"""
-    try:
-        md = socket.recv_json(flags=flags)
-        msg = socket.recv(flags=flags, copy=copy, track=track)
-        buf = memoryview(msg)
-        image = numpy.frombuffer(buf, dtype=md["dtype"])
-        return md["results"], image.reshape(md["shape"])
-    except zmq.error.Again as e:
-        logger.debug("Missing visualization data!")
-        return {}, None
-
-
-def mark_vehicles(
-    size: tuple, objects: list, camera: Camera, marker: Image, anchor: tuple = (0, 0), to_rectified=False
-):
-    image = Image.new("RGBA", size, color=(0, 0, 0, 0))
-    ax, ay = anchor
-    # loc (N,2) xy
-    for o in objects:
-        X = np.atleast_2d([o["location"][0], o["location"][1], 0])
-        scr_loc, _ = camera.project_points(X, near=1, to_rectified=to_rectified)
-        if scr_loc.shape[0] > 0:
-            x, y = scr_loc[0]
-            image.paste(marker, (int(x - ax), int(y - ay)))
-    return image
-
-
-def draw_world_objects(
-    size: tuple,
-    camera: Camera,
-    objects: list,
-    to_rectified=False,
-):
-    image = Image.new("RGBA", size)
-    draw = ImageDraw.Draw(image)
-
-    for o in objects:
-        X = np.atleast_2d([o["location"][0], o["location"][1], 0])
-        scr_loc, _ = camera.project_points(X, to_rectified=to_rectified)
-        if scr_loc.size > 0:
-            x, y = scr_loc[0]
-            draw.line([(x - 10, y), (x + 10, y)], fill=(255, 255, 0, 128), width=3)
-            draw.line([(x, y - 10), (x, y + 10)], fill=(255, 255, 0, 128), width=3)
-
-        X = np.array(o["path"])
-        n = X.shape[0]
-        X = np.hstack([X, np.zeros((n, 1))])
-        scr_loc, _ = camera.project_points(X, near=5, to_rectified=to_rectified)
-        scr_loc = list(map(tuple, scr_loc))
-        draw.line(scr_loc, fill=(0, 255, 0, 255), width=1)
-
-    return image
-
-
-def draw_image_trackers(
-    size: tuple,
-    trackers: list,
-):
-    image = Image.new("RGBA", size)
-    draw = ImageDraw.Draw(image)
-
+def rectify_trackers(trackers: list, camera: Camera):
+    """Convert bounding boxes of trackers from distorted image to rectified image."""
+    rectified = []
     for t in trackers:
         x1, y1, x2, y2 = t["bbox"]
-        color = (0, 255, 0, 64)
-        outline = (0, 255, 0, 128)
-        if t["age"] < 3 or t["hit_streak"] == 0:  # TODO: call it.is_reliable()
-            color = (255, 255, 0, 32)
-            outline = None
-        draw.rectangle((x1, y1, x2, y2), fill=color, outline=outline)
-
-    return image
+        corners = np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], np.float32)
+        rx, ry = camera.rectify_points(corners).T
+        rectified.append(dict(t, bbox=[rx.min(), ry.min(), rx.max(), ry.max()]))
+    return rectified
+
+
+def stream_name(session: str) -> str:
+    """Session name usable in RTSP path"""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", session)
+
+
+class SessionRenderer(threading.Thread):
+    """Renders visualization of one session and streams it to RTSP server."""
+
+    def __init__(self, session: str, rtsp_url: str, display: Optional[Dict[str, np.ndarray]] = None, **kw) -> None:
+        """Constructor.
+
+        Args:
+            session (str): Session name.
+            rtsp_url (str): Output RTSP stream.
+            display (Dict[str, np.ndarray], optional): Rendered frames are stored here by session name for display.
+            **kw: Thread arguments.
+        """
+
+        super().__init__(name=f"Visualization {session}", daemon=True, **kw)
+        self.session = session
+        self.rtsp_url = rtsp_url
+        self.display = display
+        self.frames = Queue(SESSION_QUEUE_SIZE)
+        self.dropped = 0
+        self.rendered = 0
+
+        self._config: Optional[Dict] = None
+        self._config_version: Optional[int] = None
+        self._camera: Optional[Camera] = None
+        self._output: Optional[OutputContainer] = None
+        self._out_stream: Optional[Stream] = None
+
+    def put(self, config: Tuple[int, Dict[str, Any]], results: Dict[str, Any], image: np.ndarray) -> None:
+        """Queue frame for rendering, the oldest queued frame is dropped if the queue is full.
+
+        Args:
+            config (Tuple[int, Dict[str, Any]]): Version and configuration of the session.
+            results (Dict[str, Any]): FCW results.
+            image (np.ndarray): Image.
+        """
+
+        while True:
+            try:
+                self.frames.put_nowait((config, results, image))
+                return
+            except Full:
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+    def run(self) -> None:
+        logger.info(f"Session {self.session} streaming to {self.rtsp_url}")
+        while True:
+            try:
+                (version, config), results, image = self.frames.get(timeout=SESSION_TIMEOUT)
+            except Empty:
+                break
+            try:
+                if self._config_version != version:
+                    if not self._configure(config):
+                        continue
+                    self._config_version = version
+                cv_image = self._render(results, image)
+                self._encode(cv_image)
+                self.rendered += 1
+                if self.display is not None:
+                    self.display[self.session] = cv_image
+            except Exception as ex:
+                # Reopen output with next frame
+                logger.error(f"Session {self.session}: {repr(ex)}")
+                self._config_version = None
+
+        logger.info(f"Session {self.session} closed, rendered {self.rendered}, dropped {self.dropped} frames")
+        self._close()
+        if self.display is not None:
+            self.display.pop(self.session, None)
+
+    def _configure(self, config: Dict[str, Any]) -> bool:
+        if "camera_config" not in config:
+            return False
+        self._load_layers(config)
+
+        self._close()
+        # TODO: Check RTSP server is running
+        self._output = av.open(
+            self.rtsp_url,
+            mode="w",
+            format="rtsp",
+            options={"rtsp_transport": "tcp"},
+            timeout=2,
+        )
+        self._output.flags |= self._output.flags.NONBLOCK
+        self._out_stream = self._output.add_stream("h264", 30)
+        logger.debug(self._out_stream.codec_context.is_open)
+        self._out_stream.pix_fmt = "yuv420p"
+        self._out_stream.options = {"preset": "ultrafast", "tune": "zerolatency", "crf": "20"}
+        self._out_stream.width, self._out_stream.height = self._camera.rectified_size
+        self._config = config
+        return True
+
+    def _load_layers(self, config: Dict[str, Any]) -> None:
+        """Camera and static layers of the session configuration, used by _render."""
+
+        logger.info(f"Session {self.session}: initializing camera calibration")
+        self._camera = Camera.from_dict(config["camera_config"])
+        if type(config["config"]["fcw"].get("danger_zone")) == dict:
+            zone = Polygon(list(config["config"]["fcw"].get("danger_zone").values()))
+        else:
+            zone = Polygon(config["config"]["fcw"].get("danger_zone"))
+        self._overlay = static_overlay(self._camera, zone)
+        marker_image, self._marker_anchor = vehicle_marker_image(scale=3)
+        self._marker = Overlay.from_pil(marker_image)
+
+    def _close(self) -> None:
+        if self._output is not None:
+            try:
+                self._output.close()
+            except Exception as ex:
+                logger.debug(repr(ex))
+            self._output = None
+
+    def _render(self, results: Dict[str, Any], image: np.ndarray) -> np.ndarray:
+        camera = self._camera
+        trackers = list(results["dangerous_detections"].values())
+        if not self._config.get("is_rectified", True):
+            # Distorted image processing mode - rectify only for visualization, image may be downscaled by publisher
+            if image.shape[1::-1] != tuple(camera.image_size):
+                image = cv2.resize(image, tuple(camera.image_size))
+            image = camera.rectify_image(image)
+            trackers = rectify_trackers(trackers, camera)
+        elif image.shape[1::-1] != tuple(camera.rectified_size):
+            # Image may be rectified directly to detector input size
+            image = cv2.resize(image, tuple(camera.rectified_size))
+        else:
+            # Received buffer is read-only
+            image = image.copy()
+
+        logger.debug(results["dangerous_detections"])
+        logger.debug(results["objects"])
+        logger.debug("--------")
+
+        # Layers showing various information
+        self._overlay.blend(image)
+        boxes = [t["bbox"] for t in trackers]
+        reliable = [not (t["age"] < 3 or t["hit_streak"] == 0) for t in trackers]  # TODO: call it.is_reliable()
+        draw_image_trackers(image, boxes, reliable)
+        objects = list(results["objects"])
+        locations = np.array([o["location"][:2] for o in objects]).reshape(-1, 2)
+        draw_world_objects(image, camera, locations, [o.get("path", []) for o in objects], to_rectified=True)
+        object_statuses: List[ObjectStatus] = []
+        for object_status_str in objects:
+            object_status = ObjectStatus(
+                id=object_status_str["id"],
+                distance=object_status_str["distance"],
+                location=object_status_str["location"],
+                path=object_status_str.get("path"),
+                is_in_danger_zone=object_status_str["is_in_danger_zone"],
+                crosses_danger_zone=object_status_str["crosses_danger_zone"],
+                time_to_collision=object_status_str["time_to_collision"],
+            )
+            object_statuses.append(object_status)
+        draw_tracking_info(image, object_statuses)
+        mark_vehicles(image, camera, locations, self._marker, self._marker_anchor, to_rectified=True)
+        return image
 
+    def _encode(self, cv_image: np.ndarray) -> None:
+        out_frame = av.VideoFrame.from_ndarray(cv_image, format="bgr24")
+        out_packet = self._out_stream.encode(out_frame)
+        logger.debug(out_packet)
+        self._output.mux(out_packet)
 
-recv_queue = Queue(5)
-context: Context = zmq.Context()
-socket: Socket = context.socket(zmq.SUB)
-socket.setsockopt(zmq.SUBSCRIBE, b"")
-socket.setsockopt(zmq.RCVTIMEO, 2000)
 
+def recv_sessions(socket: Socket, rtsp_port: str, display: Optional[Dict[str, np.ndarray]] = None) -> None:
+    """Receive frames of all sessions and pass them to session renderers, renderers are started on demand."""
 
-def recv_results_with_images():
+    receiver = VizReceiver(socket)
+    sessions: Dict[str, SessionRenderer] = dict()
     while True:
-        results, image = recv_array(socket)
-        try:
-            recv_queue.put_nowait((results, image))
-        except Full:
-            logger.info(f"Results dropped {results}")
+        frame = receiver.recv()
+        if frame is None:
+            continue
+        session, config, results, image = frame
+        name = stream_name(session)
+        renderer = sessions.get(name)
+        if renderer is None or not renderer.is_alive():
+            renderer = sessions[name] = SessionRenderer(name, f"rtsp://localhost:{rtsp_port}/video/{name}", display)
+            renderer.start()
+        renderer.put(config, results, image)
 
 
 def main(args=None):
     parser = argparse.ArgumentParser(description="Visualization of Forward Collision Warning Service")
     parser.add_argument("--host", type=str, help="ZeroMQ Host uri", default="localhost")
-    parser.add_argument("-z", "--zmq_port", type=str, help="ZeroMQ port", default="5558")
+    parser.add_argument("-z", "--zmq_port", type=int, help="First ZeroMQ port of workers", default=5558)
+    parser.add_argument(
+        "-n", "--zmq_ports", type=int, help="Number of ZeroMQ ports of workers", default=VIZ_PORT_RANGE
+    )
     parser.add_argument(
-        "-u", "--rtsp_port", type=str, help="RTSP port, address is rtsp://localhost:{rtsp_port}/video", default="8554"
+        "-u",
+        "--rtsp_port",
+        type=str,
+        help="RTSP port, address is rtsp://localhost:{rtsp_port}/video/{session}",
+        default="8554",
     )
+    parser.add_argument("--display", action="store_true", help="Show sessions in windows")
     args = parser.parse_args()
 
-        
-    socket.connect("tcp://%s:%s" % (args.host, args.zmq_port))
-    logger.info("URI tcp://%s:%s" % (args.host, args.zmq_port))
-
-    camera: Optional[Camera] = None
-    config: Optional[Dict] = None
-    output = None
-
-    recv_thread = threading.Thread(target=recv_results_with_images, daemon=True)
+    context: Context = zmq.Context()
+    socket: Socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    socket.setsockopt(zmq.RCVTIMEO, 2000)
+    # Workers bind the first free port of the range, connections to unbound ports are retried by ZeroMQ
+    for port in range(args.zmq_port, args.zmq_port + args.zmq_ports):
+        socket.connect("tcp://%s:%s" % (args.host, port))
+    logger.info("URI tcp://%s:%s-%s" % (args.host, args.zmq_port, args.zmq_port + args.zmq_ports - 1))
+
+    display: Optional[Dict[str, np.ndarray]] = dict() if args.display else None
+    recv_thread = threading.Thread(target=recv_sessions, args=(socket, args.rtsp_port, display), daemon=True)
     recv_thread.start()
     print("Start FCW_Visualization !")
-    
-    while True:
-        try:
-            results, image = recv_queue.get()
-            if results is None or image is None:
-                #cv2.destroyAllWindows()
-                continue
-
-            if not config or config != results["config"]:
-                config = results["config"]
-                if "camera_config" not in config:
-                    config = None
-                    continue
-                logger.info("Initializing camera calibration")
-                camera = Camera.from_dict(config["camera_config"])
-                # logo = cog_logo((64, 64))
-                coord_sys = draw_world_coordinate_system(camera.rectified_size, camera)
-                coord_sys.putalpha(64)
-                if type(config["config"]["fcw"].get("danger_zone")) == dict:
-                    zone = Polygon(list(config["config"]["fcw"].get("danger_zone").values()))
-                else:
-                    zone = Polygon(config["config"]["fcw"].get("danger_zone"))
-                danger_zone = draw_danger_zone(camera.rectified_size, camera, zone)
-                horizon = draw_horizon(camera.rectified_size, camera, width=1, fill=(255, 255, 0, 64))
-                marker, marker_anchor = vehicle_marker_image(scale=3)
-
-                if output is not None:
-                    output.close()
-                # TODO: Check RTSP server is running
-                output: OutputContainer = av.open(
-                    f"rtsp://localhost:{args.rtsp_port}/video",
-                    mode="w",
-                    format="rtsp",
-                    options={"rtsp_transport": "tcp"},
-                    timeout=2,
-                )
-                output.flags |= output.flags.NONBLOCK
-                out_stream: Stream = output.add_stream("h264", 30)
-                logger.debug(out_stream.codec_context.is_open)
-                out_stream.pix_fmt = "yuv420p"
-                out_stream.options = {"preset": "ultrafast", "tune": "zerolatency", "crf": "20"}
-                out_stream.width = image.shape[1]
-                out_stream.height = image.shape[0]
-
-            logger.debug(results["dangerous_detections"])
-            logger.debug(results["objects"])
-            logger.debug("--------")
-
-            base_undistorted = Image.fromarray(image[..., ::-1], "RGB").convert("RGBA")
-            # Layers showing various information
-            sz = base_undistorted.size
-            layers = [
-                (coord_sys, None),
-                (danger_zone, None),
-                (horizon, None),
-                (draw_image_trackers(sz, list(results["dangerous_detections"].values())), None),
-                (draw_world_objects(sz, camera, list(results["objects"]), to_rectified=True), None),
-            ]
-            # Compose layers together
-            compose_layers(base_undistorted, *layers)
-            object_statuses: List[ObjectStatus] = []
-            for object_status_str in results["objects"]:
-                object_status = ObjectStatus(
-                    id=object_status_str["id"],
-                    distance=object_status_str["distance"],
-                    location=object_status_str["location"],
-                    path=object_status_str["path"],
-                    is_in_danger_zone=object_status_str["is_in_danger_zone"],
-                    crosses_danger_zone=object_status_str["crosses_danger_zone"],
-                    time_to_collision=object_status_str["time_to_collision"],
-                )
-                object_statuses.append(object_status)
-            w1, h1 = base_undistorted.size
-            compose_layers(
-                base_undistorted,  # Original image
-                (tracking_info((w1, 16), object_statuses), (0, 0)),
-                (
-                    mark_vehicles(
-                        camera.image_size, list(results["objects"]), camera, marker, marker_anchor, to_rectified=True
-                    ),
-                    (0, 0),
-                ),
-                # (logo, (8, 16 + 8)),
-            )
-            # Convert to OpenCV for display
-            cv_image = np.array(base_undistorted.convert("RGB"))[..., ::-1]
 
+    windows = set()
+    try:
+        while True:
+            if display is None:
+                time.sleep(1)
+                continue
             try:
-                out_frame = av.VideoFrame.from_ndarray(cv_image, format="bgr24")
-                out_packet = out_stream.encode(out_frame)
-                logger.info(out_packet)
-                output.mux(out_packet)
-                # time.sleep(1 / float(in_stream.framerate))
+                for session, cv_image in list(display.items()):
+                    # Display the image
+                    cv2.imshow(f"Visualization {session}", cv_image)
+                    windows.add(session)
+                for session in windows - display.keys():
+                    # Session closed
+                    cv2.destroyWindow(f"Visualization {session}")
+                    windows.discard(session)
+                cv2.waitKey(10)
             except Exception as ex:
-                config = None
-                logger.error(repr(ex))
-            
-            if USE_DISPLAY:
-                try:
-                # Display the image
-                    cv2.imshow("Visualization", cv_image)
-                    cv2.waitKey(1)
-                except Exception as ex:
-                    logger.debug(repr(ex))
-            
-        except KeyboardInterrupt:
-            logger.info("Terminating ...")
-            break
+                logger.debug(repr(ex))
+                time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Terminating ...")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+"""
+Transport of visualization data from CollisionWorker to the visualization service
+
+Messages are ZeroMQ multipart messages starting with message type and session name:
+
+    [b"config", session, JSON {"version": int, "config": {...}}]
+    [b"frame", session, header, results, image]
+
+Images are sent raw or compressed to JPEG or H.264 by a background encoder thread, the receiver decodes them.
+
+The configuration is announced when it changes, when a subscriber attaches and periodically. Frames refer to the
+configuration by its version (hash of its content), results are encoded by fcw_core_utils.results_codec and the image
+is sent and received without copies.
+
+The publisher uses XPUB socket to track subscriptions, frames are published only while somebody subscribes and
+at most at the configured rate.
+"""
+import json
+import logging
+import struct
+import threading
+import time
+import zlib
+from queue import Empty, Full, Queue
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+import zmq
+from zmq import Socket
+
+import av
+from av.codec import CodecContext
+from av.error import FFmpegError
+from era_5g_interface.frame_encoder import FrameEncoder
+from fcw_core_utils.geometry import fit_size
+from fcw_core_utils.results_codec import decode_results, encode_results
+
+logger = logging.getLogger(__name__)
+
+CONFIG_MESSAGE = b"config"
+FRAME_MESSAGE = b"frame"
+# Period of configuration announcements [s]
+CONFIG_PERIOD = 1.0
+
+# Image encodings and their ids in frame header
+CODECS = {"raw": 0, "jpeg": 1, "h264": 2}
+JPEG_QUALITY = 80
+# Keyframe every second, decoding recovers from lost frames
+H264_OPTIONS = {"preset": "ultrafast", "tune": "zerolatency", "x264-params": "keyint=30"}
+
+# config version, image height, width, channels, codec
+_frame_header = struct.Struct("<IHHHB")
+
+
+def config_version(config: Dict[str, Any]) -> int:
+    """Version id of the configuration, hash of its content."""
+    return zlib.crc32(json.dumps(config, sort_keys=True).encode())
+
+
+class VizPublisher:
+    """Publishes configuration and frames of one session.
+
+    The socket is used only by one thread. Raw frames are sent directly by the calling thread. Compressed frames are
+    encoded and sent by a background thread which also owns the socket, the latest frame waiting for encoding
+    replaces the previous one.
+    """
+
+    def __init__(
+        self,
+        socket: Socket,
+        session: str,
+        fps: Optional[float] = None,
+        max_size: Optional[int] = None,
+        codec: str = "raw",
+    ) -> None:
+        """Constructor.
+
+        Args:
+            socket (Socket): Bound ZeroMQ XPUB (or PUB) socket.
+            session (str): Session name.
+            fps (float, optional): Maximal rate of published frames, unlimited by default.
+            max_size (int, optional): Published images are downscaled to fit this size, not scaled by default.
+            codec (str): Image encoding, one of CODECS - raw (default), jpeg or h264.
+        """
+
+        if codec not in CODECS:
+            raise ValueError(f"Unknown visualization codec {codec}, use one of {list(CODECS)}")
+        self._socket = socket
+        self._session = session.encode()
+        self._config: Optional[bytes] = None
+        self._announce = False
+        self._version = 0
+        self._announced = 0.0
+        self._period = 1 / fps if fps else 0.0
+        self._published = 0.0
+        self._max_size = max_size
+        self._codec = codec
+        # Subscribed topics, PUB socket is always considered subscribed
+        self._topics = set() if socket.type == zmq.XPUB else {b""}
+        self._subscribed = bool(self._topics)
+        # Tracker of the last image sent without copy
+        self._tracker: Optional[zmq.MessageTracker] = None
+        self._encoder: Optional[FrameEncoder] = None
+        self._thread: Optional[threading.Thread] = None
+        self._frames = Queue(1)
+        self._stop_event = threading.Event()
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    @property
+    def subscribed(self) -> bool:
+        """Is there any subscriber?"""
+
+        if self._codec == "raw":
+            self._poll()
+        elif self._thread is None:
+            # The encoder thread owns the socket from now on
+            self._thread = threading.Thread(
+                target=self._run, name=f"Visualization encoder {self._session.decode()}", daemon=True
+            )
+            self._thread.start()
+        return self._subscribed
+
+    def _poll(self) -> None:
+        """Process pending subscription messages and configuration announcements, owner thread of socket only."""
+
+        while self._socket.type == zmq.XPUB:
+            try:
+                msg = self._socket.recv(zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+            if msg[:1] == b"\x01":
+                logger.info(f"Session {self._session.decode()}: visualization subscribed")
+                self._topics.add(msg[1:])
+                # Configuration and video stream start for the new subscriber
+                self._announce = True
+                self._encoder = None
+            elif msg[:1] == b"\x00":
+                logger.info(f"Session {self._session.decode()}: visualization unsubscribed")
+                self._topics.discard(msg[1:])
+        self._subscribed = bool(self._topics)
+        if self._config is not None and (self._announce or time.monotonic() - self._announced > CONFIG_PERIOD):
+            self._socket.send_multipart([CONFIG_MESSAGE, self._session, self._config])
+            self._announced = time.monotonic()
+            self._announce = False
+
+    def ready(self) -> bool:
+        """Should the next frame be published? There is a subscriber and the frame rate allows it."""
+
+        return self.subscribed and time.monotonic() - self._published >= self._period
+
+    def set_config(self, config: Dict[str, Any]) -> None:
+        """Set configuration of the session, it is announced before the next frame."""
+
+        self._version = config_version(config)
+        self._config = json.dumps(dict(version=self._version, config=config)).encode()
+        self._announce = True
+
+    def publish(self, results: Dict[str, Any], image: np.ndarray) -> None:
+        """Publish results with the image.
+
+        Raw image is sent without copy, it must not be modified afterwards. A frame is skipped when the image of
+        the previous frame has not been handed over to ZeroMQ yet. Compressed frames are passed to the encoder thread
+        (started by `ready`).
+
+        Args:
+            results (Dict[str, Any]): FCW results.
+            image (np.ndarray): Image (uint8).
+        """
+
+        self._published = time.monotonic()
+        if self._codec == "raw":
+            if self._tracker is not None and not self._tracker.done:
+                self.skipped += 1
+                return
+            self._send(results, image)
+            return
+
+        try:
+            self._frames.put_nowait((results, image))
+        except Full:
+            # Replace frame the encoder did not take yet
+            try:
+                self._frames.get_nowait()
+                self.skipped += 1
+            except Empty:
+                pass
+            self._frames.put_nowait((results, image))
+
+    def close(self) -> None:
+        """Stop the encoder thread. The socket is owned by the caller."""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._poll()
+            try:
+                results, image = self._frames.get(timeout=0.1)
+            except Empty:
+                continue
+            try:
+                self._send(results, image)
+            except Exception as ex:
+                logger.error(f"Session {self._session.decode()}: visualization encoding failed: {repr(ex)}")
+                self._encoder = None
+
+    def _send(self, results: Dict[str, Any], image: np.ndarray) -> None:
+        if self._codec == "raw":
+            self._poll()
+        if self._max_size and max(image.shape[:2]) > self._max_size:
+            image = cv2.resize(image, fit_size(image.shape[1::-1], self._max_size), interpolation=cv2.INTER_AREA)
+        image = np.ascontiguousarray(image, np.uint8)
+        h, w = image.shape[:2]
+        c = image.shape[2] if image.ndim == 3 else 1
+        if self._codec == "jpeg":
+            data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1]
+        elif self._codec == "h264":
+            if self._encoder is None or (self._encoder.width(), self._encoder.height()) != (w, h):
+                # Stream starts with keyframe, the receiver starts decoding from it
+                self._encoder = FrameEncoder(w, h, codec="h264", options=H264_OPTIONS)
+            data = self._encoder.encode_ndarray(image if c == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+            c = 3
+            if not data:
+                return
+        else:
+            data = image
+        header = _frame_header.pack(self._version, h, w, c, CODECS[self._codec])
+        parts = [FRAME_MESSAGE, self._session, header, encode_results(results)]
+        self._socket.send_multipart(parts, zmq.SNDMORE)
+        tracker = self._socket.send(data, copy=False, track=self._codec == "raw")
+        if self._codec == "raw":
+            self._tracker = tracker
+        self.frames += 1
+        self.bytes += sum(len(p) for p in parts) + (data.nbytes if isinstance(data, np.ndarray) else len(data))
+
+
+class VizReceiver:
+    """Receives frames of all sessions published on a SUB socket, keeps configurations of the sessions."""
+
+    def __init__(self, socket: Socket) -> None:
+        """Constructor.
+
+        Args:
+            socket (Socket): Connected and subscribed ZeroMQ SUB socket.
+        """
+
+        self._socket = socket
+        # session -> (version, config)
+        self.configs: Dict[str, Tuple[int, Dict[str, Any]]] = dict()
+        # session -> H.264 decoder
+        self._decoders: Dict[str, CodecContext] = dict()
+
+    def recv(self) -> Optional[Tuple[str, Tuple[int, Dict[str, Any]], Dict[str, Any], np.ndarray]]:
+        """Receive next frame.
+
+        Frames of sessions with unknown configuration are dropped.
+
+        Returns:
+            (session, (config version, config), results, read-only image) or None if nothing was received.
+        """
+
+        try:
+            parts = self._socket.recv_multipart(copy=False)
+        except zmq.error.Again:
+            logger.debug("Missing visualization data!")
+            return None
+        kind, session = parts[0].bytes, parts[1].bytes.decode()
+        if kind == CONFIG_MESSAGE:
+            msg = json.loads(parts[2].bytes)
+            current = self.configs.get(session)
+            if current is None or current[0] != msg["version"]:
+                logger.info(f"Session {session}: configuration version {msg['version']}")
+                self.configs[session] = msg["version"], msg["config"]
+            return None
+        if kind != FRAME_MESSAGE:
+            return None
+        version, h, w, c, codec = _frame_header.unpack(parts[2].buffer)
+        image = self._decode(session, codec, parts[4], (h, w, c) if c > 1 else (h, w))
+        config = self.configs.get(session)
+        if image is None or config is None or config[0] != version:
+            logger.debug(f"Session {session}: waiting for configuration {version} or keyframe")
+            return None
+        results = decode_results(parts[3].buffer)
+        return session, config, results, image
+
+    def _decode(self, session: str, codec: int, data: zmq.Frame, shape: tuple) -> Optional[np.ndarray]:
+        if codec == CODECS["raw"]:
+            return np.frombuffer(data.buffer, np.uint8).reshape(shape)
+        if codec == CODECS["jpeg"]:
+            return cv2.imdecode(np.frombuffer(data.buffer, np.uint8), cv2.IMREAD_UNCHANGED)
+        # H.264 frames must be decoded in order, also when they are not rendered
+        decoder = self._decoders.get(session)
+        if decoder is None:
+            decoder = self._decoders[session] = CodecContext.create("h264", "r")
+        try:
+            for frame in decoder.decode(av.Packet(data.bytes)):
+                return frame.to_ndarray(format="bgr24")
+        except FFmpegError as e:
+            logger.debug(f"Session {session}: {e}")
+        return None
@@ -0,0 +1,119 @@
+"""
+Pool of pre-loaded detectors for instant session start
+
+Loading of the detector model is the slow part of CollisionWorker creation. WarmDetectorPool keeps a few detectors
+loaded and warmed up by a dummy inference, so a new session only configures its camera, tracker and guard. A detector
+taken by a session is replaced in the background. Failed loads (e.g. out of GPU memory, failed model download) are
+retried with increasing delay.
+
+Only sessions with the detector configuration of the pool take pre-loaded detectors, others load their own.
+"""
+import logging
+import threading
+from queue import Empty, Queue
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from fcw_core.yolo_detector import YOLODetector
+
+logger = logging.getLogger(__name__)
+
+# Delay of the first retry of failed load, doubled by each failure up to the maximum [s]
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+
+def detector_key(d: Dict) -> Tuple:
+    """Detector configuration with defaults of YOLODetector.from_dict, equal keys give equal detectors."""
+
+    classes = d.get("classes")
+    return (
+        d.get("model", "yolov5n6"),
+        tuple(classes) if classes is not None else None,
+        d.get("max_size", 1024),
+        d.get("min_score", 0.3),
+        d.get("filter_in_frame", False),
+        d.get("min_area"),
+    )
+
+
+class WarmDetectorPool:
+    """Detectors loaded and warmed up in advance, refilled by a background thread."""
+
+    def __init__(
+        self,
+        size: int,
+        detector_config: Optional[Dict] = None,
+        warmup_shape=(720, 1280, 3),
+        factory: Callable[[Dict], YOLODetector] = YOLODetector.from_dict,
+        retry_delay: float = RETRY_DELAY,
+    ) -> None:
+        """Constructor, the pool is filled in the background.
+
+        Args:
+            size (int): Number of pre-loaded detectors.
+            detector_config (Dict, optional): Detector configuration (see YOLODetector.from_dict), defaults are used
+                by default.
+            warmup_shape (tuple): Shape of the dummy image of the warm-up inference.
+            factory (Callable[[Dict], YOLODetector]): Creates detector of the configuration.
+            retry_delay (float): Delay of the first retry of failed load [s], doubled by each failure up to
+                MAX_RETRY_DELAY.
+        """
+
+        self.size = size
+        self.detector_config = detector_config or {}
+        self.warmup_shape = warmup_shape
+        self._factory = factory
+        self._retry_delay = retry_delay
+        self._key = detector_key(self.detector_config)
+        self._detectors: Queue = Queue(size)
+        self._refill = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._fill, name="Warm detector pool", daemon=True)
+        self._refill.set()
+        self._thread.start()
+
+    def take(self, detector_config: Dict) -> Optional[YOLODetector]:
+        """Pre-loaded detector of the configuration.
+
+        Args:
+            detector_config (Dict): Detector configuration of the session.
+
+        Returns:
+            Warmed-up detector, None if the configuration differs or the pool is empty.
+        """
+
+        if detector_key(detector_config) != self._key:
+            return None
+        try:
+            detector = self._detectors.get_nowait()
+        except Empty:
+            return None
+        self._refill.set()
+        return detector
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._refill.set()
+        self._thread.join()
+
+    def _fill(self) -> None:
+        delay = self._retry_delay
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while not self._stop_event.is_set() and not self._detectors.full():
+                try:
+                    detector = self._factory(self.detector_config)
+                    detector.detect(np.zeros(self.warmup_shape, np.uint8))
+                except Exception as ex:
+                    logger.error(f"Failed to pre-load detector, retry in {delay:.0f}s: {repr(ex)}")
+                    self._stop_event.wait(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+                    continue
+                delay = self._retry_delay
+                self._detectors.put(detector)
+                logger.info(f"Pre-loaded detector {self._detectors.qsize()}/{self.size}")
+            if self._stop_event.is_set():
+                return
@@ -0,0 +1,436 @@
+"""
+Process-based FCW workers
+
+CollisionWorker threads share one interpreter (and its GIL) with the server and with each other. WorkerPool runs
+the workers in separate processes instead, each process hosts one or more sessions. Decoded frames are written to
+a shared-memory ring of the process and only small frame descriptors are passed through a pipe. Results come back
+through the same pipe as the messages sent to the client, in the encoding negotiated by the client (JSON results as
+plain dicts), so threads and processes send the same results. Results are not returned through shared memory, they
+have a few kB of variable size - pickling them for the pipe costs less than a handshake of fixed-size ring slots.
+
+ProcessWorker has the interface of CollisionWorker used by the server (start, stop, join, is_alive, running and
+latency_measurements), so the server handles both kinds of workers the same way.
+
+Pipe messages are tuples (kind, sid, ...):
+
+    server -> process: ("create", sid, worker_args), ("frame", sid, metadata, descriptor or image), ("stop", sid),
+                       ("profile", sid, duration, output directory, tag), ("exit", None)
+    process -> server: ("created", sid, error message or None), ("profiling", sid, started),
+                       ("results", sid, results message, (dropped frames, frame age counts, stage summaries or
+                       None)),
+                       ("error", sid, message), ("stopped", sid)
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing.connection import Connection
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from era_5g_interface.interface_helpers import LatencyMeasurements
+from fcw_service.metrics import FRAME_AGE_BOUNDS_MS, BucketHistogram, Summary
+from fcw_core_utils.shm_ring import FrameDescriptor, ShmRing
+
+logger = logging.getLogger(__name__)
+
+# Time to wait for worker creation (model loading), for worker stop and for reply to profiling request [s]
+CREATE_TIMEOUT = 60
+STOP_TIMEOUT = 10
+REPLY_TIMEOUT = 5
+# Period of sending stage duration summaries from processes [s]
+METRICS_PERIOD = 1.0
+
+
+def _pool_main(conn: Connection, ring: ShmRing, queue_size: int) -> None:
+    """Main function of pool process, serves pipe messages until exit or until the server closes the pipe."""
+
+    # Imported here, the server process does not need to import the detector when threads are not used
+    from fcw_service.collision_worker import CollisionWorker
+
+    workers: Dict[str, CollisionWorker] = dict()
+    send_lock = threading.Lock()
+    # Last sending of stage summaries by session
+    summaries_sent: Dict[str, float] = dict()
+
+    def send(msg: tuple) -> None:
+        with send_lock:
+            conn.send(msg)
+
+    def send_results(sid: str, message: Dict[str, Any]) -> None:
+        worker = workers.get(sid)
+        stats = None
+        if worker is not None:
+            summaries = None
+            if time.monotonic() - summaries_sent.get(sid, 0) > METRICS_PERIOD:
+                summaries = worker.metrics_summary()
+                summaries_sent[sid] = time.monotonic()
+            stats = (worker.dropped_frames, list(worker.frame_ages.counts), summaries)
+        send(("results", sid, message, stats))
+
+    def create(sid: str, worker_args: Dict[str, Any]) -> None:
+        # Detector loading takes time, other sessions of the process are served meanwhile
+        try:
+            worker = CollisionWorker(
+                image_queue=Queue(queue_size),
+                send_function=lambda message: send_results(sid, message),
+                send_error_function=lambda message: send(("error", sid, message)),
+                daemon=True,
+                **worker_args,
+            )
+            worker.start()
+        except Exception as ex:
+            logger.error(f"Failed to create CollisionWorker: {repr(ex)}")
+            send(("created", sid, repr(ex)))
+            return
+        workers[sid] = worker
+        send(("created", sid, None))
+
+    def put_frame(worker: CollisionWorker, metadata: Dict[str, Any], image: np.ndarray) -> None:
+        # The latest frame wins, the pipe reader never blocks on a slow session
+        while True:
+            try:
+                worker.image_queue.put_nowait((metadata, image))
+                return
+            except Full:
+                try:
+                    worker.image_queue.get_nowait()
+                except Empty:
+                    pass
+
+    while True:
+        try:
+            kind, sid, *args = conn.recv()
+        except (EOFError, OSError):
+            break
+        if kind == "create":
+            threading.Thread(target=create, args=(sid, *args), name=f"Create {sid}", daemon=True).start()
+        elif kind == "frame":
+            metadata, frame = args
+            if isinstance(frame, FrameDescriptor):
+                # The worker may keep the image (visualization), copy it and free the slot right away
+                image = ring.view(frame).copy()
+                ring.release(frame.slot)
+            else:
+                image = frame
+            worker = workers.get(sid)
+            if worker is None:
+                continue
+            if worker.is_alive():
+                put_frame(worker, metadata, image)
+            else:
+                del workers[sid]
+                send(("stopped", sid))
+        elif kind == "profile":
+            worker = workers.get(sid)
+            send(("profiling", sid, worker is not None and worker.start_profiling(*args)))
+        elif kind == "stop":
+            worker = workers.pop(sid, None)
+            if worker is not None:
+                worker.stop()
+                worker.join()
+            send(("stopped", sid))
+        elif kind == "exit":
+            break
+
+    for worker in workers.values():
+        worker.stop()
+    for worker in workers.values():
+        worker.join()
+    ring.close()
+
+
+class PoolProcess:
+    """One process of the pool with its shared-memory ring and pipe."""
+
+    def __init__(self, context, index: int, slots: int, slot_size: int, queue_size: int) -> None:
+        """Constructor.
+
+        Args:
+            context: Multiprocessing context.
+            index (int): Process number, used in names.
+            slots (int): Number of frames in flight from server to the process.
+            slot_size (int): Maximal size of frame in the ring [B], larger frames are sent through the pipe.
+            queue_size (int): Input queue size of workers in the process.
+        """
+
+        self.name = f"FCW worker process {index}"
+        self.ring = ShmRing(slots, slot_size, context)
+        self.workers: Dict[str, "ProcessWorker"] = dict()
+        self._conn, child_conn = context.Pipe()
+        self._send_lock = threading.Lock()
+        self._closing = False
+        self.process = context.Process(
+            target=_pool_main, args=(child_conn, self.ring, queue_size), name=self.name, daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self._reader = threading.Thread(target=self._read, name=f"{self.name} reader", daemon=True)
+        self._reader.start()
+        logger.info(f"{self.name} started, pid {self.process.pid}")
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def send(self, msg: tuple) -> bool:
+        """Send message to the process, False if the process is gone."""
+
+        try:
+            with self._send_lock:
+                self._conn.send(msg)
+            return True
+        except (BrokenPipeError, EOFError, OSError):
+            return False
+
+    def _read(self) -> None:
+        while True:
+            try:
+                kind, sid, *args = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            worker = self.workers.get(sid)
+            if worker is None:
+                continue
+            if kind == "created":
+                worker._on_created(*args)
+            elif kind == "results":
+                worker._on_results(*args)
+            elif kind == "profiling":
+                worker._on_profiling(*args)
+            elif kind == "error":
+                worker._on_error(*args)
+            elif kind == "stopped":
+                worker._on_stopped()
+        # Process ended, workers can not continue
+        if not self._closing:
+            logger.warning(f"{self.name} exited")
+        for worker in list(self.workers.values()):
+            worker._on_stopped()
+
+    def close(self) -> None:
+        """Stop the process and free the ring."""
+
+        self._closing = True
+        self.send(("exit", None))
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+        self.ring.close()
+
+
+class ProcessWorker:
+    """FCW worker running in a pool process, proxy with the interface of CollisionWorker.
+
+    Frames from the image queue are written to the ring of the process by a feeder thread. When the ring is full,
+    the frame is dropped and the next one from the queue is taken.
+    """
+
+    def __init__(
+        self,
+        process: PoolProcess,
+        sid: str,
+        image_queue: Queue,
+        send_function: Callable[[Dict[str, Any]], None],
+        send_error_function: Optional[Callable[[Dict[str, Any]], None]] = None,
+        name: Optional[str] = None,
+        **worker_args,
+    ) -> None:
+        """Constructor. Creates the worker in the process and waits until it is ready.
+
+        Args:
+            process (PoolProcess): Process running the worker.
+            sid (str): Session id.
+            image_queue (Queue): The queue with all to-be-processed images.
+            send_function (Callable[[Dict], None]): Callback used to send results.
+            send_error_function (Callable[[Dict], None], optional): Callback used to send errors.
+            name (str, optional): Worker name.
+            **worker_args: CollisionWorker arguments (config, camera_config, fps, viz...), must be picklable.
+
+        Raises:
+            RuntimeError: Worker creation failed in the process.
+        """
+
+        self.name = name or f"Collision Worker {sid}"
+        self.sid = sid
+        self.image_queue = image_queue
+        self.latency_measurements: LatencyMeasurements = LatencyMeasurements()
+        # Frames dropped by the feeder (full ring) and by the worker, ages of frames in the worker.
+        self.dropped = 0
+        self.worker_dropped_frames = 0
+        self.frame_ages = BucketHistogram(FRAME_AGE_BOUNDS_MS)
+        self._metrics_summary: Dict[str, Summary] = dict()
+        self._process = process
+        self._send_function = send_function
+        self._send_error_function = send_error_function
+        self._created = threading.Event()
+        self._stopped = threading.Event()
+        self._stop_event = threading.Event()
+        # Set when the feeder runs, the worker in the process runs since its creation.
+        self.running = threading.Event()
+        self._error: Optional[str] = None
+        self._feeder: Optional[threading.Thread] = None
+        # Reply of the process to profiling request, one request at a time
+        self._profiling_lock = threading.Lock()
+        self._profiling_reply = threading.Event()
+        self._profiling_started = False
+
+        process.workers[sid] = self
+        if not process.send(("create", sid, dict(worker_args, name=self.name))):
+            self._error = f"{process.name} is not running"
+        elif not self._created.wait(CREATE_TIMEOUT):
+            self._error = f"Timed out to create worker in {process.name}"
+        if self._error is not None:
+            process.workers.pop(sid, None)
+            raise RuntimeError(self._error)
+
+    def start(self) -> None:
+        self._feeder = threading.Thread(target=self._feed, name=f"{self.name} feeder", daemon=True)
+        self._feeder.start()
+        self.running.set()
+
+    def is_alive(self) -> bool:
+        return not self._stopped.is_set() and self._process.is_alive()
+
+    def stop(self) -> None:
+        """Set stop event to stop FCW worker."""
+
+        self._stop_event.set()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """Wait for feeder thread and for the worker in the process."""
+
+        if self._feeder is not None:
+            self._feeder.join(timeout)
+        if not self._stopped.is_set() and self._process.send(("stop", self.sid)):
+            self._stopped.wait(timeout or STOP_TIMEOUT)
+        self._process.workers.pop(self.sid, None)
+
+    def _feed(self) -> None:
+        ring = self._process.ring
+        while not self._stop_event.is_set() and self.is_alive():
+            try:
+                metadata, image = self.image_queue.get(block=True, timeout=1)
+            except Empty:
+                continue
+            image = np.ascontiguousarray(image)
+            if image.nbytes > ring.slot_size:
+                frame = image
+            else:
+                frame = ring.put(image, timeout=1)
+                if frame is None:
+                    # The process does not keep up
+                    self.dropped += 1
+                    continue
+            if not self._process.send(("frame", self.sid, metadata, frame)):
+                break
+
+    def _on_created(self, error: Optional[str]) -> None:
+        self._error = error
+        self._created.set()
+
+    @property
+    def dropped_frames(self) -> int:
+        return self.dropped + self.worker_dropped_frames
+
+    def start_profiling(self, duration: float, output_dir: str, tag: Optional[str] = None) -> bool:
+        """Profile the worker in its process, see CollisionWorker.start_profiling. Files are written by the process.
+
+        Returns:
+            False if the worker is not running, it is being profiled already or the process did not reply.
+        """
+
+        with self._profiling_lock:
+            self._profiling_reply.clear()
+            self._profiling_started = False
+            if not self.is_alive() or not self._process.send(("profile", self.sid, duration, output_dir, tag)):
+                return False
+            self._profiling_reply.wait(REPLY_TIMEOUT)
+            return self._profiling_started
+
+    def _on_profiling(self, started: bool) -> None:
+        self._profiling_started = started
+        self._profiling_reply.set()
+
+    def metrics_summary(self) -> Dict[str, Summary]:
+        """Summaries of durations of processing stages, updated by the process periodically."""
+
+        return self._metrics_summary
+
+    def _on_results(self, message: Dict[str, Any], stats: Optional[tuple]) -> None:
+        if stats is not None:
+            self.worker_dropped_frames, self.frame_ages.counts, summaries = stats
+            if summaries is not None:
+                self._metrics_summary = summaries
+        self.latency_measurements.store_latency(time.perf_counter_ns() - message["recv_timestamp"])
+        self._send_function(message)
+
+    def _on_error(self, message: Dict[str, Any]) -> None:
+        if self._send_error_function:
+            self._send_error_function(message)
+
+    def _on_stopped(self) -> None:
+        self._stopped.set()
+        self._profiling_reply.set()
+        if not self._created.is_set():
+            self._error = self._error or "Worker process exited"
+            self._created.set()
+
+
+class WorkerPool:
+    """Pool of processes running FCW workers.
+
+    A new session goes to the process with the least sessions. Processes are started on demand up to the given
+    number, so with enough processes each session has its own.
+    """
+
+    def __init__(self, processes: int, slots: int = 4, slot_size: int = 1920 * 1080 * 3, queue_size: int = 1) -> None:
+        """Constructor.
+
+        Args:
+            processes (int): Maximal number of processes.
+            slots (int): Number of frames in flight to each process.
+            slot_size (int): Maximal size of frame in shared memory [B], larger frames are sent through the pipe.
+            queue_size (int): Input queue size of workers in processes.
+        """
+
+        self.max_processes = processes
+        self.slots = slots
+        self.slot_size = slot_size
+        self.queue_size = queue_size
+        # Fork of the server with running threads is not safe, processes import what they need
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[PoolProcess] = []
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _select_process(self) -> PoolProcess:
+        with self._lock:
+            for p in [p for p in self._processes if not p.is_alive()]:
+                logger.warning(f"Removing dead {p.name}")
+                p.close()
+                self._processes.remove(p)
+            idle = [p for p in self._processes if not p.workers]
+            if idle:
+                return idle[0]
+            if len(self._processes) < self.max_processes:
+                self._started += 1
+                p = PoolProcess(self._context, self._started, self.slots, self.slot_size, self.queue_size)
+                self._processes.append(p)
+                return p
+            return min(self._processes, key=lambda p: len(p.workers))
+
+    def create_worker(self, sid: str, **kw) -> ProcessWorker:
+        """Create worker of the session in one of the processes, arguments are those of ProcessWorker."""
+
+        return ProcessWorker(self._select_process(), sid, **kw)
+
+    def close(self) -> None:
+        """Stop all processes."""
+
+        with self._lock:
+            for p in self._processes:
+                p.close()
+            self._processes.clear()
@@ -0,0 +1,17 @@
+from fcw_service.latency_controller import DetectorLevel, LatencyController
+
+
+def test_cadence_level_is_kept_while_detection_is_slow():
+    ladder = [DetectorLevel("yolov5m6", 1024, 1), DetectorLevel("yolov5m6", 1024, 2)]
+    controller = LatencyController(0.15, ladder, interval=0, down_after=2, up_after=2, up_ratio=0.8)
+    for _ in range(2):
+        controller.update(int(0.2e9), 0.0)
+    assert controller.current.cadence == 2
+
+    # Cadence 2: frames with detection take 200 ms, repeated results 10 ms. The worker observes only the frames with
+    # detection, mean of all frames (105 ms) would be under up_ratio * target_latency (120 ms) and restore the level.
+    for frame in range(100):
+        if frame % controller.current.cadence:
+            continue
+        controller.update(int(0.2e9), 0.0)
+        assert controller.level == 1
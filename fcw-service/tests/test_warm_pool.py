@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+pytest.importorskip("fcw_core.yolo_detector")
+
+from fcw_service.warm_pool import WarmDetectorPool
+
+
+class FakeDetector:
+    def detect(self, image):
+        return []
+
+
+def test_failed_load_is_retried():
+    calls = []
+
+    def factory(config):
+        calls.append(config)
+        if len(calls) == 1:
+            raise RuntimeError("CUDA out of memory")
+        return FakeDetector()
+
+    pool = WarmDetectorPool(1, factory=factory, retry_delay=0.01)
+    try:
+        deadline = time.monotonic() + 5
+        detector = None
+        while detector is None and time.monotonic() < deadline:
+            detector = pool.take({})
+            time.sleep(0.01)
+        assert isinstance(detector, FakeDetector)
+        # The failed load was retried, the taken detector may be replaced already
+        assert len(calls) >= 2
+    finally:
+        pool.close()